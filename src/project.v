@@ -33,6 +33,13 @@ module tt_um_MichaelBell_tinyQV (
     localparam PERI_SPI_STATUS = 4'h9;
     localparam PERI_DEBUG = 4'hC;
 
+    // Simulation can run the UART faster than the real 115200 baud
+`ifdef SIM_UART_BIT_RATE
+    localparam UART_BIT_RATE = `SIM_UART_BIT_RATE;
+`else
+    localparam UART_BIT_RATE = 115_200;
+`endif
+
     // Register the reset on the negative edge of clock for safety.
     // This also allows the option of async reset in the design, which might be preferable in some cases
     /* verilator lint_off SYNCASYNCNET */
@@ -211,7 +218,7 @@ module tt_um_MichaelBell_tinyQV (
         end
     end
 
-    uart_tx #(.CLK_HZ(64_000_000), .BIT_RATE(115_200)) i_uart_tx(
+    uart_tx #(.CLK_HZ(64_000_000), .BIT_RATE(UART_BIT_RATE)) i_uart_tx(
         .clk(clk),
         .resetn(rst_reg_n),
         .uart_txd(uart_txd),
@@ -220,7 +227,7 @@ module tt_um_MichaelBell_tinyQV (
         .uart_tx_busy(uart_tx_busy) 
     );
 
-    uart_rx #(.CLK_HZ(64_000_000), .BIT_RATE(115_200)) i_uart_rx(
+    uart_rx #(.CLK_HZ(64_000_000), .BIT_RATE(UART_BIT_RATE)) i_uart_rx(
         .clk(clk),
         .resetn(rst_reg_n),
         .uart_rxd(uart_rxd),
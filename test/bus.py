@@ -0,0 +1,130 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Pin level interfaces to the QSPI, UART and SPI buses of tb and tb_qspi.
+#
+# The signal handles are looked up once, and the outputs are read as the
+# packed uio_out, uio_oe and uo_out vectors, one read each per sample, and
+# decoded into a named tuple by table lookup.  Fields with X or Z bits are
+# None.  Inputs are driven through the handles kept on the bus objects.
+#
+#   qspi = QspiBus.of(dut)
+#   state = qspi.sample()
+#   if state.clk == 1 and state.select(FLASH) == 0: ...
+#   qspi.expect(device=FLASH, clk=0, data_oe=0xF)
+
+from collections import namedtuple
+
+from cocotb.triggers import FallingEdge
+
+FLASH, RAM_A, RAM_B = 0, 1, 2
+
+# Decodes an 8-bit vector into a named tuple of fields, each given by its
+# bits from most to least significant
+class _Decoder:
+    def __init__(self, state_type, fields):
+        self.state_type = state_type
+        self.fields = fields
+        self.table = [state_type(*(self._field(v, bits) for bits in fields)) for v in range(256)]
+
+    @staticmethod
+    def _field(value, bits):
+        result = 0
+        for bit in bits:
+            result = (result << 1) | ((value >> bit) & 1)
+        return result
+
+    def decode(self, value):
+        if value.is_resolvable:
+            return self.table[value.integer]
+        binstr = value.binstr
+        fields = []
+        for bits in self.fields:
+            chars = "".join(binstr[-1 - bit] for bit in bits)
+            fields.append(int(chars, 2) if chars.strip("01") == "" else None)
+        return self.state_type(*fields)
+
+_QspiOut = namedtuple("_QspiOut", "flash_select ram_a_select ram_b_select clk data_out")
+_qspi_out = _Decoder(_QspiOut, ((0,), (6,), (7,), (3,), (5, 4, 2, 1)))
+_qspi_oe = _Decoder(namedtuple("_QspiOe", "data_oe"), ((5, 4, 2, 1),))
+
+class QspiState(namedtuple("QspiState", _QspiOut._fields + ("data_oe",))):
+    __slots__ = ()
+
+    # The select of device FLASH, RAM_A or RAM_B
+    def select(self, device):
+        return self[device]
+
+def _expect(bus, state, expected):
+    for name, value in expected.items():
+        actual = getattr(state, name)
+        assert actual == value, "{} {} is {}, expected {}".format(bus, name, actual, value)
+
+_buses = {}
+
+class _Bus:
+    # The bus of dut, created on first use
+    @classmethod
+    def of(cls, dut):
+        bus = _buses.get((cls, dut))
+        if bus is None:
+            bus = _buses[(cls, dut)] = cls(dut)
+        return bus
+
+class QspiBus(_Bus):
+    def __init__(self, dut):
+        self.clk = dut.clk
+        self.rst_n = dut.rst_n
+        self.uio_out = dut.uio_out
+        self.uio_oe = dut.uio_oe
+        self.data_in = dut.qspi_data_in
+        self.selects = (dut.qspi_flash_select, dut.qspi_ram_a_select, dut.qspi_ram_b_select)
+        self.falling_edge = FallingEdge(dut.clk)
+
+    def sample(self, oe=True):
+        out = _qspi_out.decode(self.uio_out.value)
+        return QspiState(*out, _qspi_oe.decode(self.uio_oe.value).data_oe if oe else None)
+
+    def in_reset(self):
+        return self.rst_n.value.binstr != "1"
+
+    # Assert the value of each field given.  device checks all three
+    # selects: only that device's is low, or none if it is None.  selected
+    # only checks that the given device's select is low.
+    def expect(self, state=None, device=..., selected=None, **expected):
+        if state is None:
+            state = self.sample("data_oe" in expected)
+        if device is not ...:
+            for i, name in enumerate(QspiState._fields[:3]):
+                expected[name] = 0 if i == device else 1
+        if selected is not None:
+            expected[QspiState._fields[selected]] = 0
+        _expect("QSPI", state, expected)
+
+UartState = namedtuple("UartState", "tx rts debug_tx")
+_uart = _Decoder(UartState, ((0,), (1,), (6,)))
+
+class UartPins(_Bus):
+    def __init__(self, dut):
+        self.uo_out = dut.uo_out
+        self.rx = dut.uart_rx
+
+    def sample(self):
+        return _uart.decode(self.uo_out.value)
+
+    def expect(self, **expected):
+        _expect("UART", self.sample(), expected)
+
+SpiState = namedtuple("SpiState", "cs sck mosi dc")
+_spi = _Decoder(SpiState, ((4,), (5,), (3,), (2,)))
+
+class SpiPins(_Bus):
+    def __init__(self, dut):
+        self.uo_out = dut.uo_out
+        self.miso = dut.spi_miso
+
+    def sample(self):
+        return _spi.decode(self.uo_out.value)
+
+    def expect(self, **expected):
+        _expect("SPI", self.sample(), expected)
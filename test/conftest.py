@@ -0,0 +1,15 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# The test modules in this directory are cocotb tests, run by make under a
+# simulator.  pytest only collects the unit tests of the Python models and
+# offline tools in unit/.
+
+import os
+import sys
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TEST_DIR)
+
+def pytest_ignore_collect(collection_path, config):
+    return str(collection_path.parent) == TEST_DIR and collection_path.suffix == ".py"
@@ -0,0 +1,230 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Analytic model of the cycles tinyQV takes to run a program, calibrated
+# from the benchmark results of an RTL simulation of tb_qspi.
+#
+# The cycles are a linear function of counts taken from the instructions a
+# program executes:
+#   instr16, instr32  - instructions by size, the bytes fetched
+#   restart           - taken branches, jumps, calls and returns, each
+#                       restarting the flash read, and the same count
+#                       multiplied by the latency
+#   load, store       - RAM and flash accesses, which also restart the
+#                       flash read, and the same counts multiplied by the
+#                       latency, and the bytes transferred
+#   shift, mul        - instructions that may take longer to execute
+# Peripheral accesses count as plain instructions.
+#
+# Calibration fits the cost of each count by non-negative least squares to the
+# cycles measured by make bench, for every kernel in kernels.py at every
+# latency.  The fit is pulled weakly toward costs estimated from the QSPI protocol,
+# PRIOR, so costs the kernels can't tell apart (the kernels have no
+# compressed instructions, for example) stay at those estimates.  The stated
+# error bound is the largest error predicting each kernel from a fit to the
+# other kernels only.
+#
+#   python cycle_model.py calibrate [bench_results.json]
+#   python cycle_model.py predict --kernel sieve --latency 4
+#   python cycle_model.py predict prime.hex --static
+#   python cycle_model.py predict hello.hex --expect "Hello 36"
+#
+# The counts come from running the program on the reference model until it
+# writes to the debug UART or finishes, or with --static from each basic block
+# found by fetch_cost.py run once, so a loop counts one iteration.  The model's
+# UART is never busy, so time spent waiting for peripherals isn't predicted.
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from kernels import KERNELS, UART, trace_on_model
+from qspi_memory import read_image
+from tinyqv_model import TinyQVModel, TP_VALUE
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_FILE = os.path.join(TEST_DIR, "cycle_model.json")
+FEATURES = ("instr16", "instr32", "restart", "restart_latency", "load", "load_latency",
+            "load_bytes", "store", "store_latency", "store_bytes", "shift", "mul")
+
+# A nibble every two clocks: a restart sends 6 address, 2 mode and 4 dummy
+# nibbles, a RAM read 2 command, 6 address and 4 dummy nibbles, and a RAM
+# write 2 command and 6 address nibbles, each followed by a fetch restart.
+PRIOR = {"instr16": 8, "instr32": 16, "restart": 26, "restart_latency": 1,
+         "load": 52, "load_latency": 2, "load_bytes": 4,
+         "store": 44, "store_latency": 1, "store_bytes": 4, "shift": 0, "mul": 0}
+PRIOR_WEIGHT = 1.0
+SHIFTS = {"sll", "slli", "srl", "srli", "sra", "srai", "c.slli", "c.srli", "c.srai"}
+
+# Counts of an instruction, latency is applied later
+def _count(counts, name, size, access, taken):
+    counts["instr16" if size == 2 else "instr32"] += 1
+    if taken:
+        counts["restart"] += 1
+    if access is not None and access.addr < TP_VALUE:
+        kind = "store" if access.store else "load"
+        counts[kind] += 1
+        counts[kind + "_bytes"] += access.size
+    if name in SHIFTS:
+        counts["shift"] += 1
+    elif name == "c.mul16":
+        counts["mul"] += 1
+
+def _empty_counts():
+    return dict.fromkeys(("instr16", "instr32", "restart", "load", "load_bytes",
+                          "store", "store_bytes", "shift", "mul"), 0)
+
+# Counts from the instructions retired by the reference model
+def trace_counts(trace):
+    counts = _empty_counts()
+    for retired, following in zip(trace, trace[1:] + [None]):
+        size = 4 if (retired.instr & 3) == 3 else 2
+        taken = following is not None and following.pc != retired.pc + size
+        _count(counts, retired.name, size, retired.access, taken)
+    return counts
+
+# Counts from running each basic block of an image once.  Each instruction
+# is executed on a fresh model to classify it, so accesses relative to tp
+# are recognised as peripheral accesses.
+def static_counts(image):
+    from fetch_cost import ENTRY_POINTS, find_blocks
+    counts = _empty_counts()
+    for block in find_blocks(image, ENTRY_POINTS):
+        for addr, (size, _, _) in block.instrs:
+            model = TinyQVModel()
+            model.pc = addr
+            try:
+                retired = model.execute(int.from_bytes(image[addr:addr + size], "little"), lambda a, s: 0)
+                _count(counts, retired.name, size, retired.access, False)
+            except ValueError:
+                _count(counts, None, size, None, False)
+        counts["restart"] += block.taken
+    return counts
+
+# Counts from running an image on the reference model until it has sent the
+# expected strings on the UART, in order
+def output_counts(image, expect, max_instrs=1000000):
+    uart = []
+    trace, _ = trace_on_model(image, max_instrs, uart)
+    output = bytes(uart).decode("latin-1")
+    end = 0
+    for s in expect:
+        found = output.find(s, end)
+        if found < 0:
+            raise ValueError("The model didn't send {!r}".format(s))
+        end = found + len(s)
+    for i, retired in enumerate(trace):
+        access = retired.access
+        if access is not None and access.store and access.addr == TP_VALUE + UART:
+            end -= 1
+            if end == 0:
+                return trace_counts(trace[:i + 1])
+    return trace_counts(trace)
+
+def features(counts, latency):
+    return np.array([counts[name] if name in counts else
+                     counts[name.split("_latency")[0]] * latency for name in FEATURES], dtype=float)
+
+# Least squares, with PRIOR_WEIGHT rows pulling each cost toward PRIOR.  Costs
+# can't be negative: any that come out negative are fixed at zero and the rest
+# refitted, until none are.
+def fit(rows):
+    x = np.array([features(counts, latency) for counts, latency, _ in rows])
+    y = np.array([cycles for _, _, cycles in rows], dtype=float)
+    x = np.vstack([x, PRIOR_WEIGHT * np.eye(len(FEATURES))])
+    y = np.concatenate([y, PRIOR_WEIGHT * np.array([PRIOR[name] for name in FEATURES], dtype=float)])
+    free = np.ones(len(FEATURES), dtype=bool)
+    costs = np.zeros(len(FEATURES))
+    while free.any():
+        costs[:] = 0
+        costs[free] = np.linalg.lstsq(x[:, free], y, rcond=None)[0]
+        if (costs >= 0).all():
+            break
+        free &= costs > 0
+    return costs
+
+def kernel_counts():
+    counts = {}
+    for name, kernel in KERNELS.items():
+        trace, result = trace_on_model(kernel().assemble())
+        counts[name] = trace_counts(trace)
+    return counts
+
+# Fit to the benchmark results, and find the error bound by leaving each
+# kernel out in turn
+def calibrate(results):
+    counts = kernel_counts()
+    rows = [(counts[r["kernel"]], r["latency"], r["cycles"]) for r in results if r["kernel"] in counts]
+    coefficients = fit(rows)
+
+    def error(costs, row):
+        counts, latency, cycles = row
+        return 100 * abs(features(counts, latency) @ costs - cycles) / cycles
+
+    fit_error = max(error(coefficients, row) for row in rows)
+    held_out_error = 0.0
+    for name in {r["kernel"] for r in results if r["kernel"] in counts}:
+        costs = fit([row for row in rows if row[0] is not counts[name]])
+        held_out_error = max([held_out_error] + [error(costs, row) for row in rows if row[0] is counts[name]])
+
+    return {"features": list(FEATURES), "coefficients": [round(float(c), 4) for c in coefficients],
+            "fit_error_percent": round(float(fit_error), 2), "error_percent": round(float(held_out_error), 2)}
+
+def predict(model, counts, latency):
+    return float(features(counts, latency) @ np.array(model["coefficients"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Analytic cycle model for tinyQV")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    cal = subparsers.add_parser("calibrate", help="Fit the model to benchmark results")
+    cal.add_argument("results", nargs="?", default=os.path.join(TEST_DIR, "bench_results.json"))
+    cal.add_argument("--model", default=MODEL_FILE)
+    pred = subparsers.add_parser("predict", help="Predict the cycles a program takes")
+    pred.add_argument("image", nargs="?", help=".hex, ELF or binary image")
+    pred.add_argument("--kernel", choices=KERNELS, help="Predict a kernel from kernels.py instead of an image")
+    pred.add_argument("--latency", default="1,2,3,4,5", help="Latencies, e.g. 1,4")
+    pred.add_argument("--static", action="store_true", help="Count each basic block once instead of running the image")
+    pred.add_argument("--expect", action="append", help="Stop once this has been sent on the UART, may be repeated")
+    pred.add_argument("--max-instrs", type=int, default=1000000)
+    pred.add_argument("--model", default=MODEL_FILE)
+    args = parser.parse_args()
+
+    if args.command == "calibrate":
+        with open(args.results) as f:
+            model = calibrate(json.load(f))
+        with open(args.model, "w") as f:
+            json.dump(model, f, indent=1)
+        for name, cost in zip(model["features"], model["coefficients"]):
+            print("{:16} {:8.2f} cycles".format(name, cost))
+        print("Fit error {}%, error predicting a kernel not in the fit {}%".format(
+              model["fit_error_percent"], model["error_percent"]))
+        return 0
+
+    with open(args.model) as f:
+        model = json.load(f)
+    if args.kernel:
+        image = KERNELS[args.kernel]().assemble()
+    elif args.image:
+        image = read_image(args.image)
+    else:
+        parser.error("give an image or --kernel")
+    if args.static:
+        counts = static_counts(image)
+    elif args.expect:
+        counts = output_counts(image, args.expect, args.max_instrs)
+    else:
+        trace, result = trace_on_model(image, args.max_instrs)
+        if len(trace) == args.max_instrs:
+            print("Stopped after {} instructions".format(len(trace)))
+        counts = trace_counts(trace)
+
+    print(", ".join("{} {}".format(name, count) for name, count in counts.items()))
+    for latency in (int(x) for x in args.latency.split(",")):
+        print("latency {}: {:.0f} cycles +/- {}%".format(latency, predict(model, counts, latency), model["error_percent"]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Static instruction fetch cost of a firmware image, without simulating it.
+#
+# tinyQV fetches instructions from flash over QSPI at a nibble every two
+# clocks, and every taken branch, jump, call or return restarts the read
+# with the address, mode bits and dummy cycles.  So the fetch cost of code
+# is roughly its size, plus a restart each time control flow jumps.
+#
+# The code is found by following control flow from the entry points (the
+# jumps at 0 and 4 at the start of the images, and any symbols given), so
+# data in the image isn't disassembled.  For each basic block and function
+# this reports the mix of 16 and 32-bit instructions, the bytes fetched per
+# instruction, the taken branch density, and the estimated fetch cycles to
+# run it once at each latency.  Conditional branches are assumed taken if
+# backward and not taken if forward.  A block that is the target of a jump
+# or branch, or follows a call, is assumed to be entered by a restart.
+#
+#   python fetch_cost.py hello.hex [--symbols hello.elf] [--blocks] [--listing]
+
+import argparse
+import sys
+
+from pc_profile import Symbols
+from qspi_memory import read_image
+
+LATENCIES = (1, 2, 3, 4, 5)
+ENTRY_POINTS = (0, 4)
+CYCLES_PER_BYTE = 4         # A nibble every two clocks
+RESTART_CYCLES = 26         # Deselect, select, then 6 address, 2 mode and 4 dummy nibbles
+
+# Kinds of instruction, by their effect on the flow of instruction fetch
+PLAIN, BRANCH, JUMP, CALL, RETURN, INDIRECT_CALL = "plain", "branch", "jump", "call", "return", "indirect_call"
+
+# Names of the compressed instructions by quadrant and funct3, for listings
+COMPRESSED_NAMES = (
+    ("c.addi4spn", "c.fld", "c.lw", "c.flw", "c.res", "c.fsd", "c.sw", "c.fsw"),
+    ("c.addi", "c.jal", "c.li", "c.lui", "c.alu", "c.j", "c.beqz", "c.bnez"),
+    ("c.slli", "c.fldsp", "c.lwsp", "c.flwsp", "c.jr/mv/add", "c.fsdsp", "c.swsp", "c.fswsp"),
+)
+
+def _sign(value, bits):
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+def _bit(word, pos, to):
+    return ((word >> pos) & 1) << to
+
+# Returns the length, kind and target address of the instruction at addr
+def decode(image, addr):
+    if addr + 2 > len(image):
+        return None
+    half = image[addr] | (image[addr + 1] << 8)
+    if half & 3 != 3:
+        quadrant, funct3 = half & 3, half >> 13
+        if quadrant == 1 and funct3 in (1, 5):
+            offset = (_bit(half, 12, 11) | _bit(half, 11, 4) | ((half >> 9) & 3) << 8 | _bit(half, 8, 10) |
+                      _bit(half, 7, 6) | _bit(half, 6, 7) | ((half >> 3) & 7) << 1 | _bit(half, 2, 5))
+            return 2, CALL if funct3 == 1 else JUMP, addr + _sign(offset, 12)
+        if quadrant == 1 and funct3 in (6, 7):
+            offset = (_bit(half, 12, 8) | ((half >> 10) & 3) << 3 | ((half >> 5) & 3) << 6 |
+                      ((half >> 3) & 3) << 1 | _bit(half, 2, 5))
+            return 2, BRANCH, addr + _sign(offset, 9)
+        if quadrant == 2 and funct3 == 4 and (half >> 7) & 0x1F and not (half >> 2) & 0x1F:
+            return 2, INDIRECT_CALL if half & 0x1000 else RETURN, None
+        return 2, PLAIN, None
+
+    if addr + 4 > len(image):
+        return None
+    word = half | (image[addr + 2] << 16) | (image[addr + 3] << 24)
+    opcode, rd = word & 0x7F, (word >> 7) & 0x1F
+    if opcode == 0x6F:
+        offset = (_bit(word, 31, 20) | ((word >> 21) & 0x3FF) << 1 | _bit(word, 20, 11) | ((word >> 12) & 0xFF) << 12)
+        return 4, CALL if rd else JUMP, addr + _sign(offset, 21)
+    if opcode == 0x63:
+        offset = (_bit(word, 31, 12) | ((word >> 25) & 0x3F) << 5 | ((word >> 8) & 0xF) << 1 | _bit(word, 7, 11))
+        return 4, BRANCH, addr + _sign(offset, 13)
+    if opcode == 0x67:
+        return 4, INDIRECT_CALL if rd else RETURN, None
+    return 4, PLAIN, None
+
+def mnemonic(image, addr):
+    half = image[addr] | (image[addr + 1] << 8)
+    if half & 3 != 3:
+        return COMPRESSED_NAMES[half & 3][half >> 13]
+    from riscvmodel.code import decode as rv_decode
+    try:
+        return str(rv_decode(int.from_bytes(image[addr:addr + 4], "little")))
+    except Exception:
+        return "unknown"
+
+# Follow control flow from the entry points.  Returns the instructions found,
+# address to (length, kind, target), and the block leaders, address to
+# whether the block is entered by a restart.
+def find_code(image, entries):
+    instrs = {}
+    leaders = {addr: True for addr in entries}
+    work = list(entries)
+    while work:
+        addr = work.pop()
+        while addr not in instrs:
+            instr = decode(image, addr)
+            if instr is None:
+                break
+            instrs[addr] = instr
+            length, kind, target = instr
+            if target is not None and 0 <= target < len(image):
+                leaders[target] = True
+                work.append(target)
+            if kind in (BRANCH, CALL, INDIRECT_CALL):
+                leaders.setdefault(addr + length, kind != BRANCH)
+            if kind in (JUMP, RETURN):
+                break
+            addr += length
+    return instrs, leaders
+
+class Block:
+    def __init__(self, start, restart):
+        self.start = start
+        self.restart = restart
+        self.instrs = []
+
+    @property
+    def compressed(self):
+        return sum(1 for _, (length, _, _) in self.instrs if length == 2)
+
+    @property
+    def size(self):
+        return sum(length for _, (length, _, _) in self.instrs)
+
+    # Taken jumps, calls and returns, and backward branches
+    @property
+    def taken(self):
+        addr, (_, kind, target) = self.instrs[-1]
+        if kind == BRANCH:
+            return 1 if target <= addr else 0
+        return 1 if kind != PLAIN else 0
+
+    def fetch_cycles(self, latency):
+        return self.size * CYCLES_PER_BYTE + (RESTART_CYCLES + latency if self.restart else 0)
+
+def find_blocks(image, entries):
+    instrs, leaders = find_code(image, entries)
+    blocks = []
+    block = None
+    for addr in sorted(instrs):
+        length, kind, _ = instrs[addr]
+        if block is None or addr in leaders or addr != block.start + block.size:
+            block = Block(addr, leaders.get(addr, True))
+            blocks.append(block)
+        block.instrs.append((addr, instrs[addr]))
+        if kind != PLAIN:
+            block = None
+    return blocks
+
+# Totals for a group of blocks
+def summary(blocks):
+    instrs = sum(len(b.instrs) for b in blocks)
+    size = sum(b.size for b in blocks)
+    result = {
+        "instrs": instrs,
+        "compressed_percent": round(100 * sum(b.compressed for b in blocks) / max(instrs, 1), 1),
+        "bytes_per_instr": round(size / max(instrs, 1), 2),
+        "taken_per_instr": round(sum(b.taken for b in blocks) / max(instrs, 1), 3),
+    }
+    for latency in LATENCIES:
+        result["cycles_l{}".format(latency)] = sum(b.fetch_cycles(latency) for b in blocks)
+    return result
+
+def by_function(blocks, symbols):
+    functions = {}
+    for block in blocks:
+        functions.setdefault(symbols.lookup(block.start), []).append(block)
+    return functions
+
+# Without symbols, name the entry points and call targets
+def call_symbols(blocks, entries):
+    targets = set(entries)
+    for block in blocks:
+        _, (_, kind, target) = block.instrs[-1]
+        if kind == CALL:
+            targets.add(target)
+    return Symbols((addr, 0, "sub_{:x}".format(addr)) for addr in targets)
+
+def format_table(rows, first):
+    columns = ["instrs", "compressed_percent", "bytes_per_instr", "taken_per_instr"] + \
+              ["cycles_l{}".format(l) for l in LATENCIES]
+    headings = ["instrs", "16-bit%", "B/instr", "taken/instr"] + ["L{} cycles".format(l) for l in LATENCIES]
+    lines = ["{:24} ".format(first) + " ".join("{:>10}".format(h) for h in headings)]
+    for name, row in rows:
+        lines.append("{:24} ".format(name[:24]) + " ".join("{:>10}".format(row[c]) for c in columns))
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate the instruction fetch cost of a firmware image")
+    parser.add_argument("image", help=".hex, ELF or binary image")
+    parser.add_argument("--symbols", help="ELF file or nm symbol listing, defaults to the image if it is an ELF file")
+    parser.add_argument("--entry", type=lambda x: int(x, 0), action="append", help="Entry point, may be repeated")
+    parser.add_argument("--blocks", action="store_true", help="Report each basic block")
+    parser.add_argument("--listing", action="store_true", help="List the instructions of each block")
+    args = parser.parse_args()
+
+    image = read_image(args.image)
+    symbols_path = args.symbols or (args.image if args.image.endswith(".elf") else None)
+    symbols = Symbols.load(symbols_path) if symbols_path else None
+    entries = set(args.entry or ENTRY_POINTS)
+    if symbols is not None:
+        entries |= {addr for addr in symbols.addrs if addr < len(image)}
+    blocks = find_blocks(image, sorted(entries))
+    if symbols is None:
+        symbols = call_symbols(blocks, entries)
+
+    functions = by_function(blocks, symbols)
+    rows = sorted(((name, summary(b)) for name, b in functions.items()),
+                  key=lambda row: -row[1]["cycles_l1"] / max(row[1]["instrs"], 1))
+    print(format_table(rows, "function"))
+    print()
+    print(format_table([("total", summary(blocks))], ""))
+
+    if args.blocks or args.listing:
+        for name, function_blocks in functions.items():
+            print()
+            print(format_table([("{:06x}{}".format(b.start, " *" if b.restart else ""), summary([b]))
+                                for b in function_blocks], name))
+            if args.listing:
+                for block in function_blocks:
+                    print()
+                    for addr, (length, kind, target) in block.instrs:
+                        code = int.from_bytes(image[addr:addr + length], "little")
+                        print("  {:06x}: {:>8x}  {}{}".format(addr, code, mnemonic(image, addr),
+                              "  -> {:x}".format(target) if target is not None else ""))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
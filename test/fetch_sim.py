@@ -0,0 +1,262 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# What-if simulator for instruction fetch front ends, replaying a stream of
+# instruction fetches and data accesses.
+#
+# tinyQV has no instruction cache: instructions are read from flash as they
+# are executed, every taken branch restarts the flash read, and so does every
+# data access, as it takes over the QSPI bus.  This replays the stream
+# through a hypothetical front end and counts the fetches it serves without
+# the flash, the bytes it reads from flash, and the restarts:
+#   none               - tinyQV as it is
+#   buffer:N           - keeps the last N bytes of the current sequential
+#                        flash read, so branches back or forward into them
+#                        are served from the buffer.  A fetch outside them
+#                        starts a new read, which empties the buffer.  As
+#                        reads are not speculative, the fetch after a data
+#                        access continues past the bytes read, so it still
+#                        restarts the flash read
+#   cache:SIZE:LINE:W  - SIZE byte I-cache of LINE byte lines, W way set
+#                        associative with LRU replacement, a miss reads the
+#                        whole line
+#   loop:N             - on a backward branch or jump of at most N bytes, the
+#                        loop body just fetched is kept, and fetches within it
+#                        are served from the buffer until the next loop
+# Reads are not speculative, bytes are only read when a fetch needs them.
+# A flash read carries on without a restart if the next read follows on from
+# the last one and there was no data access in between.  The fetch cycles
+# are CYCLES_PER_BYTE per byte read and RESTART_CYCLES plus the latency per
+# restart, as in fetch_cost.py, and the saving is against none.  Execution
+# is assumed to overlap with fetch, so the saving is an upper bound.
+#
+# The streams come from a kernel or image run on the reference model, or
+# from a trace recorded from the RTL by FetchRecorder: set FETCH_TRACE to a
+# directory for make bench to save one for each run, as
+# <kernel>_<latency>.npy.  The recorded fetches are the changes of
+# instr_addr, and the data accesses the starts of debug read or write.
+#
+#   python fetch_sim.py --kernel sieve --config cache:256:16:2 --config loop:64
+#   python fetch_sim.py fetch_traces/*.npy
+
+import argparse
+import sys
+
+import numpy as np
+
+import cocotb
+from cocotb.triggers import RisingEdge
+
+from fetch_cost import CYCLES_PER_BYTE, RESTART_CYCLES, LATENCIES
+from kernels import KERNELS, trace_on_model
+from qspi_memory import read_image
+from stall_monitor import BIT
+from tinyqv_model import TP_VALUE
+
+FETCH, DATA = 0, 1
+EVENT_DTYPE = np.dtype([("kind", "u1"), ("addr", "u4"), ("size", "u1")])
+CONFIGS = ("none", "buffer:8", "buffer:32", "buffer:64", "cache:128:8:1", "cache:256:16:1", "cache:256:16:2",
+           "cache:512:16:2", "loop:32", "loop:64")
+
+# Each front end returns the flash reads, as (start, length), needed to
+# serve a fetch, none if it is a hit.  prev_end is the end of the previous
+# fetch, None after a data access.
+class NoBuffer:
+    def fetch(self, addr, size, prev_end):
+        return [(addr, size)]
+
+class FetchBuffer:
+    def __init__(self, size):
+        self.size = size
+        self.start = self.end = 0
+
+    def fetch(self, addr, size, prev_end):
+        low = max(self.start, self.end - self.size)
+        if low <= addr and addr + size <= self.end:
+            return []
+        if low <= addr <= self.end:
+            read = (self.end, addr + size - self.end)
+        else:
+            read = (addr, size)
+            self.start = addr
+        self.end = addr + size
+        return [read]
+
+class ICache:
+    def __init__(self, size, line, ways):
+        self.line = line
+        self.ways = ways
+        self.sets = [[] for _ in range(max(size // (line * ways), 1))]
+
+    def fetch(self, addr, size, prev_end):
+        reads = []
+        for tag in range(addr // self.line, (addr + size - 1) // self.line + 1):
+            lines = self.sets[tag % len(self.sets)]
+            if tag in lines:
+                lines.remove(tag)
+            else:
+                reads.append((tag * self.line, self.line))
+                if len(lines) == self.ways:
+                    lines.pop(0)
+            lines.append(tag)
+        return reads
+
+class LoopBuffer:
+    def __init__(self, size):
+        self.size = size
+        self.body = None
+
+    def fetch(self, addr, size, prev_end):
+        if self.body is not None and self.body[0] <= addr and addr + size <= self.body[1]:
+            return []
+        if prev_end is not None and addr < prev_end and prev_end - addr <= self.size:
+            self.body = (addr, prev_end)
+            return []
+        return [(addr, size)]
+
+def front_end(config):
+    kind, *args = config.split(":")
+    args = [int(x, 0) for x in args]
+    return {"none": NoBuffer, "buffer": FetchBuffer, "cache": ICache, "loop": LoopBuffer}[kind](*args)
+
+# Replay events through a front end, returns the counts
+def replay(events, config):
+    frontend = front_end(config)
+    fetches = hits = restarts = flash_bytes = 0
+    stream = prev_end = None
+    for kind, addr, size in events.tolist():
+        if kind == DATA:
+            stream = prev_end = None
+            continue
+        fetches += 1
+        reads = frontend.fetch(addr, size, prev_end)
+        if not reads:
+            hits += 1
+        for start, length in reads:
+            if start != stream:
+                restarts += 1
+            flash_bytes += length
+            stream = start + length
+        prev_end = addr + size
+    return {"fetches": fetches, "hits": hits, "flash_bytes": flash_bytes, "restarts": restarts}
+
+def fetch_cycles(counts, latency):
+    return counts["flash_bytes"] * CYCLES_PER_BYTE + counts["restarts"] * (RESTART_CYCLES + latency)
+
+def simulate(events, configs):
+    baseline = replay(events, "none")
+    rows = []
+    for config in configs:
+        counts = baseline if config == "none" else replay(events, config)
+        row = {"config": config, "hit_percent": round(100 * counts["hits"] / max(counts["fetches"], 1), 1),
+               "flash_bytes": counts["flash_bytes"], "restarts": counts["restarts"]}
+        for latency in LATENCIES:
+            row["saved_l{}".format(latency)] = fetch_cycles(baseline, latency) - fetch_cycles(counts, latency)
+        rows.append(row)
+    return rows
+
+# Events of an image run on the reference model.  Peripheral accesses don't
+# use the QSPI bus, so aren't data accesses.
+def model_events(image, max_instrs=1000000):
+    trace, _ = trace_on_model(image, max_instrs)
+    events = []
+    for retired in trace:
+        events.append((FETCH, retired.pc, 4 if (retired.instr & 3) == 3 else 2))
+        if retired.access is not None and retired.access.addr < TP_VALUE:
+            events.append((DATA, retired.access.addr, retired.access.size))
+    return np.array(events, dtype=EVENT_DTYPE)
+
+# Records the fetch and data access stream of the RTL.  The size of each
+# fetch is the step to the next fetch address if that is sequential, and 4
+# otherwise.  Not available for gate level tests.
+class FetchRecorder:
+    def __init__(self, dut):
+        self.clk = dut.clk
+        self.rst_n = dut.rst_n
+        self.instr_addr = dut.user_project.i_tinyqv.instr_addr
+        self.debug_signals = dut.user_project.debug_signals
+        self.clear()
+        self.task = cocotb.start_soon(self._run())
+
+    @staticmethod
+    def available(dut):
+        return hasattr(dut.user_project, "debug_signals") and hasattr(dut.user_project, "i_tinyqv")
+
+    def stop(self):
+        self.task.kill()
+
+    def clear(self):
+        self.records = []
+
+    async def _run(self):
+        access_mask = (1 << BIT["read"]) | (1 << BIT["write"])
+        addr = None
+        accessing = False
+        while True:
+            await RisingEdge(self.clk)
+            value = self.instr_addr.value
+            debug = self.debug_signals.value
+            if self.rst_n.value.binstr != "1" or not value.is_resolvable or not debug.is_resolvable:
+                addr = None
+                continue
+            new_access = (debug.integer & access_mask) != 0
+            if new_access and not accessing:
+                self.records.append((DATA, 0))
+            accessing = new_access
+            if value.integer * 2 != addr:
+                addr = value.integer * 2
+                self.records.append((FETCH, addr))
+
+    def events(self):
+        events = np.zeros(len(self.records), dtype=EVENT_DTYPE)
+        if self.records:
+            events["kind"], events["addr"] = zip(*self.records)
+        fetch = np.flatnonzero(events["kind"] == FETCH)
+        step = np.diff(events["addr"][fetch].astype(np.int64), append=0)
+        events["size"][fetch] = np.where((step == 2) | (step == 4), step, 4)
+        return events
+
+    def save(self, path):
+        np.save(path, self.events())
+
+def format_table(rows):
+    columns = ["hit_percent", "flash_bytes", "restarts"] + ["saved_l{}".format(l) for l in LATENCIES]
+    headings = ["hit%", "bytes", "restarts"] + ["L{} saved".format(l) for l in LATENCIES]
+    lines = ["{:16} ".format("config") + " ".join("{:>10}".format(h) for h in headings)]
+    for row in rows:
+        lines.append("{:16} ".format(row["config"]) + " ".join("{:>10}".format(row[c]) for c in columns))
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate instruction fetch front ends for tinyQV")
+    parser.add_argument("inputs", nargs="*", help="Recorded .npy traces, or images to run on the reference model")
+    parser.add_argument("--kernel", choices=KERNELS, action="append", help="Kernel from kernels.py, may be repeated")
+    parser.add_argument("--config", action="append", help="Front end, e.g. cache:256:16:2, may be repeated")
+    parser.add_argument("--max-instrs", type=int, default=1000000)
+    args = parser.parse_args()
+
+    configs = ["none"] + [c for c in args.config or CONFIGS if c != "none"]
+    for config in configs:
+        try:
+            front_end(config)
+        except (KeyError, TypeError, ValueError):
+            parser.error("bad front end {}".format(config))
+
+    streams = [(name, lambda name=name: model_events(KERNELS[name]().assemble()))
+               for name in args.kernel or ([] if args.inputs else KERNELS)]
+    for path in args.inputs:
+        if path.endswith(".npy"):
+            streams.append((path, lambda path=path: np.load(path)))
+        else:
+            streams.append((path, lambda path=path: model_events(read_image(path), args.max_instrs)))
+
+    for name, load in streams:
+        events = load()
+        print("{}: {} fetches, {} data accesses".format(name, int((events["kind"] == FETCH).sum()),
+                                                       int((events["kind"] == DATA).sum())))
+        print(format_table(simulate(events, configs)))
+        print()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
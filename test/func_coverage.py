@@ -0,0 +1,170 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Functional coverage of the random instruction tests.
+#
+# Coverage is a set of coverpoints, each a dict of bin name to hit count.
+# The bins are defined up front from the ops table so that bins that are
+# never hit show up as holes:
+#   op     - each op
+#   rd, rs - destination and source registers
+#   imm    - immediate edge values of each op: 0, -1, min and max
+#   align  - the byte offset within a word of each memory access, per op
+#   dep    - back to back dependencies: the kind of the previous and current
+#            op (alu, load or store) and whether the current op reads (raw)
+#            or writes (waw) the register the previous op wrote
+#
+# Each run saves its database as JSON in COVERAGE_DIR, <test>_<seed>_<shard>.json.
+# Databases can be merged across shards and seeds:
+#   python func_coverage.py merge -o coverage.json <db>...
+#   python func_coverage.py report [--holes] <db>...
+
+import argparse
+import json
+import os
+
+# Where each run of a random test saves its coverage
+COVERAGE_DIR = os.environ.get("RANDOM_COVERAGE",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "random_coverage"))
+
+KINDS = ("alu", "load", "store")
+
+def imm_edges(lo, hi):
+    return sorted({v for v in (0, -1, lo, hi) if lo <= v <= hi})
+
+class Coverage:
+    def __init__(self, ops=()):
+        self.bins = {}
+        if not ops:
+            return
+        for op in ops:
+            self.define_op(op)
+        self.define("rd", ["x{}".format(r) for r in range(16)])
+        self.define("rs", ["x{}".format(r) for r in range(16)])
+        kinds = [kind for kind in KINDS if any(op.kind == kind for op in ops)]
+        for prev in kinds:
+            for kind in kinds:
+                if prev != "store":
+                    self.define("dep", ["{}->{} raw".format(prev, kind)])
+                    if kind != "store":
+                        self.define("dep", ["{}->{} waw".format(prev, kind)])
+
+    def define(self, point, names):
+        bins = self.bins.setdefault(point, {})
+        for name in names:
+            bins.setdefault(name, 0)
+
+    def hit(self, point, name):
+        bins = self.bins.setdefault(point, {})
+        bins[name] = bins.get(name, 0) + 1
+
+    def define_op(self, op):
+        self.define("op", [op.name])
+        imm_range = op.imm_range()
+        if imm_range is not None:
+            self.define("imm", ["{} {}".format(op.name, v) for v in imm_edges(*imm_range)])
+        if op.kind != "alu":
+            self.define("align", ["{} +{}".format(op.name, i) for i in range(4)])
+
+    # Record a random test item (see random_corpus.py) as it is run.  addr is
+    # the address accessed by a memory op, prev the item run immediately
+    # before it, or None if something else was run in between.
+    def sample(self, item, addr=None, prev=None):
+        if "op" not in item:
+            # Saved before coverage was recorded
+            return
+        op = item["op"]
+        self.hit("op", op)
+        if item["dest"] is not None:
+            self.hit("rd", "x{}".format(item["dest"]))
+        for r in item["srcs"]:
+            self.hit("rs", "x{}".format(r))
+
+        imm_bins = self.bins.get("imm", {})
+        if item["imm"] is not None and "{} {}".format(op, item["imm"]) in imm_bins:
+            self.hit("imm", "{} {}".format(op, item["imm"]))
+        if addr is not None:
+            self.hit("align", "{} +{}".format(op, addr & 3))
+
+        if prev is not None and prev.get("dest") not in (None, 0):
+            if prev["dest"] in item["srcs"]:
+                self.hit("dep", "{}->{} raw".format(prev["kind"], item["kind"]))
+            if prev["dest"] == item["dest"]:
+                self.hit("dep", "{}->{} waw".format(prev["kind"], item["kind"]))
+
+    def merge(self, other):
+        for point, bins in other.bins.items():
+            for name, count in bins.items():
+                self.bins.setdefault(point, {})
+                self.bins[point][name] = self.bins[point].get(name, 0) + count
+
+    def holes(self):
+        return [(point, name) for point, bins in self.bins.items() for name, count in bins.items() if count == 0]
+
+    # The immediates and access offsets within a word not yet hit for an op
+    def op_holes(self, op_name):
+        imms = []
+        offsets = []
+        for point, values in (("imm", imms), ("align", offsets)):
+            for name, count in self.bins.get(point, {}).items():
+                name_op, value = name.rsplit(" ", 1)
+                if count == 0 and name_op == op_name:
+                    values.append(int(value))
+        return imms, offsets
+
+    def percent(self):
+        total = sum(len(bins) for bins in self.bins.values())
+        hit = sum(1 for bins in self.bins.values() for count in bins.values() if count)
+        return 100 * hit / max(total, 1)
+
+    def report(self):
+        lines = []
+        total_hit = total = 0
+        for point, bins in self.bins.items():
+            hit = sum(1 for count in bins.values() if count)
+            lines.append("{:6} {:5}/{:<5} {:6.1f}%".format(point, hit, len(bins), 100 * hit / max(len(bins), 1)))
+            total_hit += hit
+            total += len(bins)
+        lines.append("{:6} {:5}/{:<5} {:6.1f}%".format("total", total_hit, total, 100 * total_hit / max(total, 1)))
+        return "\n".join(lines)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"bins": self.bins}, f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        coverage = cls()
+        with open(path) as f:
+            coverage.bins = json.load(f)["bins"]
+        return coverage
+
+def merge_files(paths):
+    coverage = Coverage()
+    for path in paths:
+        coverage.merge(Coverage.load(path))
+    return coverage
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge and report random test coverage databases")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    merge = subparsers.add_parser("merge")
+    merge.add_argument("-o", "--output", required=True)
+    merge.add_argument("dbs", nargs="+")
+    report = subparsers.add_parser("report")
+    report.add_argument("--holes", action="store_true", help="List the bins never hit")
+    report.add_argument("dbs", nargs="+")
+    args = parser.parse_args()
+
+    coverage = merge_files(args.dbs)
+    if args.command == "merge":
+        coverage.save(args.output)
+    else:
+        print(coverage.report())
+        if args.holes:
+            for point, name in coverage.holes():
+                print("{}: {}".format(point, name))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Small CPU bound benchmark kernels for tinyQV, assembled here into flash
+# images so no toolchain is needed.  Each kernel leaves a result in a0 and
+# finishes by sending its low byte on the debug UART, then spins.
+#
+# run_on_model executes a kernel on the reference model, giving the result
+# byte and the number of instructions retired up to and including the
+# debug UART write.
+
+from riscvmodel.insn import *
+from riscvmodel.regnames import x0, ra, sp, tp, t0, t1, t2, s0, s1, a0, a1, a2, a3, a4, a5
+
+from qspi_memory import SparseMemory
+from tinyqv_model import TinyQVModel, TP_VALUE
+
+RAM_A = 0x1000000
+RAM_B = 0x1800000
+UART = 0x10
+DEBUG_UART = 0x18
+UART_TX_INTERRUPT = 19
+
+# A minimal assembler: instructions are added by calling the program with the
+# riscvmodel instruction class and its arguments.  Branch and jump targets
+# can be given as label names.  All instructions are 32-bit.
+class Program:
+    def __init__(self):
+        self.instrs = []
+        self.labels = {}
+
+    def __call__(self, insn, *args):
+        self.instrs.append((insn, args))
+
+    def label(self, name):
+        self.labels[name] = 4 * len(self.instrs)
+
+    def li(self, rd, value):
+        upper = (value + 0x800) >> 12
+        if upper & 0xFFFFF:
+            self(InstructionLUI, rd, upper & 0xFFFFF)
+            self(InstructionADDI, rd, rd, ((value + 0x800) & 0xFFF) - 0x800)
+        else:
+            self(InstructionADDI, rd, x0, ((value + 0x800) & 0xFFF) - 0x800)
+
+    def finish(self):
+        self(InstructionSW, tp, a0, DEBUG_UART)
+        self.label("_spin")
+        self(InstructionJAL, x0, "_spin")
+
+    def assemble(self):
+        image = bytearray()
+        for i, (insn, args) in enumerate(self.instrs):
+            args = [self.labels[a] - 4 * i if isinstance(a, str) else a for a in args]
+            image += insn(*args).encode().to_bytes(4, "little")
+        return bytes(image)
+
+# Arithmetic in a counted loop
+def int_loop(n=200):
+    p = Program()
+    p.li(a0, 0)
+    p.li(a1, n)
+    p.li(a2, 0x1234)
+    p.label("loop")
+    p(InstructionADD, a0, a0, a2)
+    p(InstructionSLLI, t0, a0, 3)
+    p(InstructionXOR, a0, a0, t0)
+    p(InstructionSRLI, t1, a0, 5)
+    p(InstructionSUB, a0, a0, t1)
+    p(InstructionADDI, a2, a2, 7)
+    p(InstructionADDI, a1, a1, -1)
+    p(InstructionBNE, a1, x0, "loop")
+    p.finish()
+    return p
+
+# Fill a buffer in RAM A, copy it word by word to dst, then sum the copy
+def memcpy(dst, n_words=64):
+    p = Program()
+    p.li(a1, RAM_A)
+    p.li(a2, n_words)
+    p.li(a3, 0x9E3779B9)
+    p.label("fill")
+    p(InstructionSW, a1, a3, 0)
+    p(InstructionADD, a3, a3, a3)
+    p(InstructionXORI, a3, a3, 0x5A5)
+    p(InstructionADDI, a1, a1, 4)
+    p(InstructionADDI, a2, a2, -1)
+    p(InstructionBNE, a2, x0, "fill")
+
+    p.li(a1, RAM_A)
+    p.li(a4, dst)
+    p.li(a2, n_words)
+    p.label("copy")
+    p(InstructionLW, t0, a1, 0)
+    p(InstructionSW, a4, t0, 0)
+    p(InstructionADDI, a1, a1, 4)
+    p(InstructionADDI, a4, a4, 4)
+    p(InstructionADDI, a2, a2, -1)
+    p(InstructionBNE, a2, x0, "copy")
+
+    p.li(a0, 0)
+    p.li(a4, dst)
+    p.li(a2, n_words)
+    p.label("sum")
+    p(InstructionLW, t0, a4, 0)
+    p(InstructionADD, a0, a0, t0)
+    p(InstructionADDI, a4, a4, 4)
+    p(InstructionADDI, a2, a2, -1)
+    p(InstructionBNE, a2, x0, "sum")
+    p(InstructionSRLI, t0, a0, 16)
+    p(InstructionXOR, a0, a0, t0)
+    p(InstructionSRLI, t0, a0, 8)
+    p(InstructionXOR, a0, a0, t0)
+    p.finish()
+    return p
+
+# Data dependent branches on the bits of an LFSR
+def branchy(n=200):
+    p = Program()
+    p.li(a0, 0)
+    p.li(a1, n)
+    p.li(a2, 0xACE1)
+    p.label("loop")
+    p(InstructionANDI, t0, a2, 1)
+    p(InstructionSRLI, a2, a2, 1)
+    p(InstructionBEQ, t0, x0, "no_tap")
+    p.li(t1, 0xB400)
+    p(InstructionXOR, a2, a2, t1)
+    p.label("no_tap")
+    p(InstructionANDI, t0, a2, 6)
+    p(InstructionBEQ, t0, x0, "zero")
+    p(InstructionANDI, t1, a2, 2)
+    p(InstructionBNE, t1, x0, "odd")
+    p(InstructionADDI, a0, a0, 3)
+    p(InstructionJAL, x0, "next")
+    p.label("odd")
+    p(InstructionXORI, a0, a0, 0x55)
+    p(InstructionJAL, x0, "next")
+    p.label("zero")
+    p(InstructionSLLI, a0, a0, 1)
+    p.label("next")
+    p(InstructionADDI, a1, a1, -1)
+    p(InstructionBNE, a1, x0, "loop")
+    p.finish()
+    return p
+
+# Sieve of Eratosthenes over a byte array in RAM A, counting the primes
+def sieve(n=256):
+    p = Program()
+    p.li(s0, RAM_A)
+    p.li(s1, n)
+    p(InstructionADDI, a1, x0, 0)
+    p(InstructionADDI, t2, x0, 1)
+    p.label("clear")
+    p(InstructionADD, t0, s0, a1)
+    p(InstructionSB, t0, t2, 0)
+    p(InstructionADDI, a1, a1, 1)
+    p(InstructionBLT, a1, s1, "clear")
+
+    p(InstructionADDI, a0, x0, 0)
+    p(InstructionADDI, a1, x0, 2)
+    p.label("outer")
+    p(InstructionADD, t0, s0, a1)
+    p(InstructionLBU, t1, t0, 0)
+    p(InstructionBEQ, t1, x0, "next")
+    p(InstructionADDI, a0, a0, 1)
+    p(InstructionADD, a2, a1, a1)
+    p.label("inner")
+    p(InstructionBGE, a2, s1, "next")
+    p(InstructionADD, t0, s0, a2)
+    p(InstructionSB, t0, x0, 0)
+    p(InstructionADD, a2, a2, a1)
+    p(InstructionJAL, x0, "inner")
+    p.label("next")
+    p(InstructionADDI, a1, a1, 1)
+    p(InstructionBLT, a1, s1, "outer")
+    p.finish()
+    return p
+
+KERNELS = {
+    "int_loop": int_loop,
+    "memcpy_ram_a": lambda: memcpy(RAM_A + 0x400),
+    "memcpy_ram_b": lambda: memcpy(RAM_B),
+    "branchy": branchy,
+    "sieve": sieve,
+}
+
+# Runs an image on the model until it writes to the debug UART, or for
+# max_instrs instructions.  Returns the instructions retired, as Retired
+# tuples, and the byte written or None.  Firmware that finishes by spinning
+# (j .) with no interrupt left to take stops there, and the bytes it sends
+# on the UART are appended to uart if given.  The UART is never busy, so its
+# transmit interrupt is always pending.
+def trace_on_model(image, max_instrs=1000000, uart=None):
+    memory = SparseMemory()
+    memory.flash = image
+    model = TinyQVModel()
+    model.set_pending(UART_TX_INTERRUPT)
+    trace = []
+    for _ in range(max_instrs):
+        model.take_interrupt()
+        instr = memory.read_int(model.pc, 4)
+        retired = model.execute(instr, memory.read_int)
+        trace.append(retired)
+        access = retired.access
+        if access is not None and access.store:
+            if access.addr == TP_VALUE + DEBUG_UART:
+                return trace, access.value & 0xFF
+            if access.addr == TP_VALUE + UART and uart is not None:
+                uart.append(access.value & 0xFF)
+            memory.write_int(access.addr, access.size, access.value)
+        if model.pc == retired.pc and retired.name in ("jal", "c.j") and not model.take_interrupt():
+            break
+    return trace, None
+
+# Returns the result byte and the number of instructions retired
+def run_on_model(image, max_instrs=1000000):
+    trace, result = trace_on_model(image, max_instrs)
+    if result is None:
+        raise ValueError("Kernel didn't finish in {} instructions".format(max_instrs))
+    return result, len(trace)
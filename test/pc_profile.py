@@ -0,0 +1,171 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Program counter profiler for firmware running on tb_qspi.
+#
+# Every clock cycle is attributed to the program counter, read from the
+# core's pc if it is visible, otherwise from the fetch address instr_addr.
+# With retired=True only cycles in which an instruction completes are
+# counted instead, weighted by the cycles since the previous instruction
+# completed if weighted=True, so stalls are charged to the instruction that
+# was waiting.
+#
+# Given symbols from an ELF file (needs pyelftools) or a symbol map in nm
+# format, cycles are also attributed to functions.  Calls and returns are
+# followed from the debug signals: a taken jump followed by a register write
+# of its return address, the address after one of the last few instructions,
+# is a call, and debug_ret a return.  debug_rd carries the data written a
+# nibble per cycle, not the register index, so the written value is what
+# identifies a call.  This gives call stacks for a collapsed stack file, the
+# input format of flamegraph.pl and speedscope.
+
+import bisect
+from collections import deque
+
+import cocotb
+from cocotb.triggers import RisingEdge
+
+MAX_DEPTH = 64
+# Distinct PCs kept to match return addresses against
+RECENT_PCS = 4
+
+class Symbols:
+    def __init__(self, symbols=()):
+        symbols = sorted(symbols)
+        self.addrs = [addr for addr, _, _ in symbols]
+        self.symbols = symbols
+
+    @classmethod
+    def from_nm(cls, path):
+        symbols = []
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3 and fields[1] in "tTwW":
+                    symbols.append((int(fields[0], 16), 0, fields[2]))
+        return cls(symbols)
+
+    @classmethod
+    def from_elf(cls, path):
+        from elftools.elf.elffile import ELFFile
+        symbols = []
+        with open(path, "rb") as f:
+            for section in ELFFile(f).iter_sections():
+                if section.header.sh_type != "SHT_SYMTAB":
+                    continue
+                for sym in section.iter_symbols():
+                    if sym["st_info"]["type"] == "STT_FUNC":
+                        symbols.append((sym["st_value"], sym["st_size"], sym.name))
+        return cls(symbols)
+
+    @classmethod
+    def load(cls, path):
+        return cls.from_elf(path) if path.endswith(".elf") else cls.from_nm(path)
+
+    def lookup(self, addr):
+        i = bisect.bisect_right(self.addrs, addr) - 1
+        if i < 0:
+            return "0x{:x}".format(addr)
+        start, size, name = self.symbols[i]
+        if size and addr >= start + size:
+            return "0x{:x}".format(addr)
+        return name
+
+class PcProfiler:
+    def __init__(self, dut, symbols=None, retired=False, weighted=True):
+        core = dut.user_project.i_tinyqv
+        self.clk = dut.clk
+        self.rst_n = dut.rst_n
+        self.pc = core.i_core.pc if hasattr(core, "i_core") and hasattr(core.i_core, "pc") else core.instr_addr
+        self.debug = dut.user_project
+        self.symbols = symbols or Symbols()
+        self.retired = retired
+        self.weighted = weighted
+        self.clear()
+        self.task = cocotb.start_soon(self._run())
+
+    def stop(self):
+        self.task.kill()
+
+    def clear(self):
+        self.by_addr = {}
+        self.by_stack = {}
+        self.stack = []
+        self.cycles = 0
+
+    def _charge(self, pc, cycles):
+        self.by_addr[pc] = self.by_addr.get(pc, 0) + cycles
+        stack = ";".join(self.stack + [self.symbols.lookup(pc)])
+        self.by_stack[stack] = self.by_stack.get(stack, 0) + cycles
+
+    async def _run(self):
+        debug = self.debug
+        since_retire = 0
+        jumped = False
+        recent = deque(maxlen=RECENT_PCS)
+        value = 0
+        count = 0
+        ret = False
+        while True:
+            await RisingEdge(self.clk)
+            if self.rst_n.value.binstr != "1" or not self.pc.value.is_resolvable:
+                continue
+            pc = self.pc.value.integer * 2
+            self.cycles += 1
+            since_retire += 1
+            complete = debug.debug_instr_complete.value.binstr == "1"
+
+            if not self.retired:
+                self._charge(pc, 1)
+            elif complete:
+                self._charge(pc, since_retire if self.weighted else 1)
+
+            # Follow calls and returns for the call stacks
+            if not recent or recent[-1] != pc:
+                recent.append(pc)
+            jumped |= debug.debug_branch.value.binstr == "1" or debug.debug_early_branch.value.binstr == "1"
+            if debug.debug_reg_wen.value.binstr == "1" and debug.debug_rd.value.is_resolvable:
+                value |= debug.debug_rd.value.integer << (4 * count)
+                count += 1
+                if count == 8:
+                    caller = next((a for a in recent if value - a in (2, 4)), None)
+                    if jumped and caller is not None and len(self.stack) < MAX_DEPTH:
+                        self.stack.append(self.symbols.lookup(caller))
+                    jumped = False
+                    value = count = 0
+            else:
+                value = count = 0
+            new_ret = debug.debug_ret.value.binstr == "1"
+            if new_ret and not ret and self.stack:
+                self.stack.pop()
+            ret = new_ret
+
+            if complete:
+                since_retire = 0
+
+    def by_function(self):
+        functions = {}
+        for pc, cycles in self.by_addr.items():
+            name = self.symbols.lookup(pc)
+            functions[name] = functions.get(name, 0) + cycles
+        return functions
+
+    def flat_profile(self, limit=None):
+        total = max(sum(self.by_addr.values()), 1)
+        lines = ["{:>10} {:>7}  {}".format("cycles", "%", "function")]
+        for name, cycles in sorted(self.by_function().items(), key=lambda x: -x[1])[:limit]:
+            lines.append("{:10} {:6.2f}%  {}".format(cycles, 100 * cycles / total, name))
+        lines.append("")
+        lines.append("{:>10} {:>7}  {}".format("cycles", "%", "address"))
+        for pc, cycles in sorted(self.by_addr.items(), key=lambda x: -x[1])[:limit]:
+            lines.append("{:10} {:6.2f}%  {:06x} {}".format(cycles, 100 * cycles / total, pc, self.symbols.lookup(pc)))
+        return "\n".join(lines)
+
+    def write_flat(self, path):
+        with open(path, "w") as f:
+            f.write(self.flat_profile() + "\n")
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            for stack, cycles in sorted(self.by_stack.items()):
+                f.write("{} {}\n".format(stack, cycles))
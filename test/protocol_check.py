@@ -0,0 +1,232 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Offline QSPI protocol checker for waveform dumps of tb or tb_qspi.
+#
+# uio_out, uio_oe and rst_n are loaded from the VCD or FST dump (FST is
+# converted with fst2vcd from GTKWave) and sampled at every falling edge of
+# clk, as the inline checks in test.py do.  The whole run is then checked
+# in vectorised passes:
+#   reset      - uio_oe is 0 in reset
+#   outputs    - the selects and the QSPI clock are outputs out of reset
+#   select     - at most one select is low at a time
+#   start      - a transaction starts with the QSPI clock low and the data
+#                pins driven
+#   clock      - the QSPI clock is never high for two cycles in a row, and
+#                toggles every cycle until the data phase
+#   command    - RAM commands are 0x0B read or 0x02 write
+#   mode       - flash reads send mode bits 0xA after the address
+#   direction  - data pins are driven for the command, address and mode and
+#                for write data, and released for dummy cycles and read data
+#
+#   python protocol_check.py sim_build/cache/<hash>/tb.fst
+# prints the failures of each check and exits with an error if there are any.
+
+import argparse
+import re
+import subprocess
+import sys
+
+import numpy as np
+
+FLASH, RAM_A, RAM_B = 0, 1, 2
+SELECT_BITS = (0, 6, 7)
+CLK_BIT = 3
+CONTROL_OE = 0b11001001
+RAM_READ = 0x0B
+RAM_WRITE = 0x02
+SIGNALS = ("clk", "rst_n", "uio_out", "uio_oe")
+TIMESCALE_NS = {"s": 1e9, "ms": 1e6, "us": 1e3, "ns": 1, "ps": 1e-3, "fs": 1e-6}
+
+# Lines of the dump, converting FST to VCD on the fly
+def dump_lines(path):
+    if not path.endswith(".fst"):
+        with open(path) as f:
+            yield from f
+        return
+    try:
+        proc = subprocess.Popen(["fst2vcd", path], stdout=subprocess.PIPE, text=True)
+    except FileNotFoundError:
+        raise RuntimeError("fst2vcd (from GTKWave) is needed to read FST dumps")
+    with proc:
+        yield from proc.stdout
+    if proc.returncode:
+        raise RuntimeError("fst2vcd failed on {}".format(path))
+
+# Parse the value changes of the top level signals from a VCD.  The top level
+# is the shallowest scope containing all of SIGNALS, so it works for tb and
+# tb_qspi, and for Verilator's extra TOP scope.  Returns the time step in ns
+# and for each signal the change times and values, with -1 for X or Z.
+def load_vcd(lines):
+    scope = []
+    found = {}
+    timescale = ""
+    in_timescale = False
+    lines = iter(lines)
+    for line in lines:
+        tokens = line.split()
+        if not tokens:
+            continue
+        if in_timescale or tokens[0] == "$timescale":
+            timescale += " ".join(t for t in tokens if t not in ("$timescale", "$end"))
+            in_timescale = "$end" not in tokens
+        elif tokens[0] == "$scope":
+            scope.append(tokens[2])
+        elif tokens[0] == "$upscope":
+            scope.pop()
+        elif tokens[0] == "$var":
+            name = tokens[4]
+            if name in SIGNALS and (name not in found or len(scope) < len(found[name][1])):
+                found[name] = (tokens[3], list(scope))
+        elif tokens[0] == "$enddefinitions":
+            break
+
+    missing = [name for name in SIGNALS if name not in found]
+    if missing:
+        raise ValueError("Signals not in dump: " + ", ".join(missing))
+    match = re.fullmatch(r"\s*(\d+)\s*([munpf]?s)\s*", timescale)
+    step_ns = int(match.group(1)) * TIMESCALE_NS[match.group(2)] if match else 1
+
+    ids = {found[name][0]: name for name in SIGNALS}
+    times = {name: [] for name in SIGNALS}
+    values = {name: [] for name in SIGNALS}
+    now = 0
+    for line in lines:
+        c = line[:1]
+        if c == "#":
+            now = int(line[1:])
+            continue
+        if c in "bB":
+            value, ident = line[1:].split()
+            value = int(value, 2) if value.isdigit() else -1
+        elif c in "01xXzZ":
+            ident = line[1:].strip()
+            value = int(c) if c in "01" else -1
+        else:
+            continue
+        name = ids.get(ident)
+        if name is not None:
+            times[name].append(now)
+            values[name].append(value)
+
+    return step_ns, {name: (np.array(times[name], dtype=np.int64), np.array(values[name], dtype=np.int64))
+                     for name in SIGNALS}
+
+def load(path):
+    return load_vcd(dump_lines(path))
+
+# Sample every signal just before each falling edge of clk, when the values
+# set by the rising edge have settled.  Returns the sample times and values.
+def sample(changes):
+    clk_times, clk_values = changes["clk"]
+    falling = np.flatnonzero((clk_values[1:] == 0) & (clk_values[:-1] == 1)) + 1
+    sample_times = clk_times[falling]
+    samples = {}
+    for name, (times, values) in changes.items():
+        i = np.searchsorted(times, sample_times, side="left") - 1
+        samples[name] = np.where(i >= 0, values[np.maximum(i, 0)], -1)
+    return sample_times, samples
+
+def qspi_nibble(uio):
+    return (((uio >> 4) & 3) << 2) | ((uio >> 1) & 3)
+
+# Run all the checks on the sampled signals.  Returns a dict of check name to
+# the sample indices that failed it.
+def check(samples):
+    rst_n, out, oe = samples["rst_n"], samples["uio_out"], samples["uio_oe"]
+    prev = lambda a, fill: np.concatenate(([fill], a[:-1]))
+    failures = {}
+
+    # Skip the first cycle of reset, while it propagates
+    in_reset = (rst_n == 0) & (prev(rst_n, 0) == 0)
+    failures["reset"] = np.flatnonzero(in_reset & (oe != 0))
+
+    running = (rst_n == 1) & (prev(rst_n, 0) == 1) & (out >= 0) & (oe >= 0)
+    failures["outputs"] = np.flatnonzero(running & ((oe & CONTROL_OE) != CONTROL_OE))
+
+    low = np.stack([((out >> bit) & 1) == 0 for bit in SELECT_BITS]) & running
+    failures["select"] = np.flatnonzero(low.sum(axis=0) > 1)
+    device = np.where(low.sum(axis=0) == 1, low.argmax(axis=0), -1)
+
+    # Number the transactions, and count the QSPI clocks in each.  k is the
+    # index of each clock high cycle within its transaction.
+    start = (device >= 0) & (device != prev(device, -1))
+    start_idx = np.flatnonzero(start)
+    n_txn = len(start_idx)
+    if n_txn == 0:
+        return failures
+    txn = np.maximum(np.cumsum(start) - 1, 0)
+    active = device >= 0
+    high = active & (((out >> CLK_BIT) & 1) == 1)
+    clocks = np.cumsum(high) - high
+    k = clocks - clocks[start_idx][txn]
+    nibble = qspi_nibble(out)
+    data_oe = qspi_nibble(oe)
+
+    failures["start"] = np.flatnonzero(start & (high | (data_oe != 0xF)))
+
+    # Command and type of each transaction
+    txn_device = device[start_idx]
+    command = np.zeros(n_txn, dtype=np.int64)
+    for i, shift in ((0, 4), (1, 0)):
+        at = high & (k == i)
+        command[txn[at]] |= nibble[at] << shift
+    is_ram = txn_device != FLASH
+    command_sent = np.zeros(n_txn, dtype=bool)
+    command_sent[txn[high & (k == 1)]] = True
+    bad_command = is_ram & command_sent & (command != RAM_READ) & (command != RAM_WRITE)
+    failures["command"] = start_idx[bad_command]
+    is_write = is_ram & (command == RAM_WRITE)
+
+    # Header: 6 address nibbles, then 2 mode nibbles and 4 dummy for flash,
+    # 2 command and 6 address nibbles and 4 dummy for a RAM read, or 2
+    # command and 6 address nibbles for a RAM write.  Pins are driven for
+    # the first 8 nibbles, and for write data.
+    header = np.where(is_write, 8, 12)[txn]
+    driven = (k < 8) | is_write[txn]
+    failures["direction"] = np.flatnonzero(high & (data_oe != np.where(driven, 0xF, 0)))
+
+    is_flash = active & (device == FLASH)
+    failures["mode"] = np.flatnonzero(high & is_flash & ((k == 6) | (k == 7)) & (nibble != 0xA))
+
+    # Clock high cycles follow the start, and each other in the header, by
+    # exactly two cycles, and are never back to back
+    high_idx = np.flatnonzero(high)
+    gap = np.diff(np.concatenate(([-1], high_idx)))
+    first_gap = high_idx - start_idx[txn[high_idx]]
+    in_header = k[high_idx] < header[high_idx]
+    bad_gap = np.where(k[high_idx] == 0, first_gap != 1, in_header & (gap != 2))
+    back_to_back = (gap == 1) & (k[high_idx] > 0)
+    failures["clock"] = high_idx[bad_gap | back_to_back]
+    return failures
+
+def check_dump(path):
+    step_ns, changes = load(path)
+    times, samples = sample(changes)
+    return times * step_ns, check(samples)
+
+def format_failures(times_ns, failures, limit=10):
+    lines = []
+    for name, indices in failures.items():
+        if len(indices):
+            shown = ", ".join("{:.0f} ns".format(times_ns[i]) for i in indices[:limit])
+            lines.append("{}: {} failures, at {}{}".format(name, len(indices), shown,
+                                                          ", ..." if len(indices) > limit else ""))
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the QSPI protocol in a waveform dump")
+    parser.add_argument("dumps", nargs="+", help="VCD or FST files")
+    parser.add_argument("--limit", type=int, default=10, help="Failure times to print for each check")
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.dumps:
+        times_ns, failures = check_dump(path)
+        report = format_failures(times_ns, failures, args.limit)
+        print("{}: {} cycles, {}".format(path, len(times_ns), "FAILED\n" + report if report else "ok"))
+        failed |= bool(report)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,397 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Python model of the QSPI PMOD's flash and PSRAMs for the tb testbench.
+#
+# Addresses are as seen by tinyQV: flash from 0, RAM A from 0x1000000 and
+# RAM B from 0x1800000.
+
+import mmap
+import os
+import struct
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+import cocotb
+from cocotb.triggers import FallingEdge, First, RisingEdge, Timer
+
+from bus import QspiBus, FLASH
+
+RAM_BASE = 0x1000000
+RAM_SIZE = 0x800000
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS
+
+# Contents of RAM that has never been written, pseudo-random so that loads
+# from it return varied data, but fixed so they can be predicted.
+def background_byte(addr):
+    return ((addr * 0x9E3779B1) >> 16) & 0xFF
+
+# Bytes of a $readmemh or $writememh format file, unknown bytes read as 0
+def read_hex(path):
+    data = bytearray()
+    with open(path) as f:
+        for line in f:
+            for token in line.split("//")[0].split():
+                if token.startswith("@"):
+                    addr = int(token[1:], 16)
+                    if addr > len(data):
+                        data.extend(b"\xff" * (addr - len(data)))
+                    del data[addr:]
+                elif token.strip("0123456789abcdefABCDEF_"):
+                    data.append(0)
+                else:
+                    data.append(int(token, 16))
+    return bytes(data)
+
+# Flash contents of the loadable segments of a 32-bit little endian ELF
+# file, by physical address.  Segments in RAM are left to the startup code.
+def read_elf(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != b"\x7fELF" or data[4] != 1 or data[5] != 1:
+        raise ValueError("{} is not a 32-bit little endian ELF file".format(path))
+    phoff, = struct.unpack_from("<I", data, 28)
+    phentsize, phnum = struct.unpack_from("<HH", data, 42)
+    image = bytearray()
+    for i in range(phnum):
+        p_type, p_offset, _, p_paddr, p_filesz = struct.unpack_from("<5I", data, phoff + i * phentsize)
+        if p_type != 1 or p_filesz == 0 or p_paddr >= RAM_BASE:
+            continue
+        end = p_paddr + p_filesz
+        if end > len(image):
+            image.extend(b"\xff" * (end - len(image)))
+        image[p_paddr:end] = data[p_offset:p_offset + p_filesz]
+    return bytes(image)
+
+# Flash image from a $readmemh format .hex file, an ELF file, or a raw binary
+# file.  Binary files are memory mapped, so loading them takes the same time
+# whatever their size.
+def read_image(path):
+    if path.endswith(".hex"):
+        return read_hex(path)
+    elif path.endswith(".elf"):
+        return read_elf(path)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+# RAM is held in 4 KiB pages, allocated when first written.  The flash is
+# read only, loaded by read_image.
+class SparseMemory:
+    def __init__(self, flash=None):
+        self.pages = {}
+        self.flash = b""
+        if flash is not None:
+            self.load_flash(flash)
+
+    def load_flash(self, path):
+        self.flash = read_image(path)
+
+    def clear(self):
+        self.pages.clear()
+
+    def read_byte(self, addr):
+        if addr < RAM_BASE:
+            return self.flash[addr] if addr < len(self.flash) else 0xFF
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None:
+            return background_byte(addr)
+        return page[addr & (PAGE_SIZE - 1)]
+
+    def write_byte(self, addr, value):
+        if addr < RAM_BASE:
+            raise ValueError("Write to flash at {:x}".format(addr))
+        page = self.pages.get(addr >> PAGE_BITS)
+        if page is None:
+            base = addr & ~(PAGE_SIZE - 1)
+            page = bytearray(background_byte(base + i) for i in range(PAGE_SIZE))
+            self.pages[addr >> PAGE_BITS] = page
+        page[addr & (PAGE_SIZE - 1)] = value
+
+    def read(self, addr, length):
+        return bytes(self.read_byte(addr + i) for i in range(length))
+
+    def write(self, addr, data):
+        for i, b in enumerate(data):
+            self.write_byte(addr + i, b)
+
+    def read_int(self, addr, size):
+        return int.from_bytes(self.read(addr, size), "little")
+
+    def write_int(self, addr, size, value):
+        self.write(addr, (value & ((1 << (8 * size)) - 1)).to_bytes(size, "little"))
+
+    # Contents of size bytes of RAM from addr, including the pages never
+    # written
+    def ram_image(self, addr, size):
+        data = ((np.arange(addr, addr + size, dtype=np.uint64) * 0x9E3779B1) >> 16).astype(np.uint8)
+        for page_num, page in self.pages.items():
+            offset = (page_num << PAGE_BITS) - addr
+            if 0 <= offset < size:
+                data[offset:offset + PAGE_SIZE] = np.frombuffer(page, dtype=np.uint8)
+        return data.tobytes()
+
+    # Write RAM A followed by RAM B to a binary file
+    def save_ram(self, path):
+        with open(path, "wb") as f:
+            f.write(self.ram_image(RAM_BASE, RAM_SIZE))
+            f.write(self.ram_image(RAM_BASE + RAM_SIZE, RAM_SIZE))
+
+    # Address of the first byte of RAM that differs from other, or None
+    def compare(self, other):
+        for page_num in sorted(set(self.pages) | set(other.pages)):
+            base = page_num << PAGE_BITS
+            a = self.read(base, PAGE_SIZE)
+            b = other.read(base, PAGE_SIZE)
+            if a != b:
+                return base + next(i for i in range(PAGE_SIZE) if a[i] != b[i])
+        return None
+
+# A completed QSPI transaction, data is the bytes read or written
+QspiTransaction = namedtuple("QspiTransaction", "write addr data")
+
+# Serves the QSPI flash and RAM transactions on tb from a SparseMemory.
+# Data is driven on the falling edge of clk while the QSPI clock is low, as
+# send_instr in test.py does, on qspi_data_in or the data_in handle given.
+# While the testbench's instruction injector is enabled it serves the
+# flash, and flash transactions are skipped by waiting for the select to
+# rise, so Python doesn't wake on every clock of a fetch.  RAM transactions
+# are logged in ram_transactions, protocol errors are recorded in error.
+class QspiResponder:
+    def __init__(self, dut, memory, data_in=None):
+        self.dut = dut
+        self.memory = memory
+        self.data_in = data_in
+        self.inject_en = getattr(dut, "inject_en", None)
+        self.ram_transactions = []
+        self.error = None
+        self.task = cocotb.start_soon(self._run())
+
+    def stop(self):
+        self.task.kill()
+
+    def check(self):
+        assert self.error is None, self.error
+
+    def _error(self, msg):
+        if self.error is None:
+            self.error = msg
+            self.dut._log.error(msg)
+
+    async def _run(self):
+        qspi = QspiBus.of(self.dut)
+        any_select = First(*(FallingEdge(s) for s in qspi.selects))
+        while True:
+            state = qspi.sample(oe=False)
+            low = [i for i in range(3) if state.select(i) == 0]
+            if not low or qspi.in_reset():
+                await any_select
+                continue
+            if len(low) != 1:
+                self._error("More than one QSPI select low")
+                await any_select
+                continue
+
+            await qspi.falling_edge
+            await self._transaction(qspi, low[0])
+
+    async def _transaction(self, qspi, device):
+        data_in = self.data_in or qspi.data_in
+        flash = device == FLASH
+        if flash and self.inject_en is not None and self.inject_en.value.binstr == "1":
+            # The injector serves the flash, so skip to the end of the
+            # transaction rather than waking on every clock
+            await RisingEdge(qspi.selects[FLASH])
+            return
+        count = 0
+        cmd = 0x0B
+        addr = 0
+        data = bytearray()
+        data_start = 12
+        while True:
+            state = qspi.sample(oe=False)
+            if state.select(device) != 0 or qspi.in_reset():
+                break
+            if state.clk == 1:
+                nibble = state.data_out
+                phase = count if flash else count - 2
+                if not flash and count < 2:
+                    cmd = ((cmd << 4) | nibble) & 0xFF if count else nibble
+                elif phase < 6:
+                    addr = (addr << 4) | nibble
+                    if phase == 5:
+                        if cmd == 0x02:
+                            data_start = 8
+                        elif cmd != 0x0B:
+                            self._error("Unknown QSPI command {:02x}".format(cmd))
+                            return
+                        if not flash:
+                            addr |= RAM_BASE
+                elif flash and phase < 8:
+                    if nibble != 0xA:
+                        self._error("Bad flash mode bits {:x} at {:x}".format(nibble, addr))
+                elif count >= data_start and cmd == 0x02:
+                    j = count - data_start
+                    if j & 1 == 0:
+                        data.append(nibble << 4)
+                    else:
+                        data[-1] |= nibble
+                        self.memory.write_byte(addr + j // 2, data[-1])
+                count += 1
+            elif count >= data_start and cmd == 0x0B:
+                j = count - data_start
+                value = self.memory.read_byte(addr + j // 2)
+                if len(data) == j // 2:
+                    data.append(value)
+                if j & 1 == 0:
+                    data_in.value = value >> 4
+                else:
+                    data_in.value = value & 0xF
+            await qspi.falling_edge
+
+        if not flash and count > data_start:
+            self.ram_transactions.append(QspiTransaction(cmd == 0x02, addr, bytes(data)))
+
+# Backdoor access to the memories of sim_qspi_pmod in tb_qspi, for example
+# to check results that firmware leaves in RAM without sending them over
+# the UART.  The memory arrays can't be read or written in one access
+# through the simulator, only a byte at a time, so read_mem and write_mem
+# have tb_qspi copy them to or from a file with $writememh or $readmemh,
+# and wait for it.  Bytes that were never written read as 0.  read_mem_port
+# reads through the debug port.  The memories are smaller than the address
+# ranges, so addresses wrap within each one.
+class PmodBackdoor:
+    def __init__(self, dut):
+        self.dut = dut
+        self.pmod = dut.qspi
+        self.rom_size = len(self.pmod.rom)
+        self.ram_size = len(self.pmod.ram_a)
+        self.flash_size = 0
+
+    # Nothing to start, the memories are in the simulation
+    def start(self):
+        pass
+
+    # Replace the flash contents with a .hex, ELF or binary image, erasing
+    # whatever is left of the last image loaded
+    async def load_flash(self, path):
+        await self.write_flash(read_image(path))
+
+    async def write_flash(self, data):
+        if len(data) > self.rom_size:
+            raise ValueError("Image of {} bytes is larger than the flash".format(len(data)))
+        await self.write_mem(0, bytes(data) + b"\xff" * (self.flash_size - len(data)))
+        self.flash_size = len(data)
+
+    # The memories as numbered by backdoor_mem in tb_qspi, their sizes and
+    # the (memory, offset, length) pieces an access covers
+    def _pieces(self, addr, n):
+        pieces = []
+        while n > 0:
+            addr &= 0x1FFFFFF
+            if addr < RAM_BASE:
+                mem, base, end, size = 0, 0, RAM_BASE, self.rom_size
+            elif addr < RAM_BASE + RAM_SIZE:
+                mem, base, end, size = 1, RAM_BASE, RAM_BASE + RAM_SIZE, self.ram_size
+            else:
+                mem, base, end, size = 2, RAM_BASE + RAM_SIZE, RAM_BASE + 2 * RAM_SIZE, self.ram_size
+            offset = (addr - base) % size
+            length = min(n, size - offset, end - addr)
+            pieces.append((mem, offset, length))
+            addr += length
+            n -= length
+        return pieces
+
+    async def _transfer(self, mem, path, write):
+        self.dut.backdoor_file.value = int.from_bytes(path.encode(), "big")
+        self.dut.backdoor_mem.value = mem
+        self.dut.backdoor_write.value = int(write)
+        self.dut.backdoor_req.value = 1 - self.dut.backdoor_req.value.integer
+        await Timer(1, "ns")
+
+    async def read_mem(self, addr, n):
+        dumps = {}
+        data = bytearray()
+        with tempfile.TemporaryDirectory() as tmp:
+            for mem, offset, length in self._pieces(addr, n):
+                if mem not in dumps:
+                    path = os.path.join(tmp, "mem{}.hex".format(mem))
+                    await self._transfer(mem, path, False)
+                    dumps[mem] = read_hex(path)
+                data += dumps[mem][offset:offset + length]
+        return bytes(data)
+
+    async def write_mem(self, addr, data):
+        data = bytes(data)
+        lines = {}
+        pos = 0
+        for mem, offset, length in self._pieces(addr, len(data)):
+            lines.setdefault(mem, []).append("@{:x}\n".format(offset) +
+                                             "\n".join("{:02x}".format(b) for b in data[pos:pos + length]))
+            pos += length
+        with tempfile.TemporaryDirectory() as tmp:
+            for mem, chunks in lines.items():
+                path = os.path.join(tmp, "mem{}.hex".format(mem))
+                with open(path, "w") as f:
+                    f.write("\n".join(chunks) + "\n")
+                await self._transfer(mem, path, True)
+
+    async def read_mem_port(self, addr, n):
+        data = bytearray(n)
+        for i in range(n):
+            self.dut.qspi_debug_addr.value = (addr + i) & 0x1FFFFFF
+            await Timer(1, "ns")
+            self.dut.qspi_debug_clk.value = 1
+            await Timer(1, "ns")
+            self.dut.qspi_debug_clk.value = 0
+            data[i] = self.dut.qspi_debug_data.value.integer
+        return bytes(data)
+
+    # Write RAM A followed by RAM B to a binary file
+    async def save_ram(self, path):
+        ram = await self.read_mem(RAM_BASE, self.ram_size) + await self.read_mem(RAM_BASE + RAM_SIZE, self.ram_size)
+        with open(path, "wb") as f:
+            f.write(ram)
+
+# The full size flash and RAMs of the PMOD, 16 MiB and 2 x 8 MiB, modelled by
+# a SparseMemory for tb_qspi built with QSPI_MODEL defined.  The flash is
+# loaded from PROG_FILE if it is set, as sim_qspi_pmod loads INIT_FILE.
+# start() serves the bus, call it at the start of each test as cocotb stops
+# it at the end.
+class ModelPmod:
+    def __init__(self, dut):
+        self.dut = dut
+        self.memory = SparseMemory()
+        self.responder = None
+        if os.environ.get("PROG_FILE"):
+            self.memory.load_flash(os.environ["PROG_FILE"])
+
+    def start(self):
+        if self.responder is not None:
+            self.responder.stop()
+        self.responder = QspiResponder(self.dut, self.memory, self.dut.qspi_model_data)
+
+    # Async to match PmodBackdoor
+    async def load_flash(self, path):
+        self.memory.load_flash(path)
+
+    async def write_flash(self, data):
+        self.memory.flash = data
+
+    async def read_mem(self, addr, n):
+        return self.memory.read(addr, n)
+
+    async def write_mem(self, addr, data):
+        self.memory.write(addr, data)
+
+    async def save_ram(self, path):
+        self.memory.save_ram(path)
+
+# The memories of the PMOD in tb_qspi, with the same interface whichever
+# model was built
+def pmod_memory(dut):
+    return ModelPmod(dut) if hasattr(dut, "qspi_model_data") else PmodBackdoor(dut)
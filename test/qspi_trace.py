@@ -0,0 +1,135 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Passive tracer for the QSPI bus shared by the flash and the two PSRAMs, for
+# tb and tb_qspi.  Each transaction is decoded into a record of a NumPy
+# structured array:
+#   device      - FLASH, RAM_A or RAM_B
+#   command     - 0x0B read or 0x02 write for RAM, 0xEB for flash reads
+#                 (tinyQV uses the flash's continuous quad read mode, so no
+#                 command is sent)
+#   address     - address as seen by tinyQV
+#   start_cycle - clock cycle the select went low, counted from the start
+#   cycles      - clock cycles the select was low
+#   setup       - clock cycles before the first data nibble
+#   length      - whole data bytes transferred
+#   complete    - False if deselected before a whole data byte
+#
+# A fetch restart is a flash read that follows a RAM access: the fetch was
+# interrupted by a data access and has to send its address again.  The
+# cycles wasted by a restart are the setup cycles of the restarted read, and
+# the whole of the interrupted read if it was aborted before any data.
+
+import numpy as np
+
+import cocotb
+
+from bus import QspiBus, FLASH, RAM_A, RAM_B
+
+DEVICE_NAMES = ("flash", "ram_a", "ram_b")
+FLASH_READ = 0xEB
+RAM_BASE = 0x1000000
+
+TRACE_DTYPE = np.dtype([
+    ("device", "u1"),
+    ("command", "u1"),
+    ("address", "u4"),
+    ("start_cycle", "u8"),
+    ("cycles", "u4"),
+    ("setup", "u4"),
+    ("length", "u4"),
+    ("complete", "?"),
+])
+
+class QspiTracer:
+    def __init__(self, dut):
+        self.dut = dut
+        self.records = []
+        self.cycle = 0
+        self.task = cocotb.start_soon(self._run())
+
+    def stop(self):
+        self.task.kill()
+
+    def clear(self):
+        self.records = []
+        self.cycle = 0
+
+    def trace(self):
+        return np.array(self.records, dtype=TRACE_DTYPE)
+
+    def save(self, path):
+        np.save(path, self.trace())
+
+    def report(self):
+        return bus_report(self.trace(), self.cycle)
+
+    async def _run(self):
+        qspi = QspiBus.of(self.dut)
+        device = None
+        while True:
+            await qspi.falling_edge
+            self.cycle += 1
+            state = qspi.sample(oe=False)
+
+            if device is not None and state.select(device) != 0:
+                self._end(device, start, clocks, command, addr, data_start, setup)
+                device = None
+            if device is None:
+                for i in range(3):
+                    if state.select(i) == 0 and not qspi.in_reset():
+                        device, start, clocks, command, addr, setup = i, self.cycle, 0, 0, 0, None
+                        data_start = 12 if device == FLASH else None
+                        break
+                continue
+
+            if state.clk != 1:
+                continue
+            nibble = state.data_out if state.data_out is not None else 0
+            phase = clocks if device == FLASH else clocks - 2
+            if device != FLASH and clocks < 2:
+                command = (command << 4) | nibble
+            elif phase < 6:
+                addr = (addr << 4) | nibble
+                if phase == 5 and device != FLASH:
+                    data_start = 8 if command == 0x02 else 12
+            if data_start is not None and clocks == data_start:
+                setup = self.cycle - start
+            clocks += 1
+
+    def _end(self, device, start, clocks, command, addr, data_start, setup):
+        length = max(clocks - data_start, 0) // 2 if data_start is not None else 0
+        self.records.append((device, FLASH_READ if device == FLASH else command,
+                             addr if device == FLASH else RAM_BASE | addr,
+                             start, self.cycle - start, setup if setup is not None else self.cycle - start,
+                             length, length > 0))
+
+# Summarise a trace: bus utilisation per device over total_cycles, flash
+# burst lengths and fetch restarts
+def bus_report(trace, total_cycles):
+    report = {"total_cycles": int(total_cycles), "transactions": len(trace)}
+    for device, name in enumerate(DEVICE_NAMES):
+        busy = int(trace["cycles"][trace["device"] == device].sum())
+        report[name + "_busy_percent"] = round(100 * busy / max(total_cycles, 1), 2)
+
+    flash = trace["device"] == FLASH
+    report["fetches"] = int(flash.sum())
+    report["average_fetch_bytes"] = round(float(trace["length"][flash].mean()), 2) if flash.any() else 0.0
+    report["aborted_fetches"] = int((flash & ~trace["complete"]).sum())
+
+    # Flash reads directly after RAM accesses, and the last flash read before
+    # those accesses, which there may be several of back to back
+    restart = np.flatnonzero(flash[1:] & ~flash[:-1]) + 1
+    last_flash = np.maximum.accumulate(np.where(flash, np.arange(len(trace)), -1))
+    interrupted = last_flash[restart - 1]
+    wasted = trace["setup"][restart].astype(np.int64)
+    has_prev = interrupted >= 0
+    prev = interrupted[has_prev]
+    prev_aborted = ~trace["complete"][prev]
+    wasted[has_prev] += np.where(prev_aborted, trace["cycles"][prev], 0)
+    report["fetch_restarts"] = len(restart)
+    report["average_restart_wasted_cycles"] = round(float(wasted.mean()), 2) if len(restart) else 0.0
+    return report
+
+def format_report(report):
+    return "\n".join("{:30} {}".format(k, v) for k, v in report.items())
@@ -0,0 +1,67 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Corpus of failing random test programs, and a minimiser to shrink them.
+#
+# A case is a dict holding the test name, the seed it was generated from,
+# the initial register loads as [reg, value, offset] and the random
+# instructions as items: {"name", "instr", "base_reg", "imm", "addr"}.
+# Memory operations carry the address their base register is set to, so any
+# subsequence of the items is a valid program.  Items also carry the op name
+# and kind, and the registers written and read, for functional coverage.
+
+import json
+import os
+
+CORPUS_DIR = os.environ.get("RANDOM_CORPUS",
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), "random_corpus"))
+
+def case_path(case):
+    return os.path.join(CORPUS_DIR, "{}_{}.json".format(case["test"], case["seed"]))
+
+def save_case(case):
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    path = case_path(case)
+    with open(path, "w") as f:
+        json.dump(case, f, indent=1)
+    return path
+
+def load_cases(test):
+    if not os.path.isdir(CORPUS_DIR):
+        return []
+    cases = []
+    for filename in sorted(os.listdir(CORPUS_DIR)):
+        if filename.endswith(".json"):
+            with open(os.path.join(CORPUS_DIR, filename)) as f:
+                case = json.load(f)
+            if case["test"] == test:
+                cases.append(case)
+    return cases
+
+# Delta debugging: repeatedly try removing chunks of items, keeping any
+# removal after which the program still fails, and halving the chunk size
+# when nothing can be removed.  fails is an async function taking a list of
+# items.  Gives up after max_runs attempts and returns the smallest failing
+# list found.
+async def ddmin(items, fails, max_runs):
+    n = 2
+    runs = 0
+    while len(items) >= 2 and runs < max_runs:
+        chunk = (len(items) + n - 1) // n
+        for start in range(0, len(items), chunk):
+            complement = items[:start] + items[start + chunk:]
+            runs += 1
+            if await fails(complement):
+                items = complement
+                n = max(n - 1, 2)
+                break
+            if runs >= max_runs:
+                break
+        else:
+            if n >= len(items):
+                break
+            n = min(n * 2, len(items))
+
+    if len(items) == 1 and runs < max_runs and await fails([]):
+        items = []
+    return items
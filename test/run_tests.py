@@ -0,0 +1,182 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Runs the cocotb tests in parallel.  The suite is split into shards: each
+# test in test.py, blocks of seeds for the random tests, each firmware image
+# in the test_firmware.mk manifest, and hello with the UART at its real rate.  Shards that
+# compile to the same simulation share its build in sim_build/cache (see
+# sim_cache.py): the first shard of each build runs alone and builds it, and
+# the rest then run in parallel on that build.  Each shard writes its log,
+# results and coverage to sim_build/shards/<name>, the JUnit results are
+# merged into results.xml and the random tests' functional coverage into
+# coverage.json.
+
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from func_coverage import merge_files
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Random tests, split into blocks of seeds
+RANDOM_TESTS = ("test_random", "test_random_alu")
+
+class Shard:
+    def __init__(self, name, makefile, make_args=(), env=None):
+        self.name = name
+        self.makefile = makefile
+        self.make_args = list(make_args)
+        self.env = env or {}
+        self.out_dir = os.path.join(TEST_DIR, "sim_build", "shards", name)
+        self.results_file = os.path.join(self.out_dir, "results.xml")
+        self.sim_build = None
+        self.wall_time = None
+        self.returncode = None
+
+def cocotb_tests(module):
+    with open(os.path.join(TEST_DIR, module + ".py")) as f:
+        return re.findall(r"@cocotb\.test\(\)\s*\nasync def (\w+)", f.read())
+
+# The images in the firmware manifest, by the names of their TestFactory tests
+# on tb_qspi and on the reference model
+def firmware_images():
+    with open(os.environ.get("FIRMWARE_MANIFEST", os.path.join(TEST_DIR, "firmware.json"))) as f:
+        entries = json.load(f)
+    return [(os.path.splitext(os.path.basename(entry["image"]))[0],
+             "run_firmware_{0:03d},run_firmware_on_model_{0:03d}".format(i + 1)) for i, entry in enumerate(entries)]
+
+def make_shards(random_shards):
+    shards = []
+    for test in cocotb_tests("test"):
+        if test in RANDOM_TESTS and random_shards > 1:
+            for i in range(random_shards):
+                shards.append(Shard(f"{test}.{i}", "test_basic.mk", [f"TESTCASE={test}"],
+                                    {"RANDOM_SHARD": f"{i}/{random_shards}"}))
+        else:
+            shards.append(Shard(test, "test_basic.mk", [f"TESTCASE={test}"]))
+    # The firmware images share one build, loading each image from Python
+    for image, tests in firmware_images():
+        shards.append(Shard(f"firmware_{image}", "test_firmware.mk", [f"TESTCASE={tests}"]))
+    # The UART runs faster than the real rate in the other tests
+    shards.append(Shard("prog_hello_full_rate", "test_prog.mk", ["PROG=hello", "UART_BIT_RATE=115200"]))
+    return shards
+
+def make_cmd(shard, args):
+    return ["make", "-f", shard.makefile, f"SIM={args.sim}", f"WAVES={args.waves}"] + shard.make_args
+
+# The cached build directory the makefile picks for a shard
+def sim_build(shard, args):
+    cmd = make_cmd(shard, args) + ["-s", "--eval", "print-sim-build: ; @echo $(SIM_BUILD)", "print-sim-build"]
+    out = subprocess.run(cmd, cwd=TEST_DIR, capture_output=True, text=True).stdout.strip()
+    return os.path.join(TEST_DIR, out.splitlines()[-1]) if out else None
+
+# Group the shards by build, the first of each group builds the simulation
+def group_by_build(shards):
+    groups = {}
+    for shard in shards:
+        # Shards without a known build run separately
+        groups.setdefault(shard.sim_build or shard.name, []).append(shard)
+    return list(groups.values())
+
+def run_shard(shard, args, seed):
+    shutil.rmtree(shard.out_dir, ignore_errors=True)
+    os.makedirs(shard.out_dir)
+
+    cmd = make_cmd(shard, args) + [f"COCOTB_RESULTS_FILE={shard.results_file}"]
+    if shard.sim_build:
+        cmd.append(f"SIM_BUILD={shard.sim_build}")
+    env = dict(os.environ, RANDOM_SEED=str(seed), RANDOM_COVERAGE=os.path.join(shard.out_dir, "coverage"),
+               **shard.env)
+
+    start = time.monotonic()
+    with open(os.path.join(shard.out_dir, "sim.log"), "w") as log:
+        shard.returncode = subprocess.call(cmd, cwd=TEST_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    shard.wall_time = time.monotonic() - start
+    return shard
+
+def shard_results(shard):
+    try:
+        suites = ET.parse(shard.results_file).getroot().findall("testsuite")
+    except (OSError, ET.ParseError):
+        # The simulator failed before writing results, record that as a failure
+        suite = ET.Element("testsuite")
+        testcase = ET.SubElement(suite, "testcase", name=shard.name, classname=shard.name)
+        ET.SubElement(testcase, "failure", message="No results, see " + os.path.join(shard.out_dir, "sim.log"))
+        suites = [suite]
+
+    for suite in suites:
+        suite.set("name", shard.name)
+        suite.set("package", shard.name)
+        ET.SubElement(suite, "property", name="wall_time_s", value=f"{shard.wall_time:.2f}")
+    return suites
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the cocotb tests in parallel")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--sim", default=os.environ.get("SIM", "icarus"))
+    parser.add_argument("--waves", type=int, default=0)
+    parser.add_argument("--seed", type=int, help="RANDOM_SEED for all shards, so the random tests can be replayed")
+    parser.add_argument("--random-shards", type=int, default=5, help="Seed blocks per random test")
+    parser.add_argument("-k", "--filter", help="Only run shards whose name matches this regex")
+    parser.add_argument("-o", "--output", default=os.path.join(TEST_DIR, "results.xml"))
+    parser.add_argument("--coverage", default=os.path.join(TEST_DIR, "coverage.json"),
+                        help="Merged functional coverage of the random tests")
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randint(0, 0xFFFFFFFF)
+    shards = make_shards(args.random_shards)
+    if args.filter:
+        shards = [s for s in shards if re.search(args.filter, s.name)]
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for shard, build in zip(shards, pool.map(lambda s: sim_build(s, args), shards)):
+            shard.sim_build = build
+    groups = group_by_build(shards)
+    print(f"Running {len(shards)} shards, {len(groups)} builds, on {args.jobs} jobs with RANDOM_SEED={seed}")
+
+    start = time.monotonic()
+    testsuites = ET.Element("testsuites", name="results")
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        # The rest of each group are queued when its first shard is done
+        pending = {pool.submit(run_shard, first, args, seed): rest for first, *rest in groups}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for follower in pending.pop(future):
+                    pending[pool.submit(run_shard, follower, args, seed)] = []
+                shard = future.result()
+                suites = shard_results(shard)
+                testsuites.extend(suites)
+                failures = sum(len(suite.findall("testcase/failure")) for suite in suites)
+                status = "FAIL" if failures or shard.returncode else "ok"
+                if status != "ok":
+                    failed.append(shard)
+                print(f"{shard.name:30} {status:4} {shard.wall_time:8.1f}s")
+
+    ET.ElementTree(testsuites).write(args.output, encoding="UTF-8", xml_declaration=True)
+
+    coverage_files = [f for shard in shards for f in glob.glob(os.path.join(shard.out_dir, "coverage", "*.json"))]
+    if coverage_files:
+        coverage = merge_files(coverage_files)
+        coverage.save(args.coverage)
+        print(f"Random test coverage, saved to {args.coverage}:\n{coverage.report()}")
+
+    slowest = max(shards, key=lambda s: s.wall_time, default=None)
+    print(f"Total wall time {time.monotonic() - start:.1f}s, sum of shards {sum(s.wall_time for s in shards):.1f}s", end="")
+    print(f", slowest {slowest.name} {slowest.wall_time:.1f}s" if slowest else "")
+    for shard in failed:
+        print(f"Failed: {shard.name}, log in {os.path.join(shard.out_dir, 'sim.log')}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Prints the build directory to use for a simulation, sim_build/cache/<key>,
+# where key is a hash of everything the compiled simulation depends on: the
+# simulator and its version, the top level, the compile arguments and the
+# contents of the sources and of any headers in the include directories.
+# Builds with the same inputs share a directory.  The key shows an existing
+# build matches the sources, whatever their timestamps (e.g. after a fresh
+# checkout or a restore from a CI cache), so its files are touched to make
+# cocotb's make rules find it up to date.  Builds for other keys are left
+# alone.
+
+import argparse
+import glob
+import hashlib
+import os
+import shlex
+import subprocess
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+
+VERSION_ARGS = {
+    "icarus": ["iverilog", "-V"],
+    "verilator": ["verilator", "--version"],
+}
+
+def simulator_version(sim):
+    cmd = VERSION_ARGS.get(sim)
+    if cmd is None:
+        return sim
+    try:
+        out = subprocess.run(cmd, capture_output=True, text=True).stdout
+    except OSError:
+        return sim
+    return out.splitlines()[0] if out else sim
+
+def cocotb_version():
+    try:
+        import cocotb
+        return cocotb.__version__
+    except ImportError:
+        return ""
+
+def source_files(patterns, args):
+    files = []
+    for pattern in patterns:
+        files += sorted(glob.glob(pattern)) or [pattern]
+    for arg in args:
+        if arg.startswith("-I"):
+            for ext in ("vh", "svh"):
+                files += sorted(glob.glob(os.path.join(arg[2:], "*." + ext)))
+    return files
+
+def build_key(sim, toplevel, args, sources):
+    h = hashlib.sha256()
+    # Paths are hashed relative to the repo, so checkouts in different
+    # places share builds
+    for item in (sim, simulator_version(sim), cocotb_version(), toplevel,
+                 " ".join(args).replace(ROOT_DIR, "")):
+        h.update(item.encode() + b"\0")
+    for path in source_files(sources, args):
+        h.update(os.path.relpath(path, ROOT_DIR).encode() + b"\0")
+        try:
+            with open(path, "rb") as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        except OSError:
+            # Let the simulator report the missing file
+            h.update(b"missing")
+    return h.hexdigest()[:16]
+
+def mark_up_to_date(path):
+    for root, _, files in os.walk(path):
+        for name in files:
+            os.utime(os.path.join(root, name))
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the cached build directory for a simulation")
+    parser.add_argument("--sim", required=True)
+    parser.add_argument("--toplevel", required=True)
+    parser.add_argument("--args", default="", help="Compile arguments, as one string")
+    parser.add_argument("sources", nargs="*")
+    args = parser.parse_args()
+
+    key = build_key(args.sim, args.toplevel, shlex.split(args.args), args.sources)
+    build_dir = os.path.join("sim_build", "cache", key)
+    mark_up_to_date(os.path.join(TEST_DIR, build_dir))
+    print(build_dir)
+
+if __name__ == "__main__":
+    main()
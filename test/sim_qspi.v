@@ -51,9 +51,9 @@ module sim_qspi_pmod (
 
             if (writing) begin
                 if (!qspi_ram_a_select) 
-                    ram_a[addr[RAM_BITS:1]][(4 - 4*addr[0]) +:4] <= qspi_data_in;
+                    ram_a[addr[RAM_BITS:1]][{!addr[0], 2'b00} +:4] <= qspi_data_in;
                 else if (!qspi_ram_b_select)
-                    ram_b[addr[RAM_BITS:1]][(4 - 4*addr[0]) +:4] <= qspi_data_in;
+                    ram_b[addr[RAM_BITS:1]][{!addr[0], 2'b00} +:4] <= qspi_data_in;
             end else if (!reading && !writing && !error) begin
                 cmd <= {cmd[27:0], qspi_data_in};
             end
@@ -79,7 +79,7 @@ module sim_qspi_pmod (
                     reading <= 1;
                     reading_dummy <= 0;
                 end
-            end else if (!error && start_count == (qspi_flash_select ? 8 : 6)) begin
+            end else if (!error && start_count == (qspi_flash_select ? 6'd8 : 6'd6)) begin
                 addr[ROM_BITS:1] <= cmd[ROM_BITS-1:0];
                 addr[0] <= 0;
                 if (!qspi_flash_select || cmd[31:24] == 8'h0B)
@@ -104,11 +104,11 @@ module sim_qspi_pmod (
     always @(*) begin
         if (reading) begin
             if (!qspi_flash_select)
-                qspi_data_out = rom[addr[ROM_BITS:1]][(4 - 4*addr[0]) +:4];
+                qspi_data_out = rom[addr[ROM_BITS:1]][{!addr[0], 2'b00} +:4];
             else if (!qspi_ram_a_select)
-                qspi_data_out = ram_a[addr[RAM_BITS:1]][(4 - 4*addr[0]) +:4];
+                qspi_data_out = ram_a[addr[RAM_BITS:1]][{!addr[0], 2'b00} +:4];
             else if (!qspi_ram_b_select)
-                qspi_data_out = ram_b[addr[RAM_BITS:1]][(4 - 4*addr[0]) +:4];
+                qspi_data_out = ram_b[addr[RAM_BITS:1]][{!addr[0], 2'b00} +:4];
             else
                 qspi_data_out = 0;
         end else begin
@@ -0,0 +1,87 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Top down breakdown of where the core's cycles go, from the 16 debug
+# signals that project.v muxes onto the debug_signal output.  All of them are
+# sampled every cycle from the debug_signals vector, and each cycle is put in
+# the first class that applies:
+#   idle       - in reset
+#   restart    - branch or fetch restart penalty: from a branch, return or
+#                fetch restart until the next instruction is valid
+#   data_stall - a data read or write is in progress, or the transaction is
+#                stalled (debug_stall_txn)
+#   fetch      - fetch starved: no valid instruction to execute
+#   retiring   - executing a valid instruction, including the cycle it
+#                completes
+# Not available for gate level tests.
+
+import cocotb
+from cocotb.triggers import RisingEdge
+
+# debug_signals bit 15 down to 0
+SIGNALS = ("instr_complete", "instr_ready", "instr_valid", "fetch_restart",
+           "read", "write", "data_ready", "interrupt_pending",
+           "branch", "early_branch", "ret", "reg_wen",
+           "counter_0", "data_continue", "stall_txn", "stop_txn")
+BIT = {name: 15 - i for i, name in enumerate(SIGNALS)}
+CLASSES = ("retiring", "fetch", "data_stall", "restart", "idle")
+
+class StallMonitor:
+    def __init__(self, dut):
+        self.clk = dut.clk
+        self.rst_n = dut.rst_n
+        self.debug_signals = dut.user_project.debug_signals
+        self.clear()
+        self.task = cocotb.start_soon(self._run())
+
+    @staticmethod
+    def available(dut):
+        return hasattr(dut.user_project, "debug_signals")
+
+    def stop(self):
+        self.task.kill()
+
+    def clear(self):
+        self.counts = dict.fromkeys(CLASSES, 0)
+        self.signal_counts = dict.fromkeys(SIGNALS, 0)
+        self.cycles = 0
+        self.refilling = False
+
+    def _classify(self, value):
+        def high(name):
+            return (value >> BIT[name]) & 1
+
+        if high("branch") or high("early_branch") or high("ret") or high("fetch_restart"):
+            self.refilling = True
+        elif high("instr_valid"):
+            self.refilling = False
+
+        if self.refilling:
+            return "restart"
+        if high("read") or high("write") or high("stall_txn"):
+            return "data_stall"
+        if not high("instr_valid"):
+            return "fetch"
+        return "retiring"
+
+    async def _run(self):
+        while True:
+            await RisingEdge(self.clk)
+            self.cycles += 1
+            value = self.debug_signals.value
+            if self.rst_n.value.binstr != "1" or not value.is_resolvable:
+                self.counts["idle"] += 1
+                self.refilling = False
+                continue
+            value = value.integer
+            for name in SIGNALS:
+                if (value >> BIT[name]) & 1:
+                    self.signal_counts[name] += 1
+            self.counts[self._classify(value)] += 1
+
+    # Percentage of cycles in each class
+    def breakdown(self):
+        return {name: round(100 * count / max(self.cycles, 1), 2) for name, count in self.counts.items()}
+
+    def report(self):
+        return "  ".join("{} {:.1f}%".format(name, percent) for name, percent in self.breakdown().items())
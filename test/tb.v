@@ -11,14 +11,15 @@ module tb ();
   reg ena;
   reg [7:0] ui_in_base;
   wire [7:0] ui_in;
-  reg [7:0] uio_in;
+  wire [7:0] uio_in;
   wire [7:0] uo_out;
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
 
-  wire [3:0] qspi_data_in;
+  reg [3:0] qspi_data_in;
   reg [2:0] latency_cfg;
-  assign {uio_in[5:4], uio_in[2:1]} = rst_n ? qspi_data_in : {1'b0, latency_cfg};
+  reg inject_en;
+  reg [3:0] inject_data;
 
   wire [3:0] qspi_data_out = {uio_out[5:4], uio_out[2:1]};
   wire [3:0] qspi_data_oe  = {uio_oe[5:4],  uio_oe[2:1]};
@@ -27,8 +28,11 @@ module tb ();
   wire qspi_ram_a_select = uio_out[6];
   wire qspi_ram_b_select = uio_out[7];
 
-  wire spi_miso = ui_in_base[2];
-  assign ui_in[2] = spi_miso;
+  wire inject_active = inject_en && !qspi_flash_select;
+  assign {uio_in[5:4], uio_in[2:1]} = rst_n ? (inject_active ? inject_data : qspi_data_in) : {1'b0, latency_cfg};
+  assign {uio_in[7:6], uio_in[3], uio_in[0]} = 4'b0000;
+
+  reg spi_miso;
   wire spi_cs = uo_out[4];
   wire spi_sck = uo_out[5];
   wire spi_mosi = uo_out[3];
@@ -37,7 +41,7 @@ module tb ();
   wire uart_tx = uo_out[0];
   wire uart_rts = uo_out[1];
   wire debug_uart_tx = uo_out[6];
-  wire uart_rx = ui_in_base[7];
+  reg uart_rx;
   assign ui_in = {uart_rx, ui_in_base[6:3], spi_miso, ui_in_base[1:0]};
 
   // Replace tt_um_example with your module name:
@@ -59,4 +63,88 @@ module tb ();
       .rst_n  (rst_n)     // not reset
   );
 
+  // Instruction injection: when inject_en is set the flash is served from
+  // inject_mem, which the test fills in bulk, instead of by the test itself.
+  // From inject_end onwards the memory reads as beq x0, x0, 0, so the CPU
+  // spins at inject_end until more instructions are added.  The flash protocol is
+  // checked here, errors are reported by setting inject_error.
+  localparam INJECT_BITS = 20;
+  reg [15:0] inject_mem [0:(1 << INJECT_BITS)-1];
+  reg [INJECT_BITS-1:0] inject_end;
+  reg inject_error;
+
+  reg [3:0] inject_count;       // QSPI clocks in this transaction, 12 once reading data
+  reg inject_clk_high;
+  reg [23:0] inject_addr;
+  reg [24:0] inject_nibble;     // Nibble address of the next data nibble
+  reg [INJECT_BITS-1:0] inject_end_r;
+  reg inject_at_end;
+
+  initial begin
+    inject_en = 0;
+    inject_end = 0;
+    inject_error = 0;
+    inject_count = 0;
+    inject_clk_high = 0;
+    inject_end_r = 0;
+    inject_at_end = 0;
+  end
+
+  // Set while the CPU is spinning at inject_end
+  wire inject_idle = inject_at_end && inject_end_r == inject_end;
+
+  wire [15:0] inject_halfword = (inject_nibble[24:2] < {3'b000, inject_end_r}) ? inject_mem[inject_nibble[INJECT_BITS+1:2]] :
+                                (inject_nibble[2] == inject_end_r[0]) ? 16'h0063 : 16'h0000;
+
+  // Follows the flash reads whether or not injection is enabled, so it can be
+  // enabled at any time.  Timing matches send_instr in test.py: each nibble is
+  // presented on the falling edge of clk while the QSPI clock is low.
+  always @(negedge clk) begin
+    if (qspi_flash_select) begin
+      inject_count <= 0;
+      inject_clk_high <= 0;
+      inject_at_end <= 0;
+      inject_end_r <= inject_end;
+    end else begin
+      inject_clk_high <= qspi_clk_out;
+      if (qspi_clk_out) begin
+        if (inject_count != 12) inject_count <= inject_count + 1;
+        if (inject_count < 6) inject_addr <= {inject_addr[19:0], qspi_data_out};
+        if (inject_count == 6) inject_at_end <= inject_addr[23:1] == {3'b000, inject_end_r};
+        if (inject_count == 11) inject_nibble <= {inject_addr, 1'b0};
+        if (inject_count == 12) inject_nibble <= inject_nibble + 1;
+      end else if (inject_count == 12) begin
+        inject_data <= inject_halfword[{inject_nibble[1], !inject_nibble[0], 2'b00} +:4];
+      end
+    end
+  end
+
+  always @(negedge clk) begin
+    if (inject_en && rst_n) begin
+      if ((!qspi_flash_select && !qspi_ram_a_select) || (!qspi_flash_select && !qspi_ram_b_select) ||
+          (!qspi_ram_a_select && !qspi_ram_b_select)) begin
+        $display("%t: Injector: more than one QSPI select low", $time);
+        inject_error <= 1;
+      end
+      if (!qspi_flash_select && qspi_clk_out) begin
+        if (inject_clk_high) begin
+          $display("%t: Injector: QSPI clock high for more than one cycle", $time);
+          inject_error <= 1;
+        end
+        if (inject_count < 8 && qspi_data_oe != 4'hF) begin
+          $display("%t: Injector: data not output during address", $time);
+          inject_error <= 1;
+        end
+        if ((inject_count == 6 || inject_count == 7) && qspi_data_out != 4'hA) begin
+          $display("%t: Injector: bad mode bits %h", $time, qspi_data_out);
+          inject_error <= 1;
+        end
+        if (inject_count >= 8 && qspi_data_oe != 4'h0) begin
+          $display("%t: Injector: data output during read", $time);
+          inject_error <= 1;
+        end
+      end
+    end
+  end
+
 endmodule
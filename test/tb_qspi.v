@@ -11,7 +11,7 @@ module tb_qspi ();
   reg ena;
   reg [7:0] ui_in_base;
   wire [7:0] ui_in;
-  reg [7:0] uio_in;
+  wire [7:0] uio_in;
   wire [7:0] uo_out;
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
@@ -19,6 +19,7 @@ module tb_qspi ();
   wire [3:0] qspi_data_in;
   reg [2:0] latency_cfg;
   assign {uio_in[5:4], uio_in[2:1]} = rst_n ? qspi_data_in : {1'b0, latency_cfg};
+  assign {uio_in[7:6], uio_in[3], uio_in[0]} = 4'b0000;
 
   wire [3:0] qspi_data_out = {uio_out[5:4], uio_out[2:1]};
   wire [3:0] qspi_data_oe  = {uio_oe[5:4],  uio_oe[2:1]};
@@ -27,8 +28,7 @@ module tb_qspi ();
   wire qspi_ram_a_select = uio_out[6];
   wire qspi_ram_b_select = uio_out[7];
 
-  wire spi_miso = ui_in_base[2];
-  assign ui_in[2] = spi_miso;
+  reg spi_miso;
   wire spi_cs = uo_out[4];
   wire spi_sck = uo_out[5];
   wire spi_mosi = uo_out[3];
@@ -37,7 +37,7 @@ module tb_qspi ();
   wire uart_tx = uo_out[0];
   wire uart_rts = uo_out[1];
   wire debug_uart_tx = uo_out[6];
-  wire uart_rx = ui_in_base[7];
+  reg uart_rx;
   assign ui_in = {uart_rx, ui_in_base[6:3], spi_miso, ui_in_base[1:0]};
 
   // Replace tt_um_example with your module name:
@@ -65,20 +65,83 @@ module tb_qspi ();
   always @(posedge clk) begin
     data_buffer <= {data_buffer[15:0], buffered_qspi_data};
   end
-  assign qspi_data_in = (latency_cfg < 1) ? buffered_qspi_data :
-                        data_buffer[(latency_cfg - 1) * 4 +:4];
+  assign qspi_data_in = (latency_cfg == 3'd0) ? buffered_qspi_data :
+                        data_buffer[{latency_cfg - 3'd1, 2'b00} +:4];
 
-  // Simulated QSPI PMOD
-  sim_qspi_pmod qspi (
+`ifdef QSPI_MODEL
+  // Full size PMOD memories modelled in Python by qspi_memory.ModelPmod,
+  // which drives the data here
+  reg [3:0] qspi_model_data;
+  initial qspi_model_data = 0;
+  assign buffered_qspi_data = qspi_model_data;
+`else
+  // Simulated QSPI PMOD, its debug port reads the memories from the test
+  reg qspi_debug_clk;
+  reg [24:0] qspi_debug_addr;
+  wire [7:0] qspi_debug_data;
+  initial qspi_debug_clk = 0;
+
+  sim_qspi_pmod #(.INIT_FILE(`PROG_FILE)) qspi (
     .qspi_data_in(qspi_data_out & qspi_data_oe),
     .qspi_data_out(buffered_qspi_data),
     .qspi_clk(qspi_clk_out),
 
     .qspi_flash_select(qspi_flash_select),
     .qspi_ram_a_select(qspi_ram_a_select),
-    .qspi_ram_b_select(qspi_ram_b_select)
+    .qspi_ram_b_select(qspi_ram_b_select),
+
+    .debug_clk(qspi_debug_clk),
+    .debug_addr(qspi_debug_addr),
+    .debug_data(qspi_debug_data)
   );
 
-  defparam qspi.INIT_FILE = `PROG_FILE;
+  // Bulk backdoor access to the PMOD memories for qspi_memory.PmodBackdoor:
+  // each change of backdoor_req loads (backdoor_write) or dumps memory
+  // backdoor_mem (0 flash, 1 RAM A, 2 RAM B) from or to backdoor_file
+  reg [8*256-1:0] backdoor_file;
+  reg [1:0] backdoor_mem;
+  reg backdoor_write;
+  reg backdoor_req;
+  initial backdoor_req = 0;
+
+  always @(backdoor_req) begin
+    if (backdoor_write) begin
+      case (backdoor_mem)
+        2'd0: $readmemh(backdoor_file, qspi.rom);
+        2'd1: $readmemh(backdoor_file, qspi.ram_a);
+        default: $readmemh(backdoor_file, qspi.ram_b);
+      endcase
+    end else begin
+      case (backdoor_mem)
+        2'd0: $writememh(backdoor_file, qspi.rom);
+        2'd1: $writememh(backdoor_file, qspi.ram_a);
+        default: $writememh(backdoor_file, qspi.ram_b);
+      endcase
+    end
+  end
+`endif
+
+  // Benchmark counters: clock cycles and instructions retired from reset
+  // until the start of the first byte sent on the debug UART
+  reg [31:0] bench_cycles;
+  reg [31:0] bench_instrs;
+  reg bench_done;
+
+  always @(posedge clk) begin
+    if (!rst_n) begin
+      bench_cycles <= 0;
+      bench_instrs <= 0;
+      bench_done <= 0;
+    end else if (!bench_done) begin
+      if (!debug_uart_tx) begin
+        bench_done <= 1;
+      end else begin
+        bench_cycles <= bench_cycles + 1;
+`ifndef GL_TEST
+        if (user_project.debug_instr_complete) bench_instrs <= bench_instrs + 1;
+`endif
+      end
+    end
+  end
 
 endmodule
@@ -0,0 +1,194 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Per-test performance telemetry for the cocotb tests.
+#
+# Calling install() from a test module records, for every test:
+#   wall_time_s      - wall clock time
+#   sim_time_ns      - simulated time
+#   sim_cycles       - simulated cycles of the 64 MHz clock
+#   python_time_s    - wall time spent in Python handling simulator callbacks
+#   simulator_time_s - the rest of the wall time, spent in the simulator
+#   callbacks        - number of simulator callbacks into Python
+# The metrics are added to each testcase in results.xml as properties, and
+# appended as a JSON line to TELEMETRY_HISTORY (default telemetry.jsonl).
+#
+# The comparator checks the latest run of each test in the history against
+# the median of the runs before it:
+#   python telemetry.py compare [--cycles-threshold 2] [--wall-threshold 25]
+#                               [--metric sim_cycles]
+# and exits with an error if any test regressed by more than the threshold
+# percentages.  When a change makes tests slower on purpose, accept the
+# latest runs as the new baseline:
+#   python telemetry.py accept
+# which appends a marker to the history: runs before the latest run of each
+# test at that point are no longer compared.
+#
+# install() wraps private parts of cocotb's scheduler and regression manager,
+# so it checks they are as in the cocotb versions it was written for
+# (COCOTB_VERSIONS) and raises an error otherwise, rather than recording
+# nothing.
+
+import argparse
+import inspect
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from xml.etree.ElementTree import Element, SubElement
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+HISTORY = os.environ.get("TELEMETRY_HISTORY", os.path.join(TEST_DIR, "telemetry.jsonl"))
+CLOCK_PERIOD_NS = 15.624
+COCOTB_VERSIONS = ("1.8.",)
+METRICS = ("sim_cycles", "wall_time_s")
+
+callbacks = 0
+python_time = 0.0
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=TEST_DIR,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+# The cocotb internals wrapped by install() must be as expected
+def check_cocotb(cocotb, RegressionManager, Scheduler):
+    if not cocotb.__version__.startswith(COCOTB_VERSIONS):
+        raise RuntimeError("telemetry.py supports cocotb {}, not {}".format(
+                           " or ".join(v + "x" for v in COCOTB_VERSIONS), cocotb.__version__))
+    expected = ((Scheduler, "_react", ["self", "trigger"]),
+                (RegressionManager, "_start_test", ["self"]),
+                (RegressionManager, "_record_result", ["self", "test", "outcome", "wall_time_s", "sim_time_ns"]))
+    for cls, name, params in expected:
+        method = getattr(cls, name, None)
+        if method is None or list(inspect.signature(method).parameters) != params:
+            raise RuntimeError("telemetry.py can't wrap {}.{} in cocotb {}".format(
+                               cls.__name__, name, cocotb.__version__))
+
+# Wrap the scheduler's handling of simulator callbacks to count them and
+# time them, and the regression manager's test start and result recording to
+# take the metrics for each test.
+def install():
+    import cocotb
+    from cocotb.regression import RegressionManager
+    from cocotb.scheduler import Scheduler
+
+    if getattr(Scheduler, "_telemetry_installed", False):
+        return
+    check_cocotb(cocotb, RegressionManager, Scheduler)
+    Scheduler._telemetry_installed = True
+
+    react = Scheduler._react
+    def timed_react(self, trigger):
+        global callbacks, python_time
+        if self._is_reacting:
+            return react(self, trigger)
+        callbacks += 1
+        start = time.perf_counter()
+        try:
+            return react(self, trigger)
+        finally:
+            python_time += time.perf_counter() - start
+    Scheduler._react = timed_react
+
+    start_test = RegressionManager._start_test
+    def telemetry_start_test(self):
+        self._telemetry_start = (callbacks, python_time)
+        return start_test(self)
+    RegressionManager._start_test = telemetry_start_test
+
+    commit = git_commit()
+    record_result = RegressionManager._record_result
+    def telemetry_record_result(self, test, outcome, wall_time_s, sim_time_ns):
+        start_callbacks, start_python_time = getattr(self, "_telemetry_start", (callbacks, python_time))
+        test_python_time = python_time - start_python_time
+        metrics = {
+            "wall_time_s": round(wall_time_s, 3),
+            "sim_time_ns": round(sim_time_ns),
+            "sim_cycles": round(sim_time_ns / CLOCK_PERIOD_NS),
+            "python_time_s": round(test_python_time, 3),
+            "simulator_time_s": round(max(wall_time_s - test_python_time, 0), 3),
+            "callbacks": callbacks - start_callbacks,
+        }
+        failures = self.failures
+        record_result(self, test, outcome, wall_time_s, sim_time_ns)
+
+        properties = Element("properties")
+        for name, value in metrics.items():
+            SubElement(properties, "property", name=name, value=str(value))
+        self.xunit.last_testcase.insert(0, properties)
+
+        record = {"time": round(time.time()), "commit": commit, "sim": cocotb.SIM_NAME,
+                  "test": ".".join([test.__module__, test.__qualname__]),
+                  "shard": os.environ.get("RANDOM_SHARD", ""),
+                  "pass": None if outcome is None else self.failures == failures}
+        record.update(metrics)
+        with open(HISTORY, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    RegressionManager._record_result = telemetry_record_result
+
+def load_history(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def accept(path):
+    with open(path, "a") as f:
+        f.write(json.dumps({"accept": True, "time": time.time(), "commit": git_commit()}) + "\n")
+
+# Returns a description of each test whose latest run regressed against the
+# median of up to window runs before it.  Only passing runs are compared, and
+# only with runs on the same simulator and random test shard.  The random
+# tests' cycles vary a little with the seed, set RANDOM_SEED for exact runs.
+# At an accept marker only the latest run of each test is kept.
+def compare(records, cycles_threshold, wall_threshold, window, metrics=METRICS):
+    runs = {}
+    for record in records:
+        if record.get("accept"):
+            runs = {key: test_runs[-1:] for key, test_runs in runs.items()}
+        elif record["pass"]:
+            runs.setdefault((record["test"], record["sim"], record["shard"]), []).append(record)
+
+    regressions = []
+    for (test, sim, _), test_runs in sorted(runs.items()):
+        latest = test_runs[-1]
+        previous = test_runs[-window - 1:-1]
+        if not previous:
+            continue
+        for metric, threshold in (("sim_cycles", cycles_threshold), ("wall_time_s", wall_threshold)):
+            if metric not in metrics:
+                continue
+            base = statistics.median(r[metric] for r in previous)
+            if base > 0 and 100 * (latest[metric] - base) / base > threshold:
+                regressions.append("{} ({}): {} {} vs median {} of {} runs ({:+.1f}%)".format(
+                    test, sim, metric, latest[metric], base, len(previous), 100 * (latest[metric] - base) / base))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the test telemetry history for slowdowns")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    check = subparsers.add_parser("compare")
+    check.add_argument("--history", default=HISTORY)
+    check.add_argument("--cycles-threshold", type=float, default=2, help="Percent increase in sim cycles to flag")
+    check.add_argument("--wall-threshold", type=float, default=25, help="Percent increase in wall time to flag")
+    check.add_argument("--window", type=int, default=5, help="Number of previous runs to take the median of")
+    check.add_argument("--metric", choices=METRICS, action="append", help="Only check this metric, may be repeated")
+    accept_parser = subparsers.add_parser("accept", help="Accept the latest runs as the baseline for later runs")
+    accept_parser.add_argument("--history", default=HISTORY)
+    args = parser.parse_args()
+
+    if args.command == "accept":
+        accept(args.history)
+        return 0
+
+    regressions = compare(load_history(args.history), args.cycles_threshold, args.wall_threshold, args.window,
+                          args.metric or METRICS)
+    for line in regressions:
+        print("Regressed: " + line)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
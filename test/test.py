@@ -1,11 +1,16 @@
 # SPDX-FileCopyrightText: © 2024 Michael Bell
 # SPDX-License-Identifier: MIT
 
+import functools
+import itertools
+import os
 import random
+import time
 
 import cocotb
+import cocotb.utils
 from cocotb.clock import Clock
-from cocotb.triggers import ClockCycles, Timer
+from cocotb.triggers import ClockCycles, Timer, First, RisingEdge, FallingEdge
 
 # This hack because it isn't easy to install requirements in the TT GitHub actions
 try:
@@ -16,182 +21,162 @@ except ImportError:
     subprocess.check_call([sys.executable, "-m", "pip", "install", "riscv-model"])
     from riscvmodel.insn import *
 
+try:
+    import numpy as np
+except ImportError:
+    import sys
+    import subprocess
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "numpy"])
+    import numpy as np
+
 from riscvmodel.regnames import x0, x1, sp, gp, tp, a0, a1, a2, a3
-from riscvmodel.variant import RV32E
 
 from test_util import reset
+from tinyqv_model import TinyQVModel, RegWriteChecker, GP_VALUE
+from uart_monitor import UartMonitor, DEBUG_UART_BAUD, uart_baud
+from random_corpus import load_cases, save_case, case_path, ddmin
+from qspi_memory import SparseMemory, QspiResponder
+from bus import QspiBus, UartPins, SpiPins, FLASH, RAM_A, RAM_B
+from func_coverage import Coverage, COVERAGE_DIR
+from qspi_trace import QspiTracer, format_report
+from stall_monitor import StallMonitor
+import telemetry
+
+telemetry.install()
+
+# The QSPI protocol checks made while driving the bus by hand.  Set
+# QSPI_INLINE_CHECKS=0 to skip them in fast runs, and check the protocol
+# afterwards from the waveform dump with protocol_check.py.
+INLINE_CHECKS = os.environ.get("QSPI_INLINE_CHECKS", "1") == "1"
+
+def check_qspi(qspi, state=None, **expected):
+    if INLINE_CHECKS:
+        qspi.expect(state, **expected)
 
 select = None
 
+def ram_device(addr):
+    if addr >= 0x1800000:
+        return RAM_B
+    elif addr >= 0x1000000:
+        return RAM_A
+    else:
+        return FLASH
+
 async def start_read(dut, addr):
     global select
+    qspi = QspiBus.of(dut)
 
-    if addr is None:
-        select = dut.qspi_flash_select
-    elif addr >= 0x1800000:
-        select = dut.qspi_ram_b_select
-    elif addr >= 0x1000000:
-        select = dut.qspi_ram_a_select
-    else:
-        select = dut.qspi_flash_select
-    
-    assert select.value == 0
-    assert dut.qspi_flash_select.value == (0 if dut.qspi_flash_select == select else 1)
-    assert dut.qspi_ram_a_select.value == (0 if dut.qspi_ram_a_select == select else 1)
-    assert dut.qspi_ram_b_select.value == (0 if dut.qspi_ram_b_select == select else 1)
-    assert dut.qspi_clk_out.value == 0
-
-    if dut.qspi_flash_select != select:
+    select = FLASH if addr is None else ram_device(addr)
+    check_qspi(qspi, device=select, clk=0)
+
+    if select != FLASH:
         # Command
         cmd = 0x0B
-        assert dut.qspi_data_oe.value == 0xF    # Command
+        check_qspi(qspi, data_oe=0xF)    # Command
         for i in range(2):
-            await ClockCycles(dut.clk, 1, False)
-            assert select.value == 0
-            assert dut.qspi_clk_out.value == 1
-            assert dut.qspi_data_out.value == (cmd & 0xF0) >> 4
-            assert dut.qspi_data_oe.value == 0xF
+            await qspi.falling_edge
+            check_qspi(qspi, selected=select, clk=1, data_out=(cmd & 0xF0) >> 4, data_oe=0xF)
             cmd <<= 4
-            await ClockCycles(dut.clk, 1, False)
-            assert select.value == 0
-            assert dut.qspi_clk_out.value == 0
+            await qspi.falling_edge
+            check_qspi(qspi, selected=select, clk=0)
 
     # Address
-    assert dut.qspi_data_oe.value == 0xF
+    check_qspi(qspi, data_oe=0xF)
     for i in range(6):
-        await ClockCycles(dut.clk, 1, False)
-        assert select.value == 0
-        assert dut.qspi_clk_out.value == 1
+        await qspi.falling_edge
         if addr is not None:
-            assert dut.qspi_data_out.value == (addr >> (20 - i * 4)) & 0xF
-        assert dut.qspi_data_oe.value == 0xF
-        await ClockCycles(dut.clk, 1, False)
-        assert select.value == 0
-        assert dut.qspi_clk_out.value == 0
+            check_qspi(qspi, selected=select, clk=1, data_out=(addr >> (20 - i * 4)) & 0xF, data_oe=0xF)
+        else:
+            check_qspi(qspi, selected=select, clk=1, data_oe=0xF)
+        await qspi.falling_edge
+        check_qspi(qspi, selected=select, clk=0)
 
     # Dummy
-    if dut.qspi_flash_select == select:
+    if select == FLASH:
         for i in range(2):
-            await ClockCycles(dut.clk, 1, False)
-            assert select.value == 0
-            assert dut.qspi_clk_out.value == 1
-            assert dut.qspi_data_oe.value == 0xF
-            assert dut.qspi_data_out.value == 0xA
-            await ClockCycles(dut.clk, 1, False)
-            assert select.value == 0
-            assert dut.qspi_clk_out.value == 0
+            await qspi.falling_edge
+            check_qspi(qspi, selected=select, clk=1, data_oe=0xF, data_out=0xA)
+            await qspi.falling_edge
+            check_qspi(qspi, selected=select, clk=0)
 
     for i in range(4):
-        await ClockCycles(dut.clk, 1, False)
-        assert select.value == 0
-        assert dut.qspi_clk_out.value == 1
-        assert dut.qspi_data_oe.value == 0
-        await ClockCycles(dut.clk, 1, False)
-        assert select.value == 0
-        assert dut.qspi_clk_out.value == 0
+        await qspi.falling_edge
+        check_qspi(qspi, selected=select, clk=1, data_oe=0)
+        await qspi.falling_edge
+        check_qspi(qspi, selected=select, clk=0)
 
 
 async def start_write(dut, addr):
     global select
+    qspi = QspiBus.of(dut)
 
-    if addr >= 0x1800000:
-        select = dut.qspi_ram_b_select
-    else:
-        select = dut.qspi_ram_a_select
-
-    assert select.value == 0
-    assert dut.qspi_flash_select.value == 1
-    assert dut.qspi_ram_a_select.value == (0 if dut.qspi_ram_a_select == select else 1)
-    assert dut.qspi_ram_b_select.value == (0 if dut.qspi_ram_b_select == select else 1)
-    assert dut.qspi_clk_out.value == 0
-    assert dut.qspi_data_oe.value == 0xF
+    select = RAM_B if addr >= 0x1800000 else RAM_A
+    check_qspi(qspi, device=select, clk=0, data_oe=0xF)
 
     # Command
     cmd = 0x02
     for i in range(2):
-        await ClockCycles(dut.clk, 1, False)
-        assert select.value == 0
-        assert dut.qspi_clk_out.value == 1
-        assert dut.qspi_data_out.value == (cmd & 0xF0) >> 4
-        assert dut.qspi_data_oe.value == 0xF
+        await qspi.falling_edge
+        check_qspi(qspi, selected=select, clk=1, data_out=(cmd & 0xF0) >> 4, data_oe=0xF)
         cmd <<= 4
-        await ClockCycles(dut.clk, 1, False)
-        assert select.value == 0
-        assert dut.qspi_clk_out.value == 0
+        await qspi.falling_edge
+        check_qspi(qspi, selected=select, clk=0)
 
     # Address
     for i in range(6):
-        await ClockCycles(dut.clk, 1, False)
-        assert select.value == 0
-        assert dut.qspi_clk_out.value == 1
-        assert dut.qspi_data_out.value == (addr >> (20 - i * 4)) & 0xF
-        assert dut.qspi_data_oe.value == 0xF
-        await ClockCycles(dut.clk, 1, False)
-        assert select.value == 0
-        assert dut.qspi_clk_out.value == 0
+        await qspi.falling_edge
+        check_qspi(qspi, selected=select, clk=1, data_out=(addr >> (20 - i * 4)) & 0xF, data_oe=0xF)
+        await qspi.falling_edge
+        check_qspi(qspi, selected=select, clk=0)
 
 
 nibble_shift_order = [4, 0, 12, 8, 20, 16, 28, 24]
 
 async def send_instr(dut, data, ok_to_exit=False):
+    qspi = QspiBus.of(dut)
     instr_len = 8 if (data & 3) == 3 else 4
     for i in range(instr_len):
-        dut.qspi_data_in.value = (data >> (nibble_shift_order[i])) & 0xF
-        await ClockCycles(dut.clk, 1, False)
+        qspi.data_in.value = (data >> (nibble_shift_order[i])) & 0xF
+        await qspi.falling_edge
         for _ in range(20):
-            if ok_to_exit and dut.qspi_flash_select.value == 1:
+            state = qspi.sample(oe=INLINE_CHECKS)
+            if ok_to_exit and state.flash_select == 1:
                 return
-            assert dut.qspi_flash_select.value == 0
-            if dut.qspi_clk_out.value == 0:
-                await ClockCycles(dut.clk, 1, False)
+            check_qspi(qspi, state, flash_select=0)
+            if state.clk == 0:
+                await qspi.falling_edge
             else:
                 break
-        assert dut.qspi_clk_out.value == 1
-        assert dut.qspi_data_oe.value == 0
-        await ClockCycles(dut.clk, 1, False)
-        assert dut.qspi_clk_out.value == 0
+        else:
+            state = qspi.sample(oe=INLINE_CHECKS)
+        check_qspi(qspi, state, clk=1, data_oe=0)
+        await qspi.falling_edge
+        state = qspi.sample(oe=False)
+        check_qspi(qspi, state, clk=0)
         if i != instr_len - 1:
-            if ok_to_exit and dut.qspi_flash_select.value == 1:
+            if ok_to_exit and state.flash_select == 1:
                 return
-            assert dut.qspi_flash_select.value == 0
-
-async def expect_load(dut, addr, val):
-    if addr >= 0x1800000:
-        select = dut.qspi_ram_b_select
-    elif addr >= 0x1000000:
-        select = dut.qspi_ram_a_select
-    else:
-        assert False # Load from flash not currently supported in this test
+            check_qspi(qspi, state, flash_select=0)
 
+async def wait_ram_select(dut, select):
+    # Feed nops until the RAM access starts
+    qspi = QspiBus.of(dut)
     for i in range(12):
-        if select.value == 0:
-            await start_read(dut, addr)
-            dut.qspi_data_in.value = (val >> (nibble_shift_order[0])) & 0xF
-            for j in range(1,8):
-                await ClockCycles(dut.clk, 1, False)
-                if select.value != 0:
-                    assert j in (3, 5)
-                    break
-                assert select.value == 0
-                assert dut.qspi_clk_out.value == 1
-                assert dut.qspi_data_oe.value == 0
-                await ClockCycles(dut.clk, 1, False)
-                if select.value != 0:
-                    assert j in (2, 4)
-                    break
-                assert dut.qspi_clk_out.value == 0
-                dut.qspi_data_in.value = (val >> (nibble_shift_order[j])) & 0xF
-            break
-        elif dut.qspi_flash_select.value == 0:
+        state = qspi.sample(oe=False)
+        if state.select(select) == 0:
+            return
+        elif state.flash_select == 0:
             await send_instr(dut, 0x0001, True)
         else:
-            await ClockCycles(dut.clk, 1, False)
-    else:
-        assert False
+            await qspi.falling_edge
+    assert False
 
+async def restart_flash_read(dut):
+    qspi = QspiBus.of(dut)
     for i in range(8):
         await ClockCycles(dut.clk, 1)
-        if dut.qspi_flash_select.value == 0:
+        if qspi.sample(oe=False).flash_select == 0:
             if hasattr(dut.user_project, "i_tinyqv"):
                 await start_read(dut, dut.user_project.i_tinyqv.instr_addr.value.integer * 2)
             else:
@@ -200,13 +185,71 @@ async def expect_load(dut, addr, val):
     else:
         assert False
 
-async def load_reg(dut, reg, value):
-    offset = random.randint(-0x400, 0x3FF)
-    instr = InstructionLW(reg, gp, offset).encode()
-    await send_instr(dut, instr)
-
-    await expect_load(dut, 0x1000400 + offset, value)
-
+async def expect_load(dut, addr, val):
+    qspi = QspiBus.of(dut)
+    select = ram_device(addr)
+    assert select != FLASH # Load from flash not currently supported in this test
+
+    await wait_ram_select(dut, select)
+    await start_read(dut, addr)
+    qspi.data_in.value = (val >> (nibble_shift_order[0])) & 0xF
+    for j in range(1,8):
+        await qspi.falling_edge
+        state = qspi.sample(oe=INLINE_CHECKS)
+        if state.select(select) != 0:
+            assert j in (3, 5)
+            break
+        check_qspi(qspi, state, selected=select, clk=1, data_oe=0)
+        await qspi.falling_edge
+        state = qspi.sample(oe=False)
+        if state.select(select) != 0:
+            assert j in (2, 4)
+            break
+        check_qspi(qspi, state, clk=0)
+        qspi.data_in.value = (val >> (nibble_shift_order[j])) & 0xF
+
+    await restart_flash_read(dut)
+
+
+### Instruction injection ###
+
+# While an Injector is active the testbench serves flash reads from its
+# inject_mem, so whole programs can be written in one go instead of being
+# sent an instruction at a time.
+class Injector:
+    def __init__(self, dut):
+        self.dut = dut
+        self.size = len(dut.inject_mem)
+        self.end = 0
+        self.idle_end = 0
+        dut.inject_end.value = 0
+        dut.inject_error.value = 0
+        dut.inject_en.value = 1
+
+    def stop(self):
+        self.dut.inject_en.value = 0
+
+    def append(self, instrs):
+        for instr in instrs:
+            for halfword in ((instr & 0xFFFF, instr >> 16) if (instr & 3) == 3 else (instr,)):
+                if self.end >= self.size:
+                    # Not a failure of the design, so not an AssertionError
+                    raise RuntimeError("Injector memory full")
+                self.dut.inject_mem[self.end].value = halfword
+                self.end += 1
+        self.dut.inject_end.value = self.end
+
+    # Wait for the CPU to reach the end of the injected instructions
+    async def wait_idle(self):
+        max_cycles = 1000 + 50 * (self.end - self.idle_end)
+        await ClockCycles(self.dut.clk, 1)
+        if self.dut.inject_idle.value.binstr != "1":
+            await First(RisingEdge(self.dut.inject_idle), ClockCycles(self.dut.clk, max_cycles))
+        assert self.dut.inject_idle.value.binstr == "1", "Injected program did not complete"
+        assert self.dut.inject_error.value == 0
+        self.idle_end = self.end
+
+injector = None
 
 send_nops = True
 nop_task = None
@@ -226,69 +269,36 @@ async def stop_nops():
     await nop_task
 
 async def read_byte(dut, reg, expected_val):
+  debug_uart = UartMonitor(dut, dut.debug_uart_tx, DEBUG_UART_BAUD)
   await send_instr(dut, InstructionSW(tp, reg, 0x18).encode())
 
   start_nops(dut)
-  for i in range(80):
-      if dut.debug_uart_tx.value == 0:
-          break
-      else:
-          await Timer(5, "ns")
-  assert dut.debug_uart_tx.value == 0
-  bit_time = 250
-  await Timer(bit_time / 2, "ns")
-  assert dut.debug_uart_tx.value == 0
-  for i in range(8):
-      await Timer(bit_time, "ns")
-      assert dut.debug_uart_tx.value == (expected_val & 1)
-      expected_val >>= 1
-  await Timer(bit_time, "ns")
-  assert dut.debug_uart_tx.value == 1
+  assert await debug_uart.get_byte(timeout_ns=3000) == expected_val & 0xFF
+  debug_uart.stop()
 
   await stop_nops()
 
 async def expect_store(dut, addr):
-    if addr >= 0x1800000:
-        select = dut.qspi_ram_b_select
-    elif addr >= 0x1000000:
-        select = dut.qspi_ram_a_select
-    else:
-        assert False
+    qspi = QspiBus.of(dut)
+    select = ram_device(addr)
+    assert select != FLASH
 
     val = 0
-    for i in range(12):
-        if select.value == 0:
-            await start_write(dut, addr)
-            for j in range(8):
-                await ClockCycles(dut.clk, 1, False)
-                assert select.value == 0
-                assert dut.qspi_clk_out.value == 1
-                assert dut.qspi_data_oe.value == 0xF
-                val |= dut.qspi_data_out.value << (nibble_shift_order[j])
-                await ClockCycles(dut.clk, 1, False)
-                assert select.value == (1 if j == 7 else 0)
-                assert dut.qspi_clk_out.value == 0
-            await ClockCycles(dut.clk, 1, False)
-            assert select.value == 1
-            break
-        elif dut.qspi_flash_select.value == 0:
-            await send_instr(dut, 0x0001, True)
-        else:
-            await ClockCycles(dut.clk, 1, False)
-    else:
-        assert False
-
-    for i in range(8):
-        await ClockCycles(dut.clk, 1)
-        if dut.qspi_flash_select.value == 0:
-            if hasattr(dut.user_project, "i_tinyqv"):
-                await start_read(dut, dut.user_project.i_tinyqv.instr_addr.value.integer * 2)
-            else:
-                await start_read(dut, None)
-            break
-    else:
-        assert False
-
+    await wait_ram_select(dut, select)
+    await start_write(dut, addr)
+    for j in range(8):
+        await qspi.falling_edge
+        state = qspi.sample(oe=INLINE_CHECKS)
+        check_qspi(qspi, state, selected=select, clk=1, data_oe=0xF)
+        val |= state.data_out << (nibble_shift_order[j])
+        await qspi.falling_edge
+        state = qspi.sample(oe=False)
+        check_qspi(qspi, state, clk=0)
+        assert not INLINE_CHECKS or state.select(select) == (1 if j == 7 else 0)
+    await qspi.falling_edge
+    assert not INLINE_CHECKS or qspi.sample(oe=False).select(select) == 1
+
+    await restart_flash_read(dut)
     return val
 
 async def read_reg(dut, reg):
@@ -317,36 +327,38 @@ async def test_start(dut):
     await send_instr(dut, InstructionADDI(i+8, x0, 0x102*i).encode())
 
   # Test UART TX
+  uart = UartPins.of(dut)
+  spi = SpiPins.of(dut)
   uart_byte = 0x54
   await send_instr(dut, InstructionADDI(x1, x0, uart_byte).encode())
   await send_instr(dut, InstructionSW(tp, x1, 0x10).encode())
 
   start_nops(dut)
-  bit_time = 8680
-  await Timer(bit_time / 2, "ns")
-  assert dut.uart_tx.value == 0
+  bit_time = round(1e9 / uart_baud(dut))
+  await Timer(bit_time // 2, "ns")
+  uart.expect(tx=0)
   for i in range(8):
       await Timer(bit_time, "ns")
-      assert dut.uart_tx.value == (uart_byte & 1)
+      uart.expect(tx=uart_byte & 1)
       uart_byte >>= 1
   await Timer(bit_time, "ns")
-  assert dut.uart_tx.value == 1
+  uart.expect(tx=1)
 
   # Test UART RX
   for j in range(10):
-    assert dut.uart_rts.value == 0
+    uart.expect(rts=0)
     uart_rx_byte = random.randint(0, 255)
     val = uart_rx_byte
-    dut.uart_rx.value = 0
+    uart.rx.value = 0
     await Timer(bit_time, "ns")
     for i in range(8):
-        dut.uart_rx.value = val & 1
+        uart.rx.value = val & 1
         await Timer(bit_time, "ns")
-        assert dut.uart_rts.value == 1
+        uart.expect(rts=1)
         val >>= 1
-    dut.uart_rx.value = 1
+    uart.rx.value = 1
     await Timer(bit_time, "ns")
-    assert dut.uart_rts.value == 1
+    uart.expect(rts=1)
 
     await stop_nops()
 
@@ -354,7 +366,7 @@ async def test_start(dut):
     await read_byte(dut, x1, 0x2)
     await send_instr(dut, InstructionLW(x1, tp, 0x10).encode())
     await read_byte(dut, x1, uart_rx_byte)
-    assert dut.uart_rts.value == 0
+    uart.expect(rts=0)
     await send_instr(dut, InstructionLW(x1, tp, 0x14).encode())
     await read_byte(dut, x1, 0)
 
@@ -374,31 +386,27 @@ async def test_start(dut):
   await send_instr(dut, InstructionSW(tp, x1, 0x20).encode())
 
   start_nops(dut)
-  assert dut.spi_cs == 1
+  spi.expect(cs=1)
   for i in range(20):
     await ClockCycles(dut.clk, 1)
-    if dut.spi_cs == 0:
+    if spi.sample().cs == 0:
         break
 
   # Default divider is 2
   divider = 2
   for i in range(8):
-      assert dut.spi_cs == 0
-      assert dut.spi_sck == 0
-      assert dut.spi_mosi.value == (1 if (spi_byte & 0x80) else 0)
+      spi.expect(cs=0, sck=0, mosi=(1 if (spi_byte & 0x80) else 0))
       await ClockCycles(dut.clk, divider)
-      assert dut.spi_cs == 0
-      assert dut.spi_sck == 1
-      dut.spi_miso.value = (1 if (spi_byte_in & 0x80) else 0)
-      assert dut.spi_mosi.value == (1 if (spi_byte & 0x80) else 0)
+      spi.expect(cs=0, sck=1)
+      spi.miso.value = (1 if (spi_byte_in & 0x80) else 0)
+      spi.expect(mosi=(1 if (spi_byte & 0x80) else 0))
       await ClockCycles(dut.clk, divider)
       spi_byte <<= 1
       spi_byte_in <<= 1
 
-  assert dut.spi_sck == 0
-  assert dut.spi_cs.value == 0
+  spi.expect(sck=0, cs=0)
   await ClockCycles(dut.clk, divider)
-  assert dut.spi_cs.value == 1
+  spi.expect(cs=1)
 
   await stop_nops()  
 
@@ -417,27 +425,24 @@ async def test_start(dut):
     await send_instr(dut, InstructionSW(tp, x1, 0x20).encode())
 
     start_nops(dut)
-    assert dut.spi_cs == 1
+    spi.expect(cs=1)
     for i in range(20):
         await ClockCycles(dut.clk, 1)
-        if dut.spi_cs == 0:
+        if spi.sample().cs == 0:
             break
 
     for i in range(8):
-        assert dut.spi_cs == 0
-        assert dut.spi_sck == 0
-        assert dut.spi_mosi.value == (1 if (spi_byte & 0x80) else 0)
+        spi.expect(cs=0, sck=0, mosi=(1 if (spi_byte & 0x80) else 0))
         await ClockCycles(dut.clk, divider)
-        assert dut.spi_cs == 0
-        assert dut.spi_sck == 1
-        dut.spi_miso.value = (1 if (spi_byte_in & 0x80) else 0)
-        assert dut.spi_mosi.value == (1 if (spi_byte & 0x80) else 0)
+        spi.expect(cs=0, sck=1)
+        spi.miso.value = (1 if (spi_byte_in & 0x80) else 0)
+        spi.expect(mosi=(1 if (spi_byte & 0x80) else 0))
         await ClockCycles(dut.clk, divider)
         spi_byte <<= 1
         spi_byte_in <<= 1
 
     await ClockCycles(dut.clk, divider)
-    assert dut.spi_cs.value == 1
+    spi.expect(cs=1)
 
     await stop_nops()  
     await send_instr(dut, InstructionLW(x1, tp, 0x20).encode())
@@ -499,7 +504,9 @@ async def test_load_bug(dut):
   await reset(dut)
 
   input_byte = 0b01101000
-  dut.ui_in.value = input_byte
+  dut.ui_in_base.value = input_byte
+  UartPins.of(dut).rx.value = input_byte >> 7
+  SpiPins.of(dut).miso.value = (input_byte >> 2) & 1
 
   def encode_clwsp(reg, base_reg, imm):
     scrambled = (((imm << (12 - 5)) & 0b1000000000000) |
@@ -525,40 +532,376 @@ async def test_load_bug(dut):
 
 
 ### Random operation testing ###
-reg = [0] * 16
 
-# Each Op does reg[d] = fn(a, b)
-# fn will access reg global array
+# The programs are built up front, computing the expected results by
+# executing each instruction on the reference model, and then run through the
+# instruction injector with the RAM served by a QspiResponder.  The model's
+# loads and stores use model_memory, which must match the responder's memory
+# at the end of each program.  If the register write checker is available the
+# results are checked as the instructions retire, otherwise the registers are
+# stored to RAM at the end of each test and checked there.
+model = TinyQVModel()
+model_memory = SparseMemory()
+checker = None
+responder = None
+
+def add_instr(program, instr, debug=False):
+    retired = model.execute(instr, model_memory.read_int)
+    access = retired.access
+    if access is not None and access.store:
+        model_memory.write_int(access.addr, access.size, access.value)
+    if debug: print("{} {:08x}: x{} = {}".format(retired.name, instr, retired.rd, retired.value))
+    if checker is not None:
+        checker.expect(retired)
+    program.append((instr, access))
+
+def add_set_reg(program, rd, value):
+    add_instr(program, InstructionLUI(rd, (value + 0x800) >> 12).encode())
+    add_instr(program, InstructionADDI(rd, rd, ((value + 0x800) & 0xFFF) - 0x800).encode())
+
+def in_ram(addr):
+    return 0x1000000 <= addr <= 0x1fffffc
+
+async def run_program(dut, program):
+    start = len(responder.ram_transactions)
+    injector.append(instr for instr, _ in program)
+    await injector.wait_idle()
+    responder.check()
+    if checker is not None:
+        checker.check()
+
+    accesses = [access for _, access in program if access is not None]
+    transactions = responder.ram_transactions[start:]
+    for access, transaction in zip(accesses, transactions):
+        assert transaction.write == access.store and transaction.addr == access.addr, \
+            "Expected {} at {:x}, got {} at {:x}".format("store" if access.store else "load", access.addr,
+                                                         "store" if transaction.write else "load", transaction.addr)
+        if access.store:
+            assert int.from_bytes(transaction.data[:access.size], "little") == access.value
+    assert len(transactions) == len(accesses), "{} RAM accesses, expected {}".format(len(transactions), len(accesses))
+
+    addr = responder.memory.compare(model_memory)
+    assert addr is None, "RAM differs from model at {:x}".format(addr)
+
+# The registers are read back when there is no register write checker, or
+# with RANDOM_READBACK=1.  The checker only sees the values written, so the
+# read back also catches a write to the wrong register that is not read again.
+READBACK = os.environ.get("RANDOM_READBACK", "0") == "1"
+
+async def check_random_test(dut, debug):
+    if checker is not None:
+        await checker.drain()
+        if not READBACK:
+            return
+    program = []
+    for i in range(16):
+        add_instr(program, InstructionSW(gp, i, 4 * i).encode())
+    await run_program(dut, program)
+    for i in range(16):
+        reg_value = responder.memory.read_int(GP_VALUE + 4 * i, 4)
+        if debug: print("Reg x{} = {} should be {}".format(i, reg_value, model.reg[i]))
+        assert reg_value == model.reg[i], "x{} is {:08x}, expected {:08x}".format(i, reg_value, model.reg[i])
+
+def start_checker(dut, debug):
+    global checker
+    model.reset()
+    if checker is not None:
+        checker.stop()
+    if RegWriteChecker.available(dut):
+        checker = RegWriteChecker(dut, debug)
+    else:
+        checker = None
+
+# Reset into a clean state, with the injector serving the flash and the
+# responder the RAM
+async def start_random_tests(dut, debug):
+    global injector, responder
+
+    # The injector must be enabled before the first flash read after reset
+    injector = Injector(dut)
+    if responder is not None:
+        responder.stop()
+    responder = QspiResponder(dut, SparseMemory())
+    await reset(dut)
+    start_checker(dut, debug)
+
+# Directed generation: one instruction for each immediate edge value and
+# access alignment not yet covered (up to half the instructions), the rest
+# with ops weighted by how many of their bins are still to be hit.  Returns
+# the op index of each instruction, and the immediates and access offsets
+# forced at given instructions.
+def directed_ops(rng, ops, num_instrs, coverage):
+    targets = []
+    weights = np.ones(len(ops))
+    for i, op in enumerate(ops):
+        imms, offsets = coverage.op_holes(op.name)
+        targets += [(i, imm, None) for imm in imms] + [(i, None, offset) for offset in offsets]
+        weights[i] += len(imms) + len(offsets) + (coverage.bins["op"][op.name] == 0)
+    if len(targets) > num_instrs // 2:
+        targets = [targets[k] for k in rng.choice(len(targets), num_instrs // 2, replace=False)]
+
+    op_idx = np.concatenate([np.array([t[0] for t in targets], dtype=np.int64),
+                             rng.choice(len(ops), num_instrs - len(targets), p=weights / weights.sum())])
+    order = rng.permutation(num_instrs)
+    pos = np.argsort(order)
+    forced_imm = {int(pos[k]): imm for k, (_, imm, _) in enumerate(targets) if imm is not None}
+    forced_offset = {int(pos[k]): offset for k, (_, _, offset) in enumerate(targets) if offset is not None}
+    return op_idx[order], forced_imm, forced_offset
+
+# Generate a random case (see random_corpus.py) for a seed.  The operands of
+# each op are drawn in one go for all the instructions using that op, and the
+# encodings are memoised, so this is cheap even for long programs.
+# If coverage is given the case is directed at its holes.
+def generate_random_case(name, ops, seed, num_instrs, coverage=None):
+    rng = np.random.default_rng(seed)
+    regs = [i for i in range(1, 16) if i not in (gp, tp)]
+    values = rng.integers(-0x80000000, 0x80000000, len(regs))
+    offsets = rng.integers(-0x400, 0x400, len(regs))
+
+    if coverage is None:
+        op_idx = rng.integers(0, len(ops), num_instrs)
+        forced_imm = forced_offset = {}
+    else:
+        op_idx, forced_imm, forced_offset = directed_ops(rng, ops, num_instrs, coverage)
+    fields = {f: np.zeros(num_instrs, dtype=np.int64) for f in ("rd", "rs1", "arg2", "base_reg", "addr")}
+    for i, op in enumerate(ops):
+        selected = np.flatnonzero(op_idx == i)
+        for f, values_for_op in op.draw(rng, len(selected)).items():
+            fields[f][selected] = values_for_op
+    for i, imm in forced_imm.items():
+        fields["arg2"][i] = imm
+
+    # Base register values that steer memory accesses into RAM
+    mem_op = np.array([op.is_mem_op for op in ops])[op_idx]
+    imm = fields["arg2"]
+    fields["addr"][mem_op] = rng.integers(0x1000000 - imm[mem_op], 0x1fffffd - imm[mem_op])
+    for i, offset in forced_offset.items():
+        fields["addr"][i] -= (fields["addr"][i] + imm[i] - offset) & 3
+        if fields["addr"][i] + imm[i] < 0x1000000:
+            fields["addr"][i] += 4
+
+    items = []
+    for i in range(num_instrs):
+        op = ops[op_idx[i]]
+        rd, rs1, arg2 = int(fields["rd"][i]), int(fields["rs1"][i]), int(fields["arg2"][i])
+        dest, srcs = op.regs(rd, rs1, arg2)
+        items.append({
+            "name": "x{} = x{} {} {}".format(rd, rs1, arg2, op.name),
+            "instr": encode_op(op, rd, rs1, arg2),
+            "base_reg": int(fields["base_reg"][i]) if op.is_mem_op else None,
+            "imm": arg2 if op.imm_range() is not None else None,
+            "addr": int(fields["addr"][i]) if op.is_mem_op else None,
+            "set_base": i in forced_offset,
+            "op": op.name,
+            "kind": op.kind,
+            "dest": dest,
+            "srcs": srcs,
+        })
+
+    return {"test": name, "seed": seed,
+            "regs": [[reg, int(value), int(offset)] for reg, value, offset in zip(regs, values, offsets)],
+            "items": items}
+
+@functools.lru_cache(maxsize=None)
+def encode_op(op, rd, rs1, arg2):
+    return op.encode(rd, rs1, arg2)
+
+# Memory ops only set their base register if it doesn't already point at RAM,
+# or if set_base is set because the access offset was chosen by directed
+# generation.  The items run are recorded in coverage if given.
+async def run_random_case(dut, case, items, debug, coverage=None):
+    model_memory.clear()
+    responder.memory.clear()
+
+    program = []
+    for reg, value, offset in case["regs"]:
+        if debug: print("Set reg {} to {}".format(reg, value))
+        for memory in (model_memory, responder.memory):
+            memory.write_int(GP_VALUE + offset, 4, value)
+        add_instr(program, InstructionLW(reg, gp, offset).encode())
+
+    prev = None
+    for item in items:
+        addr = None
+        if item["addr"] is not None:
+            if item.get("set_base") or not in_ram(model.reg[item["base_reg"]] + item["imm"]):
+                add_set_reg(program, item["base_reg"], item["addr"])
+                prev = None
+            addr = model.reg[item["base_reg"]] + item["imm"]
+        if coverage is not None:
+            coverage.sample(item, addr, prev)
+        if debug: print(item["name"])
+        add_instr(program, item["instr"], debug)
+        prev = item
+
+    await run_program(dut, program)
+    await check_random_test(dut, debug)
+
+# Shrink a failing case to a short reproducer, replaying each candidate
+# from reset.  RANDOM_MINIMISE_RUNS limits the number of replays.
+async def minimise_random_case(dut, case, debug):
+    async def fails(items):
+        await start_random_tests(dut, debug)
+        try:
+            await run_random_case(dut, case, items, debug)
+        except AssertionError:
+            return True
+        return False
+
+    max_runs = int(os.environ.get("RANDOM_MINIMISE_RUNS", "200"))
+    return await ddmin(case["items"], fails, max_runs)
+
+# The random tests can be split across simulator runs: RANDOM_SHARD=i/n runs
+# the i'th of n blocks of seeds.  All shards must use the same RANDOM_SEED.
+def random_shard():
+    shard = os.environ.get("RANDOM_SHARD")
+    if not shard:
+        return 0, 1
+    return tuple(int(x) for x in shard.split("/"))
+
+def random_test_range(num_tests):
+    index, count = random_shard()
+    return range(num_tests * index // count, num_tests * (index + 1) // count)
+
+# Directed generation and budgets are set from the environment:
+#   RANDOM_DIRECTED=1       direct the generated programs at coverage holes
+#   RANDOM_COVERAGE_TARGET  stop once this percentage of coverage bins is hit
+#   RANDOM_WALL_BUDGET      stop after this many seconds of wall time
+#   RANDOM_SIM_BUDGET       stop after this many microseconds of sim time
+# With a budget set, the tests run until the first budget is reached instead
+# of for a fixed number of seeds, with the shards taking alternate seeds.
+class RandomBudget:
+    def __init__(self):
+        self.directed = os.environ.get("RANDOM_DIRECTED", "0") == "1"
+        self.coverage_target = float(os.environ.get("RANDOM_COVERAGE_TARGET", "0")) or None
+        self.wall_time = float(os.environ.get("RANDOM_WALL_BUDGET", "0")) or None
+        self.sim_time = float(os.environ.get("RANDOM_SIM_BUDGET", "0")) * 1000 or None
+        self.start()
+
+    def start(self):
+        self.start_wall = time.monotonic()
+        self.start_sim = cocotb.utils.get_sim_time("ns")
+
+    def is_set(self):
+        return (self.coverage_target, self.wall_time, self.sim_time) != (None, None, None)
+
+    def tests(self, num_tests):
+        if not self.is_set():
+            return random_test_range(num_tests)
+        index, count = random_shard()
+        return itertools.count(index, count)
+
+    # Returns why the budget is used up, or None
+    def reached(self, coverage):
+        if self.coverage_target is not None and coverage.percent() >= self.coverage_target:
+            return "coverage {:.1f}%".format(coverage.percent())
+        if self.wall_time is not None and time.monotonic() - self.start_wall >= self.wall_time:
+            return "wall time {:.0f}s".format(time.monotonic() - self.start_wall)
+        sim_time = cocotb.utils.get_sim_time("ns") - self.start_sim
+        if self.sim_time is not None and sim_time >= self.sim_time:
+            return "sim time {:.0f}us".format(sim_time / 1000)
+        return None
+
+# Cases saved in the corpus are replayed first (by the first shard only).
+# A failing seed is saved to the corpus, then minimised and saved again.
+# The functional coverage of the cases run is saved to COVERAGE_DIR.  If
+# QSPI_TRACE is set to a directory, a trace of the QSPI bus is saved there.
+# STALL_BREAKDOWN=1 logs where the core's cycles went.
+async def run_random_tests(dut, name, ops, num_tests, num_instrs, seed, debug):
+    global injector, responder
+
+    coverage = Coverage(ops)
+    budget = RandomBudget()
+    tracer = QspiTracer(dut) if os.environ.get("QSPI_TRACE") else None
+    stalls = None
+    if os.environ.get("STALL_BREAKDOWN", "0") == "1" and StallMonitor.available(dut):
+        stalls = StallMonitor(dut)
+    try:
+        # Each case runs from reset, with the injector memory empty, as when
+        # it is replayed
+        if random_shard()[0] == 0:
+            for case in load_cases(name):
+                dut._log.info("Replaying {}".format(case_path(case)))
+                await start_random_tests(dut, debug)
+                await run_random_case(dut, case, case["items"], debug, coverage)
+
+        budget.start()
+        for n, test in enumerate(budget.tests(num_tests)):
+            reason = budget.reached(coverage)
+            if reason is not None:
+                dut._log.info("Stopping after {} seeds: {}".format(n, reason))
+                break
+            dut._log.info("Running test with seed {}".format(seed + test))
+            case = generate_random_case(name, ops, seed + test, num_instrs, coverage if budget.directed else None)
+            await start_random_tests(dut, debug)
+            try:
+                await run_random_case(dut, case, case["items"], debug, coverage)
+            except AssertionError:
+                dut._log.error("Seed {} failed, saved to {}, minimising".format(seed + test, save_case(case)))
+                case["items"] = await minimise_random_case(dut, case, debug)
+                save_case(case)
+                dut._log.error("Reproducer with {} instructions saved to {}:\n{}".format(
+                    len(case["items"]), case_path(case), "\n".join(item["name"] for item in case["items"])))
+                raise
+    finally:
+        if injector is not None:
+            injector.stop()
+            injector = None
+        if responder is not None:
+            responder.stop()
+            responder = None
+
+        path = os.path.join(COVERAGE_DIR, "{}_{}_{}.json".format(name, seed, random_shard()[0]))
+        coverage.save(path)
+        dut._log.info("Coverage saved to {}:\n{}".format(path, coverage.report()))
+
+        if stalls is not None:
+            stalls.stop()
+            dut._log.info("Cycles of {}: {}".format(name, stalls.report()))
+
+        if tracer is not None:
+            tracer.stop()
+            os.makedirs(os.environ["QSPI_TRACE"], exist_ok=True)
+            path = os.path.join(os.environ["QSPI_TRACE"], "{}_{}_{}.npy".format(name, seed, random_shard()[0]))
+            tracer.save(path)
+            dut._log.info("QSPI trace saved to {}:\n{}".format(path, format_report(tracer.report())))
+
+# Each op draws the operands for n instances at once, returning arrays of
+# rd, rs1 and arg2, and for memory ops the base_reg.
+# encode must only depend on its arguments so that it can be memoised.
+# For coverage, kind is alu, load or store, imm_range gives the range of an
+# immediate arg2 (None if arg2 is a register) and regs gives the register
+# written (or None) and the registers read.
 class SimpleOp:
-    def __init__(self, rvm_insn, fn, name):
+    def __init__(self, rvm_insn, name):
         self.rvm_insn = rvm_insn
-        self.fn = fn
         self.name = name
         self.is_mem_op = False
+        self.kind = "alu"
 
-    def randomize(self):
-        self.rvm_insn_inst = self.rvm_insn()
-        self.rvm_insn_inst.randomize(variant=RV32E)
-    
-    def execute_fn(self, rd, rs1, arg2):
-        if rd != 0 and rd != 3 and rd != 4:
-            reg[rd] = self.fn(rs1, arg2)
-            while reg[rd] < -0x80000000: reg[rd] += 0x100000000
-            while reg[rd] > 0x7FFFFFFF:  reg[rd] -= 0x100000000
+    def draw(self, rng, n):
+        if issubclass(self.rvm_insn, InstructionRType):
+            arg2 = rng.integers(0, 16, n)
+        elif issubclass(self.rvm_insn, InstructionISType):
+            arg2 = rng.integers(0, 32, n)
+        else:
+            arg2 = rng.integers(-0x800, 0x800, n)
+        return {"rd": rng.integers(0, 16, n), "rs1": rng.integers(0, 16, n), "arg2": arg2}
 
     def encode(self, rd, rs1, arg2):
         return self.rvm_insn(rd, rs1, arg2).encode()
-    
-    def get_valid_rd(self):
-        return random.randint(0, 15)
 
-    def get_valid_rs1(self):
-        return random.randint(0, 15)
+    def imm_range(self):
+        if issubclass(self.rvm_insn, InstructionRType):
+            return None
+        elif issubclass(self.rvm_insn, InstructionISType):
+            return 0, 31
+        return -0x800, 0x7ff
 
-    def get_valid_arg2(self):
-        return (random.randint(0, 15) if issubclass(self.rvm_insn, InstructionRType) else 
-                self.rvm_insn_inst.shamt.value if issubclass(self.rvm_insn, InstructionISType) else
-                self.rvm_insn_inst.imm.value)
+    def regs(self, rd, rs1, arg2):
+        if issubclass(self.rvm_insn, InstructionRType):
+            return rd, [rs1, arg2]
+        return rd, [rs1]
 
 def encode_ci(reg, imm, opcode):
     scrambled = (((imm << (12 - 5)) & 0b1000000000000) |
@@ -623,102 +966,84 @@ def encode_cand(dest_reg, src_reg):
     return encode_ca(dest_reg, src_reg, 0x8C61)
 
 class CIOp:
-    def __init__(self, encoder, min_rs1, min_imm, fn, name):
+    def __init__(self, encoder, min_rs1, min_imm, name):
         self.encoder = encoder
-        self.fn = fn
         self.name = name
         self.min_rs1 = min_rs1
         self.min_imm = min_imm
         self.is_mem_op = False
+        self.kind = "alu"
 
-    def randomize(self):
-        self.rs1 = random.randint(self.min_rs1, 15)
-        self.imm = random.randint(self.min_imm, 31)
-    
-    def execute_fn(self, rd, rs1, arg2):
-        if rd != 0 and rd != 3 and rd != 4:
-            reg[rd] = self.fn(rs1, arg2)
-            while reg[rd] < -0x80000000: reg[rd] += 0x100000000
-            while reg[rd] > 0x7FFFFFFF:  reg[rd] -= 0x100000000
+    def draw(self, rng, n):
+        rs1 = rng.integers(self.min_rs1, 16, n)
+        return {"rd": rs1, "rs1": rs1, "arg2": rng.integers(self.min_imm, 32, n)}
 
     def encode(self, rd, rs1, arg2):
         return self.encoder(rs1, arg2)
-    
-    def get_valid_rd(self):
-        return self.rs1
 
-    def get_valid_rs1(self):
-        return self.rs1
+    def imm_range(self):
+        return self.min_imm, 31
 
-    def get_valid_arg2(self):
-        return self.imm
+    def regs(self, rd, rs1, arg2):
+        return rs1, [] if self.encoder is encode_cli else [rs1]
 
 class CROp:
-    def __init__(self, encoder, min_reg, fn, name):
+    def __init__(self, encoder, min_reg, name):
         self.encoder = encoder
-        self.fn = fn
         self.name = name
         self.min_reg = min_reg
         self.is_mem_op = False
+        self.kind = "alu"
 
-    def randomize(self):
-        self.rs1 = random.randint(self.min_reg, 15)
-        self.rs2 = random.randint(self.min_reg, 15)
-    
-    def execute_fn(self, rd, rs1, arg2):
-        if rd != 0 and rd != 3 and rd != 4:
-            reg[rd] = self.fn(rs1, arg2)
-            while reg[rd] < -0x80000000: reg[rd] += 0x100000000
-            while reg[rd] > 0x7FFFFFFF:  reg[rd] -= 0x100000000
+    def draw(self, rng, n):
+        rs1 = rng.integers(self.min_reg, 16, n)
+        return {"rd": rs1, "rs1": rs1, "arg2": rng.integers(self.min_reg, 16, n)}
 
     def encode(self, rd, rs1, arg2):
         return self.encoder(rs1, arg2)
-    
-    def get_valid_rd(self):
-        return self.rs1
 
-    def get_valid_rs1(self):
-        return self.rs1
+    def imm_range(self):
+        return None
 
-    def get_valid_arg2(self):
-        return self.rs2
+    def regs(self, rd, rs1, arg2):
+        return rs1, [arg2] if self.encoder is encode_cmv else [rs1, arg2]
 
 ops_alu = [
-    SimpleOp(InstructionADDI, lambda rs1, imm: reg[rs1] + imm, "+i"),
-    SimpleOp(InstructionADD, lambda rs1, rs2: reg[rs1] + reg[rs2], "+"),
-    SimpleOp(InstructionSUB, lambda rs1, rs2: reg[rs1] - reg[rs2], "-"),
-    SimpleOp(InstructionANDI, lambda rs1, imm: reg[rs1] & imm, "&i"),
-    SimpleOp(InstructionAND, lambda rs1, rs2: reg[rs1] & reg[rs2], "&"),
-    SimpleOp(InstructionORI, lambda rs1, imm: reg[rs1] | imm, "|i"),
-    SimpleOp(InstructionOR, lambda rs1, rs2: reg[rs1] | reg[rs2], "|"),
-    SimpleOp(InstructionXORI, lambda rs1, imm: reg[rs1] ^ imm, "^i"),
-    SimpleOp(InstructionXOR, lambda rs1, rs2: reg[rs1] ^ reg[rs2], "^"),
-    SimpleOp(InstructionSLTI, lambda rs1, imm: 1 if reg[rs1] < imm else 0, "<i"),
-    SimpleOp(InstructionSLT, lambda rs1, rs2: 1 if reg[rs1] < reg[rs2] else 0, "<"),
-    SimpleOp(InstructionSLTIU, lambda rs1, imm: 1 if (reg[rs1] & 0xFFFFFFFF) < (imm & 0xFFFFFFFF) else 0, "<iu"),
-    SimpleOp(InstructionSLTU, lambda rs1, rs2: 1 if (reg[rs1] & 0xFFFFFFFF) < (reg[rs2] & 0xFFFFFFFF) else 0, "<u"),
-    SimpleOp(InstructionSLLI, lambda rs1, imm: reg[rs1] << imm, "<<i"),
-    SimpleOp(InstructionSLL, lambda rs1, rs2: reg[rs1] << (reg[rs2] & 0x1F), "<<"),
-    SimpleOp(InstructionSRLI, lambda rs1, imm: (reg[rs1] & 0xFFFFFFFF) >> imm, ">>li"),
-    SimpleOp(InstructionSRL, lambda rs1, rs2: (reg[rs1] & 0xFFFFFFFF) >> (reg[rs2] & 0x1F), ">>l"),
-    SimpleOp(InstructionSRAI, lambda rs1, imm: reg[rs1] >> imm, ">>i"),
-    SimpleOp(InstructionSRA, lambda rs1, rs2: reg[rs1] >> (reg[rs2] & 0x1F), ">>"),
-    CIOp(encode_cli, 1, -32, lambda rs1, imm: imm, "=i(c)"),
-    CIOp(encode_caddi, 1, -32, lambda rs1, imm: reg[rs1] + imm, "+i(c)"),
-    CIOp(encode_cslli, 1, 0, lambda rs1, imm: reg[rs1] << imm, "<<i(c)"),
-    CIOp(encode_csrli, 8, 0, lambda rs1, imm: (reg[rs1] & 0xFFFFFFFF) >> imm, ">>li(c)"),
-    CIOp(encode_csrai, 8, 0, lambda rs1, imm: reg[rs1] >> imm, ">>li(c)"),
-    CIOp(encode_candi, 8, -32, lambda rs1, imm: reg[rs1] & imm, "&i(c)"),
-    CIOp(encode_cnot, 8, 0, lambda rs1, imm: ~(reg[rs1] & 0xFFFFFFFF), "~(c)"),
-    CIOp(encode_czext_b, 8, 0, lambda rs1, imm: reg[rs1] & 0xFF, "zb(c)"),
-    CIOp(encode_czext_h, 8, 0, lambda rs1, imm: reg[rs1] & 0xFFFF, "zh(c)"),
-    CROp(encode_cmv, 1, lambda rs1, rs2: reg[rs2], "=(c)"),
-    CROp(encode_cadd, 1, lambda rs1, rs2: reg[rs1] + reg[rs2], "+(c)"),
-    CROp(encode_cmul16, 1, lambda rs1, rs2: reg[rs1] * (reg[rs2] & 0xFFFF), "*(c)"),
-    CROp(encode_csub, 8, lambda rs1, rs2: reg[rs1] - reg[rs2], "-(c)"),
-    CROp(encode_cxor, 8, lambda rs1, rs2: reg[rs1] ^ reg[rs2], "^(c)"),
-    CROp(encode_cor, 8, lambda rs1, rs2: reg[rs1] | reg[rs2], "|(c)"),
-    CROp(encode_cand, 8, lambda rs1, rs2: reg[rs1] & reg[rs2], "&(c)"),
+    SimpleOp(InstructionADDI, "+i"),
+    SimpleOp(InstructionADD, "+"),
+    SimpleOp(InstructionSUB, "-"),
+    SimpleOp(InstructionANDI, "&i"),
+    SimpleOp(InstructionAND, "&"),
+    SimpleOp(InstructionORI, "|i"),
+    SimpleOp(InstructionOR, "|"),
+    SimpleOp(InstructionXORI, "^i"),
+    SimpleOp(InstructionXOR, "^"),
+    SimpleOp(InstructionSLTI, "<i"),
+    SimpleOp(InstructionSLT, "<"),
+    SimpleOp(InstructionSLTIU, "<iu"),
+    SimpleOp(InstructionSLTU, "<u"),
+    SimpleOp(InstructionSLLI, "<<i"),
+    SimpleOp(InstructionSLL, "<<"),
+    SimpleOp(InstructionSRLI, ">>li"),
+    SimpleOp(InstructionSRL, ">>l"),
+    SimpleOp(InstructionSRAI, ">>i"),
+    SimpleOp(InstructionSRA, ">>"),
+    CIOp(encode_cli, 1, -32, "=i(c)"),
+    CIOp(encode_caddi, 1, -32, "+i(c)"),
+    CIOp(encode_cslli, 1, 0, "<<i(c)"),
+    CIOp(encode_csrli, 8, 0, ">>li(c)"),
+    CIOp(encode_csrai, 8, 0, ">>i(c)"),
+    CIOp(encode_candi, 8, -32, "&i(c)"),
+    CIOp(encode_cnot, 8, 0, "~(c)"),
+    CIOp(encode_czext_b, 8, 0, "zb(c)"),
+    CIOp(encode_czext_h, 8, 0, "zh(c)"),
+    CROp(encode_cmv, 1, "=(c)"),
+    CROp(encode_cadd, 1, "+(c)"),
+    CROp(encode_cmul16, 1, "*(c)"),
+    CROp(encode_csub, 8, "-(c)"),
+    CROp(encode_cxor, 8, "^(c)"),
+    CROp(encode_cor, 8, "|(c)"),
+    CROp(encode_cand, 8, "&(c)"),
 ]
 
 @cocotb.test()
@@ -728,57 +1053,10 @@ async def test_random_alu(dut):
     clock = Clock(dut.clk, 15.624, units="ns")
     cocotb.start_soon(clock.start())
 
-    # Reset
-    await reset(dut)
-
-    # Should start reading flash after 1 cycle
-    await ClockCycles(dut.clk, 1)
-    await start_read(dut, 0)
-    
     seed = random.randint(0, 0xFFFFFFFF)
     #seed = 1508125843
     debug = False
-    for test in range(50):
-        random.seed(seed + test)
-        dut._log.info("Running test with seed {}".format(seed + test))
-        for i in range(1, 16):
-            if i == 3: reg[i] = 0x1000400
-            elif i == 4: reg[i] = 0x8000000
-            else:
-                reg[i] = random.randint(-0x80000000, 0x7FFFFFFF)
-                if debug: print("Set reg {} to {}".format(i, reg[i]))
-                await load_reg(dut, i, reg[i])
-
-        if False:
-            for i in range(16):
-                reg_value = (await read_reg(dut, i)).signed_integer
-                if debug: print("Reg {} is {}".format(i, reg_value))
-                assert reg_value == reg[i]
-
-        last_instr = ops_alu[0]
-        for i in range(200):
-            while True:
-                try:
-                    instr = random.choice(ops_alu)
-                    instr.randomize()
-                    rd = instr.get_valid_rd()
-                    rs1 = instr.get_valid_rs1()
-                    arg2 = instr.get_valid_arg2()
-
-                    instr.execute_fn(rd, rs1, arg2)
-                    break
-                except ValueError:
-                    pass
-
-            if debug: print("x{} = x{} {} {}, now {} {:08x}".format(rd, rs1, arg2, instr.name, reg[rd], instr.encode(rd, rs1, arg2)))
-            await send_instr(dut, instr.encode(rd, rs1, arg2))
-            #if debug:
-            #    assert await read_reg(dut, rd) == reg[rd] & 0xFFFFFFFF
-
-        for i in range(16):
-            reg_value = (await read_reg(dut, i))
-            if debug: print("Reg x{} = {} should be {}".format(i, reg_value, reg[i]))
-            assert reg_value & 0xFFFFFFFF == reg[i] & 0xFFFFFFFF
+    await run_random_tests(dut, "test_random_alu", ops_alu, 50, 200, seed, debug)
 
 def encode_clw(reg, base_reg, imm):
     scrambled = (((imm << (10 - 3)) & 0b1110000000000) |
@@ -799,85 +1077,56 @@ def encode_lbu(reg, base_reg, imm):
                     ((imm << (6 - 0)) & 0b1000000))
     return 0x8000 | scrambled | ((base_reg - 8) << 7) | ((reg - 8) << 2)
 
-async def set_reg(dut, rd, value):
-    await send_instr(dut, InstructionLUI(rd, (value + 0x800) >> 12).encode())
-    await send_instr(dut, InstructionADDI(rd, rd, ((value + 0x800) & 0xFFF) - 0x800).encode())
-    reg[rd] = value
-
 class CLoadOp:
-    def __init__(self, encoder, min_imm, max_imm, imm_mul, fn, name):
+    def __init__(self, encoder, min_imm, max_imm, imm_mul, name):
         self.encoder = encoder
-        self.fn = fn
         self.name = name
         self.is_mem_op = True
+        self.kind = "load"
         self.min_imm = min_imm
         self.max_imm = max_imm
         self.imm_mul = imm_mul
 
-    def randomize(self):
-        self.rd = random.randint(8, 15)
-        self.base_reg = random.randint(8, 15)
-        self.imm = random.randint(self.min_imm, self.max_imm) * self.imm_mul
-        self.val = random.randint(-0x80000000, 0x7fffffff)
-
-    def execute_fn(self, rd, rs1, arg2):
-        if rd != 0 and rd != 3 and rd != 4:
-            reg[rd] = self.fn(self.val)
+    def draw(self, rng, n):
+        base_reg = rng.integers(8, 16, n)
+        return {"rd": rng.integers(8, 16, n), "rs1": base_reg, "base_reg": base_reg,
+                "arg2": rng.integers(self.min_imm, self.max_imm + 1, n) * self.imm_mul}
 
     def encode(self, rd, rs1, arg2):
         return self.encoder(rd, rs1, arg2)
-    
-    def get_valid_rd(self):
-        return self.rd
 
-    def get_valid_rs1(self):
-        return self.base_reg
+    def imm_range(self):
+        return self.min_imm * self.imm_mul, self.max_imm * self.imm_mul
+
+    def regs(self, rd, rs1, arg2):
+        return rd, [rs1]
 
-    def get_valid_arg2(self):
-        return self.imm
-    
-    async def do_mem_op(self, dut, addr):
-        #print("Load {} from addr {:08x}".format(self.val, addr))
-        await expect_load(dut, addr, self.val)
+# Registers usable as the base of a memory access
+base_regs = np.array([i for i in range(1, 16) if i not in (gp, tp)])
 
 class LoadOp:
-    def __init__(self, instr, min_imm, max_imm, imm_mul, fn, name):
+    def __init__(self, instr, min_imm, max_imm, imm_mul, name):
         self.instr = instr
-        self.fn = fn
         self.name = name
         self.is_mem_op = True
+        self.kind = "load"
         self.min_imm = min_imm
         self.max_imm = max_imm
         self.imm_mul = imm_mul
 
-    def randomize(self):
-        self.rd = random.randint(0, 15)
-        while True:
-            self.base_reg = random.randint(1, 15)
-            if self.base_reg not in (gp, tp):
-                break
-        self.imm = random.randint(self.min_imm, self.max_imm) * self.imm_mul
-        self.val = random.randint(-0x80000000, 0x7fffffff)
-
-    def execute_fn(self, rd, rs1, arg2):
-        if rd != 0 and rd != 3 and rd != 4:
-            reg[rd] = self.fn(self.val)
+    def draw(self, rng, n):
+        base_reg = rng.choice(base_regs, n)
+        return {"rd": rng.integers(0, 16, n), "rs1": base_reg, "base_reg": base_reg,
+                "arg2": rng.integers(self.min_imm, self.max_imm + 1, n) * self.imm_mul}
 
     def encode(self, rd, rs1, arg2):
         return self.instr(rd, rs1, arg2).encode()
-    
-    def get_valid_rd(self):
-        return self.rd
 
-    def get_valid_rs1(self):
-        return self.base_reg
+    def imm_range(self):
+        return self.min_imm * self.imm_mul, self.max_imm * self.imm_mul
 
-    def get_valid_arg2(self):
-        return self.imm
-    
-    async def do_mem_op(self, dut, addr):
-        #print("Load {} from addr {:08x}".format(self.val, addr))
-        await expect_load(dut, addr, self.val)
+    def regs(self, rd, rs1, arg2):
+        return rd, [rs1]
 
 def encode_csw(base_reg, reg, imm):
     scrambled = (((imm << (10 - 3)) & 0b1110000000000) |
@@ -886,126 +1135,75 @@ def encode_csw(base_reg, reg, imm):
     return 0xC000 | scrambled | ((base_reg - 8) << 7) | ((reg - 8) << 2)
 
 class CStoreOp:
-    def __init__(self, encoder, min_imm, max_imm, imm_mul, fn, name):
+    def __init__(self, encoder, min_imm, max_imm, imm_mul, name):
         self.encoder = encoder
-        self.fn = fn
         self.name = name
         self.is_mem_op = True
+        self.kind = "store"
         self.min_imm = min_imm
         self.max_imm = max_imm
         self.imm_mul = imm_mul
 
-    def randomize(self):
-        self.rs1 = random.randint(8, 15)
-        while True:
-            self.base_reg = random.randint(8, 15)
-            if self.base_reg != self.rs1:
-                break
-        self.imm = random.randint(self.min_imm, self.max_imm) * self.imm_mul
-
-    def execute_fn(self, rd, rs1, arg2):
-        pass
+    # rd is the base register, rs1 the register stored, which must differ
+    def draw(self, rng, n):
+        rs1 = rng.integers(8, 16, n)
+        base_reg = 8 + (rs1 - 8 + rng.integers(1, 8, n)) % 8
+        return {"rd": base_reg, "rs1": rs1, "base_reg": base_reg,
+                "arg2": rng.integers(self.min_imm, self.max_imm + 1, n) * self.imm_mul}
 
     def encode(self, rd, rs1, arg2):
-        return self.encoder(self.base_reg, self.rs1, arg2)
-    
-    def get_valid_rd(self):
-        return self.base_reg
+        return self.encoder(rd, rs1, arg2)
 
-    def get_valid_rs1(self):
-        return self.rs1
+    def imm_range(self):
+        return self.min_imm * self.imm_mul, self.max_imm * self.imm_mul
 
-    def get_valid_arg2(self):
-        return self.imm
-    
-    async def do_mem_op(self, dut, addr):
-        #print("Load {} from addr {:08x}".format(self.val, addr))
-        assert await expect_store(dut, addr) == self.fn(self.rs1)
+    # The base register is passed as rd
+    def regs(self, rd, rs1, arg2):
+        return None, [rd, rs1]
 
 class StoreOp:
-    def __init__(self, instr, min_imm, max_imm, imm_mul, fn, name):
+    def __init__(self, instr, min_imm, max_imm, imm_mul, name):
         self.instr = instr
-        self.fn = fn
         self.name = name
         self.is_mem_op = True
+        self.kind = "store"
         self.min_imm = min_imm
         self.max_imm = max_imm
         self.imm_mul = imm_mul
 
-    def randomize(self):
-        self.rs1 = random.randint(0, 15)
-        while True:
-            self.base_reg = random.randint(1, 15)
-            if self.base_reg not in (self.rs1, gp, tp):
-                break
-        self.imm = random.randint(self.min_imm, self.max_imm) * self.imm_mul
-
-    def execute_fn(self, rd, rs1, arg2):
-        pass
+    # rd is the base register, rs1 the register stored, which must differ
+    def draw(self, rng, n):
+        rs1 = rng.integers(0, 16, n)
+        base_reg = rng.choice(base_regs, n)
+        clash = base_reg == rs1
+        while clash.any():
+            base_reg[clash] = rng.choice(base_regs, clash.sum())
+            clash = base_reg == rs1
+        return {"rd": base_reg, "rs1": rs1, "base_reg": base_reg,
+                "arg2": rng.integers(self.min_imm, self.max_imm + 1, n) * self.imm_mul}
 
     def encode(self, rd, rs1, arg2):
-        return self.instr(self.base_reg, self.rs1, arg2).encode()
-    
-    def get_valid_rd(self):
-        return self.base_reg
-
-    def get_valid_rs1(self):
-        return self.rs1
-
-    def get_valid_arg2(self):
-        return self.imm
-    
-    async def do_mem_op(self, dut, addr):
-        #print("Load {} from addr {:08x}".format(self.val, addr))
-        assert await expect_store(dut, addr) == self.fn(self.rs1)
-
-ops = [
-    SimpleOp(InstructionADDI, lambda rs1, imm: reg[rs1] + imm, "+i"),
-    SimpleOp(InstructionADD, lambda rs1, rs2: reg[rs1] + reg[rs2], "+"),
-    SimpleOp(InstructionSUB, lambda rs1, rs2: reg[rs1] - reg[rs2], "-"),
-    SimpleOp(InstructionANDI, lambda rs1, imm: reg[rs1] & imm, "&i"),
-    SimpleOp(InstructionAND, lambda rs1, rs2: reg[rs1] & reg[rs2], "&"),
-    SimpleOp(InstructionORI, lambda rs1, imm: reg[rs1] | imm, "|i"),
-    SimpleOp(InstructionOR, lambda rs1, rs2: reg[rs1] | reg[rs2], "|"),
-    SimpleOp(InstructionXORI, lambda rs1, imm: reg[rs1] ^ imm, "^i"),
-    SimpleOp(InstructionXOR, lambda rs1, rs2: reg[rs1] ^ reg[rs2], "^"),
-    SimpleOp(InstructionSLTI, lambda rs1, imm: 1 if reg[rs1] < imm else 0, "<i"),
-    SimpleOp(InstructionSLT, lambda rs1, rs2: 1 if reg[rs1] < reg[rs2] else 0, "<"),
-    SimpleOp(InstructionSLTIU, lambda rs1, imm: 1 if (reg[rs1] & 0xFFFFFFFF) < (imm & 0xFFFFFFFF) else 0, "<iu"),
-    SimpleOp(InstructionSLTU, lambda rs1, rs2: 1 if (reg[rs1] & 0xFFFFFFFF) < (reg[rs2] & 0xFFFFFFFF) else 0, "<u"),
-    SimpleOp(InstructionSLLI, lambda rs1, imm: reg[rs1] << imm, "<<i"),
-    SimpleOp(InstructionSLL, lambda rs1, rs2: reg[rs1] << (reg[rs2] & 0x1F), "<<"),
-    SimpleOp(InstructionSRLI, lambda rs1, imm: (reg[rs1] & 0xFFFFFFFF) >> imm, ">>li"),
-    SimpleOp(InstructionSRL, lambda rs1, rs2: (reg[rs1] & 0xFFFFFFFF) >> (reg[rs2] & 0x1F), ">>l"),
-    SimpleOp(InstructionSRAI, lambda rs1, imm: reg[rs1] >> imm, ">>i"),
-    SimpleOp(InstructionSRA, lambda rs1, rs2: reg[rs1] >> (reg[rs2] & 0x1F), ">>"),
-    CIOp(encode_cli, 1, -32, lambda rs1, imm: imm, "=i(c)"),
-    CIOp(encode_caddi, 1, -32, lambda rs1, imm: reg[rs1] + imm, "+i(c)"),
-    CIOp(encode_cslli, 1, 0, lambda rs1, imm: reg[rs1] << imm, "<<i(c)"),
-    CIOp(encode_csrli, 8, 0, lambda rs1, imm: (reg[rs1] & 0xFFFFFFFF) >> imm, ">>li(c)"),
-    CIOp(encode_csrai, 8, 0, lambda rs1, imm: reg[rs1] >> imm, ">>li(c)"),
-    CIOp(encode_candi, 8, -32, lambda rs1, imm: reg[rs1] & imm, "&i(c)"),
-    CIOp(encode_cnot, 8, 0, lambda rs1, imm: ~(reg[rs1] & 0xFFFFFFFF), "~(c)"),
-    CIOp(encode_czext_b, 8, 0, lambda rs1, imm: reg[rs1] & 0xFF, "zb(c)"),
-    CIOp(encode_czext_h, 8, 0, lambda rs1, imm: reg[rs1] & 0xFFFF, "zh(c)"),
-    CROp(encode_cmv, 1, lambda rs1, rs2: reg[rs2], "=(c)"),
-    CROp(encode_cadd, 1, lambda rs1, rs2: reg[rs1] + reg[rs2], "+(c)"),
-    CROp(encode_cmul16, 1, lambda rs1, rs2: reg[rs1] * (reg[rs2] & 0xFFFF), "*(c)"),
-    CROp(encode_csub, 8, lambda rs1, rs2: reg[rs1] - reg[rs2], "-(c)"),
-    CROp(encode_cxor, 8, lambda rs1, rs2: reg[rs1] ^ reg[rs2], "^(c)"),
-    CROp(encode_cor, 8, lambda rs1, rs2: reg[rs1] | reg[rs2], "|(c)"),
-    CROp(encode_cand, 8, lambda rs1, rs2: reg[rs1] & reg[rs2], "&(c)"),
-    CLoadOp(encode_clw, 0, 31, 4, lambda val: val, "lw(c)"),
-    CLoadOp(encode_lh, 0, 1, 2, lambda val: (val & 0xFFFF) - 0x10000 if (val & 0x8000) != 0 else val & 0xFFFF, "lh(c)"),
-    CLoadOp(encode_lhu, 0, 1, 2, lambda val: val & 0xFFFF, "lhu(c)"),
-    CLoadOp(encode_lbu, 0, 3, 1, lambda val: val & 0xFF, "lbu(c)"),
-    LoadOp(InstructionLW, -0x800, 0x7ff, 1, lambda val: val, "lw"),
-    LoadOp(InstructionLH, -0x800, 0x7ff, 1, lambda val: (val & 0xFFFF) - 0x10000 if (val & 0x8000) != 0 else val & 0xFFFF, "lh"),
-    LoadOp(InstructionLB, -0x800, 0x7ff, 1, lambda val: (val & 0xFF) - 0x100 if (val & 0x80) != 0 else val & 0xFF, "lb"),
-    LoadOp(InstructionLHU, -0x800, 0x7ff, 1, lambda val: val & 0xFFFF, "lhu"),
-    LoadOp(InstructionLBU, -0x800, 0x7ff, 1, lambda val: val & 0xFF, "lbu"),
-    CStoreOp(encode_csw, 0, 31, 4, lambda rs1: reg[rs1] & 0xFFFFFFFF, "sw(c)"),
-    StoreOp(InstructionSW, -0x800, 0x7ff, 1, lambda rs1: reg[rs1] & 0xFFFFFFFF, "sw"),
+        return self.instr(rd, rs1, arg2).encode()
+
+    def imm_range(self):
+        return self.min_imm * self.imm_mul, self.max_imm * self.imm_mul
+
+    # The base register is passed as rd
+    def regs(self, rd, rs1, arg2):
+        return None, [rd, rs1]
+
+ops = ops_alu + [
+    CLoadOp(encode_clw, 0, 31, 4, "lw(c)"),
+    CLoadOp(encode_lh, 0, 1, 2, "lh(c)"),
+    CLoadOp(encode_lhu, 0, 1, 2, "lhu(c)"),
+    CLoadOp(encode_lbu, 0, 3, 1, "lbu(c)"),
+    LoadOp(InstructionLW, -0x800, 0x7ff, 1, "lw"),
+    LoadOp(InstructionLH, -0x800, 0x7ff, 1, "lh"),
+    LoadOp(InstructionLB, -0x800, 0x7ff, 1, "lb"),
+    LoadOp(InstructionLHU, -0x800, 0x7ff, 1, "lhu"),
+    LoadOp(InstructionLBU, -0x800, 0x7ff, 1, "lbu"),
+    CStoreOp(encode_csw, 0, 31, 4, "sw(c)"),
+    StoreOp(InstructionSW, -0x800, 0x7ff, 1, "sw"),
 ]
 
 @cocotb.test()
@@ -1015,60 +1213,7 @@ async def test_random(dut):
     clock = Clock(dut.clk, 15.624, units="ns")
     cocotb.start_soon(clock.start())
 
-    # Reset
-    await reset(dut)
-
-    # Should start reading flash after 1 cycle
-    await ClockCycles(dut.clk, 1)
-    await start_read(dut, 0)
-    
     seed = random.randint(0, 0xFFFFFFFF)
     #seed = 1508125843
     debug = False
-    for test in range(10):
-        random.seed(seed + test)
-        dut._log.info("Running test with seed {}".format(seed + test))
-        for i in range(1, 16):
-            if i == 3: reg[i] = 0x1000400
-            elif i == 4: reg[i] = 0x8000000
-            else:
-                reg[i] = random.randint(-0x80000000, 0x7FFFFFFF)
-                if debug: print("Set reg {} to {}".format(i, reg[i]))
-                await load_reg(dut, i, reg[i])
-
-        if False:
-            for i in range(16):
-                reg_value = (await read_reg(dut, i)).signed_integer
-                if debug: print("Reg {} is {}".format(i, reg_value))
-                assert reg_value == reg[i]
-
-        last_instr = ops[0]
-        for i in range(1000):
-            while True:
-                try:
-                    instr = random.choice(ops)
-                    instr.randomize()
-                    rd = instr.get_valid_rd()
-                    rs1 = instr.get_valid_rs1()
-                    arg2 = instr.get_valid_arg2()
-
-                    if instr.is_mem_op:
-                        addr = random.randint(0x1000000-instr.imm, 0x1fffffc-instr.imm)
-                        await set_reg(dut, instr.base_reg, addr)
-
-                    instr.execute_fn(rd, rs1, arg2)
-                    break
-                except ValueError:
-                    pass
-
-            if debug: print("x{} = x{} {} {}, now {} {:08x}".format(rd, rs1, arg2, instr.name, reg[rd], instr.encode(rd, rs1, arg2)))
-            await send_instr(dut, instr.encode(rd, rs1, arg2))
-            if instr.is_mem_op:
-                await instr.do_mem_op(dut, addr + instr.imm)
-            #if debug:
-            #    assert await read_reg(dut, rd) == reg[rd] & 0xFFFFFFFF
-
-        for i in range(16):
-            reg_value = (await read_reg(dut, i))
-            if debug: print("Reg x{} = {} should be {}".format(i, reg_value, reg[i]))
-            assert reg_value & 0xFFFFFFFF == reg[i] & 0xFFFFFFFF
+    await run_random_tests(dut, "test_random", ops, 10, 1000, seed, debug)
@@ -0,0 +1,6 @@
+# Runs the benchmark kernels in kernels.py at each QSPI latency, see
+# test_bench.py for the options
+PROG_FILE = 
+MODULE = test_bench
+
+include test_prog.mk
@@ -0,0 +1,136 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Benchmarks the kernels in kernels.py on tb_qspi at each QSPI latency,
+# reporting the cycles and instructions retired from reset until the kernel
+# sends its result on the debug UART, and the CPI.
+#
+# Results are written to BENCH_OUTPUT.json and .csv (default bench_results)
+# and compared with bench_baseline.json: the test fails if any kernel takes
+# more than BENCH_TOLERANCE percent (default 1) more cycles than the baseline.
+# Set BENCH_UPDATE_BASELINE=1 (make bench-baseline) to save the results as
+# the new baseline.  A missing baseline fails the test when
+# BENCH_REQUIRE_BASELINE=1.
+# BENCH_LATENCIES selects the latencies, e.g. "1,3", default 1 to 5.
+# Set QSPI_TRACE to a directory to save a QSPI bus trace of each run there,
+# as <kernel>_<latency>.npy, and log its bus utilisation report.
+# Set FETCH_TRACE to a directory to save the instruction fetch and data
+# access stream of each run there, as <kernel>_<latency>.npy, for
+# fetch_sim.py.
+# Set STALL_BREAKDOWN=1 to add the percentage of cycles in each class of
+# stall_monitor.py to the results.
+
+import csv
+import json
+import os
+
+import cocotb
+from cocotb.clock import Clock
+
+from kernels import KERNELS, run_on_model
+from fetch_sim import FetchRecorder
+from qspi_memory import pmod_memory
+from qspi_trace import QspiTracer, format_report
+from stall_monitor import StallMonitor
+from test_util import reset
+from uart_monitor import UartMonitor, DEBUG_UART_BAUD
+import telemetry
+
+telemetry.install()
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT = os.environ.get("BENCH_OUTPUT", os.path.join(TEST_DIR, "bench_results"))
+BASELINE = os.path.join(TEST_DIR, "bench_baseline.json")
+TOLERANCE = float(os.environ.get("BENCH_TOLERANCE", "1"))
+REQUIRE_BASELINE = os.environ.get("BENCH_REQUIRE_BASELINE", "0") == "1"
+LATENCIES = [int(x) for x in os.environ.get("BENCH_LATENCIES", "1,2,3,4,5").split(",")]
+TRACE_DIR = os.environ.get("QSPI_TRACE")
+FETCH_TRACE_DIR = os.environ.get("FETCH_TRACE")
+STALL_BREAKDOWN = os.environ.get("STALL_BREAKDOWN", "0") == "1"
+FIELDS = ("kernel", "latency", "cycles", "instrs", "expected_instrs", "cpi")
+
+def write_results(results):
+    with open(OUTPUT + ".json", "w") as f:
+        json.dump(results, f, indent=1)
+    with open(OUTPUT + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, list(results[0].keys()) if results else FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+# Returns descriptions of the kernels more than TOLERANCE percent slower
+def compare_baseline(dut, results):
+    with open(BASELINE) as f:
+        baseline = {(r["kernel"], r["latency"]): r for r in json.load(f)}
+    regressions = []
+    for r in results:
+        base = baseline.get((r["kernel"], r["latency"]))
+        if base is None:
+            continue
+        change = 100 * (r["cycles"] - base["cycles"]) / base["cycles"]
+        line = "{:14} latency {}: {:8} cycles, baseline {:8} ({:+.1f}%)".format(
+                r["kernel"], r["latency"], r["cycles"], base["cycles"], change)
+        dut._log.info(line)
+        if change > TOLERANCE:
+            regressions.append(line)
+    return regressions
+
+@cocotb.test()
+async def test_bench(dut):
+    clock = Clock(dut.clk, 15.624, units="ns")
+    cocotb.start_soon(clock.start())
+
+    backdoor = pmod_memory(dut)
+    backdoor.start()
+    debug_uart = UartMonitor(dut, dut.debug_uart_tx, DEBUG_UART_BAUD)
+    tracer = None
+    if TRACE_DIR:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        tracer = QspiTracer(dut)
+    stalls = StallMonitor(dut) if STALL_BREAKDOWN and StallMonitor.available(dut) else None
+    recorder = None
+    if FETCH_TRACE_DIR and FetchRecorder.available(dut):
+        os.makedirs(FETCH_TRACE_DIR, exist_ok=True)
+        recorder = FetchRecorder(dut)
+
+    results = []
+    for name, kernel in KERNELS.items():
+        image = kernel().assemble()
+        expected_result, expected_instrs = run_on_model(image)
+        await backdoor.write_flash(image)
+
+        for latency in LATENCIES:
+            await reset(dut, latency)
+            debug_uart.clear()
+            if tracer is not None:
+                tracer.clear()
+            if stalls is not None:
+                stalls.clear()
+            if recorder is not None:
+                recorder.clear()
+            result = await debug_uart.get_byte(timeout_ns=expected_instrs * 100 * (latency + 4))
+            if tracer is not None:
+                tracer.save(os.path.join(TRACE_DIR, "{}_{}.npy".format(name, latency)))
+                dut._log.info("QSPI bus, {} latency {}:\n{}".format(name, latency, format_report(tracer.report())))
+            if recorder is not None:
+                recorder.save(os.path.join(FETCH_TRACE_DIR, "{}_{}.npy".format(name, latency)))
+            assert result == expected_result, "{} returned {:02x}, expected {:02x}".format(name, result, expected_result)
+
+            cycles = dut.bench_cycles.value.integer
+            instrs = dut.bench_instrs.value.integer
+            results.append({"kernel": name, "latency": latency, "cycles": cycles, "instrs": instrs,
+                            "expected_instrs": expected_instrs, "cpi": round(cycles / max(instrs, 1), 3)})
+            dut._log.info("{:14} latency {}: {:8} cycles, {:6} instructions, CPI {:.2f}".format(
+                name, latency, cycles, instrs, cycles / max(instrs, 1)))
+            if stalls is not None:
+                results[-1].update({name + "_percent": percent for name, percent in stalls.breakdown().items()})
+                dut._log.info("{:14} latency {}: {}".format(name, latency, stalls.report()))
+
+    write_results(results)
+    if os.environ.get("BENCH_UPDATE_BASELINE", "0") == "1":
+        with open(BASELINE, "w") as f:
+            json.dump(results, f, indent=1)
+    elif os.path.exists(BASELINE):
+        regressions = compare_baseline(dut, results)
+        assert not regressions, "Slower than baseline:\n" + "\n".join(regressions)
+    else:
+        assert not REQUIRE_BASELINE, "No {}, run make bench-baseline and commit it".format(os.path.basename(BASELINE))
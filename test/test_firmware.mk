@@ -0,0 +1,9 @@
+# Runs every firmware image in FIRMWARE_MANIFEST in one simulation, loading
+# each image into the simulated flash from test_firmware.py
+FIRMWARE_MANIFEST ?= $(PWD)/firmware.json
+export FIRMWARE_MANIFEST
+
+PROG_FILE = 
+MODULE = test_firmware
+
+include test_prog.mk
@@ -0,0 +1,139 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Runs the firmware images listed in a manifest in one simulation of
+# tb_qspi, reloading the flash between them instead of rebuilding.
+# The manifest, FIRMWARE_MANIFEST or firmware.json, is a JSON list of:
+#   {"image": path relative to the manifest, .hex, ELF or binary,
+#    "latency": list of latencies to run at,
+#    "expect": list of strings expected on the UART, in order,
+#    "timeout_ns": timeout for each character,
+#    "symbols": optional ELF or nm symbol map for profiling,
+#    "model_instrs": instructions to run on the reference model, default
+#                    1000000}
+# Each image is also run on the reference model, checking it sends the
+# expected strings.
+#
+# Set PC_PROFILE to a directory to profile each run (see pc_profile.py), the
+# flat profile and collapsed stacks are written there as
+# <image>_<latency>.prof and .folded.  PC_PROFILE_RETIRED=1 counts retired
+# instructions, weighted by stall cycles, instead of every cycle.
+# Set STALL_BREAKDOWN=1 to log where the cycles of each run went (see
+# stall_monitor.py).  Set RAM_SNAPSHOT to a directory to save the contents of
+# RAM A and B after each run there, as <image>_<latency>.ram.
+# If cycle_model.json exists (see cycle_model.py), the cycles each run took
+# to send the expected strings are logged with the model's prediction.
+
+import json
+import os
+
+import cocotb
+from cocotb.clock import Clock
+import cocotb.utils
+from cocotb.regression import TestFactory
+
+import cycle_model
+from kernels import trace_on_model
+from pc_profile import PcProfiler, Symbols
+from qspi_memory import pmod_memory, read_image
+from stall_monitor import StallMonitor
+from test_util import reset
+from uart_monitor import UartMonitor, uart_baud
+import telemetry
+
+telemetry.install()
+
+MANIFEST = os.environ.get("FIRMWARE_MANIFEST",
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), "firmware.json"))
+
+with open(MANIFEST) as f:
+    entries = json.load(f)
+
+CLOCK_PERIOD_NS = 15.624
+PROFILE_DIR = os.environ.get("PC_PROFILE")
+SNAPSHOT_DIR = os.environ.get("RAM_SNAPSHOT")
+
+# Kept between tests so each load erases the whole of the previous image
+backdoor = None
+
+async def run_firmware(dut, entry):
+    global backdoor
+    if backdoor is None:
+        backdoor = pmod_memory(dut)
+
+    clock = Clock(dut.clk, CLOCK_PERIOD_NS, units="ns")
+    cocotb.start_soon(clock.start())
+    backdoor.start()
+    uart = UartMonitor(dut, dut.uart_tx, uart_baud(dut))
+
+    image = os.path.join(os.path.dirname(MANIFEST), entry["image"])
+    dut._log.info(f"Loading {image}")
+    await backdoor.load_flash(image)
+
+    profiler = None
+    if PROFILE_DIR:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        symbols = None
+        if "symbols" in entry:
+            symbols = Symbols.load(os.path.join(os.path.dirname(MANIFEST), entry["symbols"]))
+        profiler = PcProfiler(dut, symbols, retired=os.environ.get("PC_PROFILE_RETIRED", "0") == "1")
+    stalls = None
+    if os.environ.get("STALL_BREAKDOWN", "0") == "1" and StallMonitor.available(dut):
+        stalls = StallMonitor(dut)
+
+    prediction = None
+    if os.path.exists(cycle_model.MODEL_FILE):
+        with open(cycle_model.MODEL_FILE) as f:
+            prediction = json.load(f)
+        counts = cycle_model.output_counts(read_image(image), entry["expect"], entry.get("model_instrs", 1000000))
+
+    for latency in entry["latency"]:
+        await reset(dut, latency)
+        start_time = cocotb.utils.get_sim_time("ns")
+        uart.clear()
+        if profiler is not None:
+            profiler.clear()
+        if stalls is not None:
+            stalls.clear()
+        for s in entry["expect"]:
+            await uart.expect_string(s, timeout_ns=entry["timeout_ns"])
+
+        if prediction is not None:
+            cycles = (cocotb.utils.get_sim_time("ns") - start_time) / CLOCK_PERIOD_NS
+            predicted = cycle_model.predict(prediction, counts, latency)
+            dut._log.info("{} at latency {}: {:.0f} cycles, predicted {:.0f} +/- {}% ({:+.1f}%)".format(
+                image, latency, cycles, predicted, prediction["error_percent"], 100 * (predicted - cycles) / cycles))
+
+        name = "{}_{}".format(os.path.splitext(os.path.basename(image))[0], latency)
+        if SNAPSHOT_DIR:
+            os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+            await backdoor.save_ram(os.path.join(SNAPSHOT_DIR, name + ".ram"))
+        if profiler is not None:
+            base = os.path.join(PROFILE_DIR, name)
+            profiler.write_flat(base + ".prof")
+            profiler.write_collapsed(base + ".folded")
+            dut._log.info("Profile of {} at latency {}:\n{}".format(image, latency, profiler.flat_profile(limit=10)))
+        if stalls is not None:
+            dut._log.info("Cycles of {} at latency {}: {}".format(image, latency, stalls.report()))
+
+factory = TestFactory(run_firmware)
+factory.add_option("entry", entries)
+factory.generate_tests()
+
+# The reference model must run the same images, for the tools built on it
+# (cycle_model.py, fetch_sim.py)
+async def run_firmware_on_model(dut, entry):
+    image = os.path.join(os.path.dirname(MANIFEST), entry["image"])
+    uart = []
+    trace, _ = trace_on_model(read_image(image), entry.get("model_instrs", 1000000), uart)
+    output = bytes(uart).decode("latin-1")
+    dut._log.info("{} ran {} instructions on the model".format(image, len(trace)))
+    pos = 0
+    for s in entry["expect"]:
+        found = output.find(s, pos)
+        assert found >= 0, "Model didn't send {!r} after {!r}".format(s, output[:pos])
+        pos = found + len(s)
+
+factory = TestFactory(run_firmware_on_model)
+factory.add_option("entry", entries)
+factory.generate_tests()
@@ -5,32 +5,13 @@ import random
 
 import cocotb
 from cocotb.clock import Clock
-from cocotb.triggers import ClockCycles, Timer
 
+from qspi_memory import pmod_memory
 from test_util import reset
+from uart_monitor import UartMonitor, uart_baud
+import telemetry
 
-async def receive_string(dut, str):
-    for char in str:
-        dut._log.info(f"Wait for: {char}")
-
-        for _ in range(20000):
-            await ClockCycles(dut.clk, 8)
-            if dut.uart_tx.value == 0:
-                break
-        else:
-            # Should have started by now
-            assert dut.uart_tx.value == 0
-        
-        uart_byte = ord(char)
-        bit_time = 8680
-        await Timer(bit_time / 2, "ns")
-        assert dut.uart_tx.value == 0
-        for i in range(8):
-            await Timer(bit_time, "ns")
-            assert dut.uart_tx.value == (uart_byte & 1)
-            uart_byte >>= 1
-        await Timer(bit_time, "ns")
-        assert dut.uart_tx.value == 1
+telemetry.install()
 
 @cocotb.test()
 async def test_prime(dut):
@@ -39,15 +20,17 @@ async def test_prime(dut):
     # Our example module doesn't use clock and reset, but we show how to use them here anyway.
     clock = Clock(dut.clk, 15.624, units="ns")
     cocotb.start_soon(clock.start())
+    pmod_memory(dut).start()
 
+    uart = UartMonitor(dut, dut.uart_tx, uart_baud(dut))
     await reset(dut, 3)
 
-    await receive_string(dut, "3 ")
-    await receive_string(dut, "5 ")
-    await receive_string(dut, "7 ")
-    await receive_string(dut, "11 ")
-    await receive_string(dut, "13 ")
-    await receive_string(dut, "17 ")
-    await receive_string(dut, "19 ")
-    await receive_string(dut, "23 ")
-    await receive_string(dut, "29 ")
+    await uart.expect_string("3 ", timeout_ns=2_600_000)
+    await uart.expect_string("5 ", timeout_ns=2_600_000)
+    await uart.expect_string("7 ", timeout_ns=2_600_000)
+    await uart.expect_string("11 ", timeout_ns=2_600_000)
+    await uart.expect_string("13 ", timeout_ns=2_600_000)
+    await uart.expect_string("17 ", timeout_ns=2_600_000)
+    await uart.expect_string("19 ", timeout_ns=2_600_000)
+    await uart.expect_string("23 ", timeout_ns=2_600_000)
+    await uart.expect_string("29 ", timeout_ns=2_600_000)
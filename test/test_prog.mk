@@ -3,29 +3,45 @@
 
 # defaults
 SIM ?= icarus
+ifeq ($(SIM),verilator)
+WAVES ?= 0
+else
 WAVES ?= 1
+endif
 TOPLEVEL_LANG ?= verilog
 PROG ?= hello
 PROG_FILE ?= $(PROG).hex
 SRC_DIR = $(PWD)/../src
 PROJECT_SOURCES = project.v tinyQV/cpu/*.v tinyQV/peri/uart/*.v tinyQV/peri/spi/*.v
 
+# With QSPI_MODEL=1 the PMOD's memories are full size and modelled in
+# Python (qspi_memory.ModelPmod), which loads PROG_FILE
+QSPI_MODEL ?= 0
+ifeq ($(QSPI_MODEL),1)
+COMPILE_ARGS += -DQSPI_MODEL
+else
 VERILOG_SOURCES += sim_qspi.v
+endif
 COMPILE_ARGS +=  -DPROG_FILE=\"$(PROG_FILE)\"
+export PROG_FILE
 
 ifneq ($(GATES),yes)
 
 ifneq ($(SYNTH),yes)
 
 # RTL simulation:
-SIM_BUILD				= sim_build/rtl
 VERILOG_SOURCES += $(addprefix $(SRC_DIR)/,$(PROJECT_SOURCES))
 COMPILE_ARGS 		+= -DSIM
 COMPILE_ARGS 		+= -I$(SRC_DIR)
 
+# Run the UART at UART_BIT_RATE instead of 115200 baud, the tests read the
+# rate from the design.  Set UART_BIT_RATE=115200 to test at the real rate.
+UART_BIT_RATE ?= 4000000
+COMPILE_ARGS 		+= -DSIM_UART_BIT_RATE=$(UART_BIT_RATE)
+export UART_BIT_RATE
+
 else
 
-SIM_BUILD				= sim_build/synth
 COMPILE_ARGS    += -DGL_TEST
 COMPILE_ARGS    += -DFUNCTIONAL
 COMPILE_ARGS    += -DSIM
@@ -43,6 +59,7 @@ endif
 else
 
 # Gate level simulation:
+# Built in a fixed directory, the GDS workflow uploads the waves from there
 SIM_BUILD				= sim_build/gl
 COMPILE_ARGS    += -DGL_TEST
 COMPILE_ARGS    += -DFUNCTIONAL
@@ -58,12 +75,30 @@ VERILOG_SOURCES += $(PWD)/gate_level_netlist.v
 
 endif
 
+# Verilator: build a multithreaded model with VERILATOR_THREADS > 1,
+# and write an FST trace to dump.fst with WAVES=1
+ifeq ($(SIM),verilator)
+VERILATOR_THREADS ?= 1
+COMPILE_ARGS    += --threads $(VERILATOR_THREADS)
+BUILD_ARGS      += -j $(VERILATOR_THREADS)
+ifeq ($(WAVES),1)
+EXTRA_ARGS      += --trace-fst --trace-structs
+endif
+endif
+
 # Include the testbench sources:
 VERILOG_SOURCES += $(PWD)/tb_qspi.v 
 TOPLEVEL = tb_qspi
 
+# Build in sim_build/cache/<hash of the build inputs>, so an unchanged
+# simulation is reused instead of rebuilt
+ifndef SIM_BUILD
+SIM_BUILD := $(shell python $(PWD)/sim_cache.py --sim $(SIM) --toplevel $(TOPLEVEL) \
+	--args '$(COMPILE_ARGS) $(EXTRA_ARGS) $(BUILD_ARGS)' $(VERILOG_SOURCES))
+endif
+
 # MODULE is the basename of the Python test file
-MODULE = test_$(PROG)
+MODULE ?= test_$(PROG)
 
 # include cocotb's make rules to take care of the simulator setup
 include $(shell cocotb-config --makefiles)/Makefile.sim
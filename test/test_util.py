@@ -6,9 +6,9 @@ async def reset(dut, latency=1, ui_in=0x80):
   dut._log.info(f"Reset, latency {latency}")
   dut.ena.value = 1
   dut.ui_in_base.value = ui_in
-  dut.uio_in.value = 0
   dut.rst_n.value = 1
   dut.uart_rx.value = 1
+  dut.spi_miso.value = 0
   await ClockCycles(dut.clk, 2)
   dut.rst_n.value = 0
   dut.latency_cfg.value = latency
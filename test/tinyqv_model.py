@@ -0,0 +1,502 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Instruction set reference model for tinyQV: RV32EC plus the Zcb loads/stores
+# and bit ops, and the tinyQV custom instructions (c.mul16, mul16, c.lwtp,
+# c.swtp, and the multiple register loads and stores lw2, lw4, sw2, sw4,
+# sw4rep, c.lw2 and c.sw2).
+# gp and tp are hard wired, writes to x0, gp and tp are discarded.
+#
+# Interrupts are taken by take_interrupt, which the caller runs before each
+# instruction, when an interrupt is enabled in mie and mstatus and its bit is
+# set in mip.  The handler is at INTERRUPT_VECTOR.  The cycle, time and
+# instret counters all read the instructions retired.
+
+from collections import deque, namedtuple
+
+import cocotb
+from cocotb.triggers import ClockCycles, FallingEdge, RisingEdge
+
+GP_VALUE = 0x1000400
+TP_VALUE = 0x8000000
+INTERRUPT_VECTOR = 0x8
+
+MSTATUS, MIE, MEPC, MCAUSE, MIP = 0x300, 0x304, 0x341, 0x342, 0x344
+COUNTERS = (0xC00, 0xC01, 0xC02)
+MSTATUS_MIE, MSTATUS_MPIE = 0x8, 0x80
+
+# A memory access made by an instruction.  For loads value is the data returned
+# by the bus (before sign extension), for stores it is the data written.
+MemAccess = namedtuple("MemAccess", "addr size store value")
+
+# The result of executing one instruction.  rd is None if the instruction does
+# not write a register, value is None if the written value can't be modelled.
+# writes has the further (rd, value) written by lw2, lw4 and c.lw2.
+Retired = namedtuple("Retired", "pc instr name rd value access writes", defaults=((),))
+
+def sign_extend(val, bits):
+    val &= (1 << bits) - 1
+    if val & (1 << (bits - 1)):
+        val -= 1 << bits
+    return val
+
+def bits(val, hi, lo):
+    return (val >> lo) & ((1 << (hi - lo + 1)) - 1)
+
+class TinyQVModel:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pc = 0
+        self.reg = [0] * 16
+        self.reg[3] = GP_VALUE
+        self.reg[4] = TP_VALUE
+        self.csr = dict.fromkeys((MSTATUS, MIE, MEPC, MCAUSE, MIP), 0)
+        self.instret = 0
+
+    # Set or clear an interrupt's bit in mip
+    def set_pending(self, bit, pending=True):
+        if pending:
+            self.csr[MIP] |= 1 << bit
+        else:
+            self.csr[MIP] &= ~(1 << bit)
+
+    # Take the lowest enabled pending interrupt, if any.  Returns whether one
+    # was taken.
+    def take_interrupt(self):
+        pending = self.csr[MIE] & self.csr[MIP]
+        if not pending or not self.csr[MSTATUS] & MSTATUS_MIE:
+            return False
+        bit = (pending & -pending).bit_length() - 1
+        self.csr[MEPC] = self.pc
+        self.csr[MCAUSE] = 0x80000000 | bit
+        self.csr[MSTATUS] = (self.csr[MSTATUS] & ~MSTATUS_MIE) | MSTATUS_MPIE
+        self.pc = INTERRUPT_VECTOR
+        return True
+
+    def read(self, r):
+        if r >= 16:
+            raise ValueError("Register x{} not in RV32E".format(r))
+        return self.reg[r]
+
+    def set_reg(self, r, value):
+        if r not in (0, 3, 4):
+            self.reg[r] = value & 0xFFFFFFFF
+
+    def execute(self, instr, load_data=None):
+        writes = ()
+        if (instr & 3) == 3:
+            name, rd, value, access, next_pc = self._execute32(instr, load_data)
+            size = 4
+        else:
+            name, rd, value, access, next_pc = self._execute16(instr & 0xFFFF, load_data)
+            size = 2
+        if name in ("lw2", "lw4", "c.lw2"):
+            writes = tuple((rd + i, (value >> (32 * i)) & 0xFFFFFFFF) for i in range(1, access.size // 4))
+            value &= 0xFFFFFFFF
+
+        if rd is not None:
+            if rd >= 16:
+                raise ValueError("Register x{} not in RV32E".format(rd))
+            if value is not None:
+                value &= 0xFFFFFFFF
+                self.set_reg(rd, value)
+        for r, v in writes:
+            self.set_reg(r, v)
+
+        retired = Retired(self.pc, instr, name, rd, value, access, writes)
+        self.instret += 1
+        self.pc = (self.pc + size) if next_pc is None else (next_pc & 0xFFFFFFFF)
+        return retired
+
+    # load_data is either the data returned by the bus, or a function taking
+    # the address and size that returns it, e.g. SparseMemory.read_int
+    def _load(self, addr, size, signed, load_data):
+        if callable(load_data):
+            load_data = load_data(addr & 0xFFFFFFFF, size)
+        if load_data is None:
+            raise ValueError("No data supplied for load from {:08x}".format(addr))
+        data = load_data & ((1 << (8 * size)) - 1)
+        value = sign_extend(data, 8 * size) if signed else data
+        return value, MemAccess(addr & 0xFFFFFFFF, size, False, data)
+
+    def _store(self, addr, size, value):
+        data = value & ((1 << (8 * size)) - 1)
+        return MemAccess(addr & 0xFFFFFFFF, size, True, data)
+
+    def _execute32(self, instr, load_data):
+        opcode = bits(instr, 6, 0)
+        rd = bits(instr, 11, 7)
+        funct3 = bits(instr, 14, 12)
+        rs1 = bits(instr, 19, 15)
+        rs2 = bits(instr, 24, 20)
+        funct7 = bits(instr, 31, 25)
+        imm_i = sign_extend(instr >> 20, 12)
+        imm_u = instr & 0xFFFFF000
+        pc = self.pc
+
+        if opcode == 0x37:
+            return "lui", rd, imm_u, None, None
+        if opcode == 0x17:
+            return "auipc", rd, pc + imm_u, None, None
+        if opcode == 0x6F:
+            imm = sign_extend((bits(instr, 31, 31) << 20) | (bits(instr, 19, 12) << 12) |
+                              (bits(instr, 20, 20) << 11) | (bits(instr, 30, 21) << 1), 21)
+            return "jal", rd, pc + 4, None, pc + imm
+        if opcode == 0x67 and funct3 == 0:
+            target = (self.read(rs1) + imm_i) & ~1
+            return "jalr", rd, pc + 4, None, target
+        if opcode == 0x63:
+            imm = sign_extend((bits(instr, 31, 31) << 12) | (bits(instr, 7, 7) << 11) |
+                              (bits(instr, 30, 25) << 5) | (bits(instr, 11, 8) << 1), 13)
+            a = self.read(rs1)
+            b = self.read(rs2)
+            sa = sign_extend(a, 32)
+            sb = sign_extend(b, 32)
+            conds = {0: ("beq", a == b), 1: ("bne", a != b),
+                     4: ("blt", sa < sb), 5: ("bge", sa >= sb),
+                     6: ("bltu", a < b), 7: ("bgeu", a >= b)}
+            if funct3 not in conds:
+                raise ValueError("Illegal branch {:08x}".format(instr))
+            name, taken = conds[funct3]
+            return name, None, None, None, (pc + imm) if taken else None
+        # lw2 and lw4 load consecutive registers from rd, sw2 and sw4 store
+        # them from rs2, and sw4rep stores rs2 four times.  The toolchain uses
+        # them to copy data and clear bss at start up, and in its libraries.
+        if opcode == 0x03:
+            loads = {0: ("lb", 1, True), 1: ("lh", 2, True), 2: ("lw", 4, False), 3: ("lw2", 8, False),
+                     4: ("lbu", 1, False), 5: ("lhu", 2, False), 7: ("lw4", 16, False)}
+            if funct3 not in loads or rd + loads[funct3][1] // 4 > 16:
+                raise ValueError("Illegal load {:08x}".format(instr))
+            name, size, signed = loads[funct3]
+            value, access = self._load(self.read(rs1) + imm_i, size, signed, load_data)
+            return name, rd, value, access, None
+        if opcode == 0x23:
+            stores = {0: ("sb", 1), 1: ("sh", 2), 2: ("sw", 4), 3: ("sw2", 8), 6: ("sw4rep", 16), 7: ("sw4", 16)}
+            if funct3 not in stores or (funct3 in (3, 7) and rs2 + stores[funct3][1] // 4 > 16):
+                raise ValueError("Illegal store {:08x}".format(instr))
+            name, size = stores[funct3]
+            imm = sign_extend((funct7 << 5) | rd, 12)
+            if funct3 == 6:
+                value = self.read(rs2) * 0x00000001000000010000000100000001
+            elif funct3 in (3, 7):
+                value = sum(self.read(rs2 + i) << (32 * i) for i in range(size // 4))
+            else:
+                value = self.read(rs2)
+            access = self._store(self.read(rs1) + imm, size, value)
+            return name, None, None, access, None
+        if opcode == 0x13:
+            a = self.read(rs1)
+            if funct3 == 0: return "addi", rd, a + imm_i, None, None
+            if funct3 == 2: return "slti", rd, int(sign_extend(a, 32) < imm_i), None, None
+            if funct3 == 3: return "sltiu", rd, int(a < (imm_i & 0xFFFFFFFF)), None, None
+            if funct3 == 4: return "xori", rd, a ^ imm_i, None, None
+            if funct3 == 6: return "ori", rd, a | imm_i, None, None
+            if funct3 == 7: return "andi", rd, a & imm_i, None, None
+            if funct3 == 1 and funct7 == 0: return "slli", rd, a << rs2, None, None
+            if funct3 == 5 and funct7 == 0: return "srli", rd, a >> rs2, None, None
+            if funct3 == 5 and funct7 == 0x20: return "srai", rd, sign_extend(a, 32) >> rs2, None, None
+            raise ValueError("Illegal op-imm {:08x}".format(instr))
+        if opcode == 0x33:
+            a = self.read(rs1)
+            b = self.read(rs2)
+            shamt = b & 0x1F
+            ops = {(0, 0): ("add", lambda: a + b),
+                   (0, 0x20): ("sub", lambda: a - b),
+                   (1, 0): ("sll", lambda: a << shamt),
+                   (2, 0): ("slt", lambda: int(sign_extend(a, 32) < sign_extend(b, 32))),
+                   (3, 0): ("sltu", lambda: int(a < b)),
+                   (4, 0): ("xor", lambda: a ^ b),
+                   (5, 0): ("srl", lambda: a >> shamt),
+                   (5, 0x20): ("sra", lambda: sign_extend(a, 32) >> shamt),
+                   (6, 0): ("or", lambda: a | b),
+                   (7, 0): ("and", lambda: a & b),
+                   (0, 2): ("mul16", lambda: a * (b & 0xFFFF))}
+            if (funct3, funct7) not in ops:
+                raise ValueError("Illegal op {:08x}".format(instr))
+            name, fn = ops[(funct3, funct7)]
+            return name, rd, fn(), None, None
+        if opcode == 0x0F:
+            return "fence", None, None, None, None
+        if opcode == 0x73:
+            if instr == 0x30200073:
+                mstatus = self.csr[MSTATUS]
+                self.csr[MSTATUS] = (mstatus & ~MSTATUS_MIE) | (MSTATUS_MIE if mstatus & MSTATUS_MPIE else 0)
+                return "mret", None, None, None, self.csr[MEPC]
+            if funct3 == 0:
+                names = {0x00000073: "ecall", 0x00100073: "ebreak"}
+                if instr in names:
+                    return names[instr], None, None, None, None
+            elif funct3 != 4:
+                return "csr", rd, self._csr(instr >> 20, funct3, rs1), None, None
+            raise ValueError("Illegal system {:08x}".format(instr))
+
+        raise ValueError("Unsupported instruction {:08x}".format(instr))
+
+    # Read and update a CSR, returning the old value, or None if the CSR is
+    # not modelled
+    def _csr(self, csr, funct3, rs1):
+        if csr in COUNTERS:
+            return self.instret
+        if csr not in self.csr:
+            return None
+        old = self.csr[csr]
+        arg = rs1 if funct3 & 4 else self.read(rs1)
+        op = funct3 & 3
+        if op == 1:
+            self.csr[csr] = arg
+        elif op == 2:
+            self.csr[csr] = old | arg
+        else:
+            self.csr[csr] = old & ~arg
+        return old
+
+    def _execute16(self, instr, load_data):
+        quadrant = instr & 3
+        funct3 = bits(instr, 15, 13)
+        rd = bits(instr, 11, 7)
+        rs2 = bits(instr, 6, 2)
+        rd_p = bits(instr, 9, 7) + 8
+        rs2_p = bits(instr, 4, 2) + 8
+        imm6 = sign_extend((bits(instr, 12, 12) << 5) | bits(instr, 6, 2), 6)
+        uimm6 = (bits(instr, 12, 12) << 5) | bits(instr, 6, 2)
+        pc = self.pc
+
+        if instr == 0:
+            raise ValueError("Illegal instruction 0000")
+
+        if quadrant == 0:
+            if funct3 == 0:
+                imm = ((bits(instr, 12, 11) << 4) | (bits(instr, 10, 7) << 6) |
+                       (bits(instr, 6, 6) << 2) | (bits(instr, 5, 5) << 3))
+                return "c.addi4spn", rs2_p, self.read(2) + imm, None, None
+            if funct3 in (2, 6):
+                imm = (bits(instr, 12, 10) << 3) | (bits(instr, 6, 6) << 2) | (bits(instr, 5, 5) << 6)
+                addr = self.read(rd_p) + imm
+                if funct3 == 2:
+                    value, access = self._load(addr, 4, False, load_data)
+                    return "c.lw", rs2_p, value, access, None
+                return "c.sw", None, None, self._store(addr, 4, self.read(rs2_p)), None
+            if funct3 == 4:
+                # Zcb loads and stores
+                funct6 = bits(instr, 12, 10)
+                addr = self.read(rd_p) + (bits(instr, 5, 5) << 1)
+                if funct6 == 0:
+                    value, access = self._load(addr + bits(instr, 6, 6), 1, False, load_data)
+                    return "c.lbu", rs2_p, value, access, None
+                if funct6 == 1:
+                    signed = bits(instr, 6, 6) == 1
+                    value, access = self._load(addr, 2, signed, load_data)
+                    return "c.lh" if signed else "c.lhu", rs2_p, value, access, None
+                if funct6 == 2:
+                    return "c.sb", None, None, self._store(addr + bits(instr, 6, 6), 1, self.read(rs2_p)), None
+                if funct6 == 3 and bits(instr, 6, 6) == 0:
+                    return "c.sh", None, None, self._store(addr, 2, self.read(rs2_p)), None
+            if funct3 == 7:
+                # c.sw2 is encoded in the c.fsw slot, with the c.fsdsp
+                # immediate, storing rs2 and rs2+1 relative to gp
+                imm = (bits(instr, 12, 10) << 3) | (bits(instr, 9, 7) << 6)
+                rs2_pair = bits(instr, 6, 2)
+                if rs2_pair + 2 <= 16:
+                    value = self.read(rs2_pair) | (self.read(rs2_pair + 1) << 32)
+                    return "c.sw2", None, None, self._store(self.read(3) + imm, 8, value), None
+
+        elif quadrant == 1:
+            if funct3 == 0:
+                return "c.addi", rd, self.read(rd) + imm6, None, None
+            if funct3 in (1, 5):
+                imm = sign_extend((bits(instr, 12, 12) << 11) | (bits(instr, 11, 11) << 4) |
+                                  (bits(instr, 10, 9) << 8) | (bits(instr, 8, 8) << 10) |
+                                  (bits(instr, 7, 7) << 6) | (bits(instr, 6, 6) << 7) |
+                                  (bits(instr, 5, 3) << 1) | (bits(instr, 2, 2) << 5), 12)
+                if funct3 == 1:
+                    return "c.jal", 1, pc + 2, None, pc + imm
+                return "c.j", None, None, None, pc + imm
+            if funct3 == 2:
+                return "c.li", rd, imm6, None, None
+            if funct3 == 3:
+                if rd == 2:
+                    imm = sign_extend((bits(instr, 12, 12) << 9) | (bits(instr, 6, 6) << 4) |
+                                      (bits(instr, 5, 5) << 6) | (bits(instr, 4, 3) << 7) |
+                                      (bits(instr, 2, 2) << 5), 10)
+                    return "c.addi16sp", 2, self.read(2) + imm, None, None
+                return "c.lui", rd, imm6 << 12, None, None
+            if funct3 == 4:
+                op = bits(instr, 11, 10)
+                a = self.read(rd_p)
+                if op == 0 and uimm6 < 32:
+                    return "c.srli", rd_p, a >> uimm6, None, None
+                if op == 1 and uimm6 < 32:
+                    return "c.srai", rd_p, sign_extend(a, 32) >> uimm6, None, None
+                if op == 2:
+                    return "c.andi", rd_p, a & imm6, None, None
+                if op == 3:
+                    funct2 = bits(instr, 6, 5)
+                    if bits(instr, 12, 12) == 0:
+                        b = self.read(rs2_p)
+                        name, value = [("c.sub", a - b), ("c.xor", a ^ b),
+                                       ("c.or", a | b), ("c.and", a & b)][funct2]
+                        return name, rd_p, value, None, None
+                    if funct2 == 3:
+                        # Zcb bit manipulation
+                        ops = {0: ("c.zext.b", a & 0xFF),
+                               1: ("c.sext.b", sign_extend(a, 8)),
+                               2: ("c.zext.h", a & 0xFFFF),
+                               3: ("c.sext.h", sign_extend(a, 16)),
+                               5: ("c.not", ~a)}
+                        if rs2_p - 8 in ops:
+                            name, value = ops[rs2_p - 8]
+                            return name, rd_p, value, None, None
+            if funct3 in (6, 7):
+                imm = sign_extend((bits(instr, 12, 12) << 8) | (bits(instr, 11, 10) << 3) |
+                                  (bits(instr, 6, 5) << 6) | (bits(instr, 4, 3) << 1) |
+                                  (bits(instr, 2, 2) << 5), 9)
+                a = self.read(rd_p)
+                taken = (a == 0) if funct3 == 6 else (a != 0)
+                return "c.beqz" if funct3 == 6 else "c.bnez", None, None, None, (pc + imm) if taken else None
+
+        elif quadrant == 2:
+            if funct3 == 0 and uimm6 < 32:
+                return "c.slli", rd, self.read(rd) << uimm6, None, None
+            if funct3 == 1 and rd + 2 <= 16:
+                # c.lw2 is encoded in the c.fldsp slot, loading rd and rd+1
+                # relative to gp
+                imm = (bits(instr, 12, 12) << 5) | (bits(instr, 6, 5) << 3) | (bits(instr, 4, 2) << 6)
+                value, access = self._load(self.read(3) + imm, 8, False, load_data)
+                return "c.lw2", rd, value, access, None
+            if funct3 in (2, 3):
+                # c.lwtp is encoded in the c.flwsp slot
+                imm = (bits(instr, 12, 12) << 5) | (bits(instr, 6, 4) << 2) | (bits(instr, 3, 2) << 6)
+                base = 2 if funct3 == 2 else 4
+                value, access = self._load(self.read(base) + imm, 4, False, load_data)
+                return "c.lwsp" if funct3 == 2 else "c.lwtp", rd, value, access, None
+            if funct3 == 4:
+                if bits(instr, 12, 12) == 0:
+                    if rs2 == 0 and rd != 0:
+                        return "c.jr", None, None, None, self.read(rd) & ~1
+                    if rs2 != 0:
+                        return "c.mv", rd, self.read(rs2), None, None
+                else:
+                    if rs2 == 0 and rd == 0:
+                        return "c.ebreak", None, None, None, None
+                    if rs2 == 0:
+                        return "c.jalr", 1, pc + 2, None, self.read(rd) & ~1
+                    return "c.add", rd, self.read(rd) + self.read(rs2), None, None
+            if funct3 == 5:
+                # c.mul16 is encoded in the c.fsdsp slot
+                return "c.mul16", rd, self.read(rd) * (self.read(rs2) & 0xFFFF), None, None
+            if funct3 in (6, 7):
+                # c.swtp is encoded in the c.fswsp slot
+                imm = (bits(instr, 12, 9) << 2) | (bits(instr, 8, 7) << 6)
+                base = 2 if funct3 == 6 else 4
+                access = self._store(self.read(base) + imm, 4, self.read(rs2))
+                return "c.swsp" if funct3 == 6 else "c.swtp", None, None, access, None
+
+        raise ValueError("Unsupported instruction {:04x}".format(instr))
+
+
+# Checks the register writes made by the core against the model, as they happen.
+# Needs access to the debug_reg_wen and debug_rd signals inside the design, so
+# is not available for gate level tests.
+#
+# The core writes the destination register a nibble per clock, least significant
+# first, with debug_reg_wen high for the 8 cycles of the write.  The checker only
+# wakes on the rising edge of debug_reg_wen and for the cycles of each write.
+# debug_rd carries the data, not the register index, so only the values are
+# checked, and a write to the wrong register is only caught when the register
+# is read again or the registers are read back.  Writes to x0, gp and tp may
+# or may not be seen, so they are skipped if they don't match, and a write of
+# zero may be a write to x0.  Any other unexpected write is an error.
+class RegWriteChecker:
+    def __init__(self, dut, debug=False):
+        self.clk = dut.clk
+        self.wen = dut.user_project.debug_reg_wen
+        self.rd = dut.user_project.debug_rd
+        self.log = dut._log
+        self.debug = debug
+        self.expected = deque()
+        self.error = None
+        self.checked = 0
+        self.task = cocotb.start_soon(self._run())
+
+    @staticmethod
+    def available(dut):
+        return hasattr(dut.user_project, "debug_reg_wen")
+
+    def expect(self, retired):
+        if retired.rd is not None:
+            self.expected.append(retired)
+            for rd, value in retired.writes:
+                self.expected.append(retired._replace(rd=rd, value=value, writes=()))
+
+    def pending(self):
+        return any(r.rd not in (0, 3, 4) for r in self.expected)
+
+    def stop(self):
+        self.task.kill()
+
+    # Errors are raised from here, rather than from the checker's task, so
+    # that the test can handle them
+    def check(self):
+        assert self.error is None, self.error
+
+    # Wait for all the expected writes to be seen, the core must be kept
+    # running (e.g. with nops) while this happens.
+    async def drain(self, max_cycles=400):
+        for _ in range(max_cycles // 8):
+            self.check()
+            if not self.pending():
+                break
+            await ClockCycles(self.clk, 8)
+        else:
+            head = next(r for r in self.expected if r.rd not in (0, 3, 4))
+            assert False, "No register write seen for " + self._describe(head)
+        self.expected.clear()
+
+    def _describe(self, retired):
+        return "{} (instr {:08x} at pc {:x}) writing x{}".format(retired.name, retired.instr, retired.pc, retired.rd)
+
+    def _is_load(self, retired):
+        return retired.access is not None and not retired.access.store
+
+    # Loads may complete after later instructions have written back, and
+    # writes to x0, gp and tp may not be seen at all, so look past those.  A
+    # value that can't be modelled only matches in order.
+    def _check(self, value):
+        skipped = []
+        for i, entry in enumerate(self.expected):
+            if (entry.value == value or (entry.value is None and i == len(skipped)) or
+                    (value == 0 and entry.rd == 0)):
+                del self.expected[i]
+                for j in reversed(skipped):
+                    del self.expected[j]
+                self.checked += 1
+                if self.debug: self.log.info("{} = {:08x}".format(self._describe(entry), value))
+                return
+            if self._is_load(entry):
+                continue
+            if entry.rd not in (0, 3, 4):
+                break
+            skipped.append(i)
+
+        if self.expected:
+            head = self.expected[0]
+            self.error = "{}: got {:08x}, expected {}".format(
+                self._describe(head), value, "unknown" if head.value is None else "{:08x}".format(head.value))
+        else:
+            self.error = "Unexpected register write of {:08x}".format(value)
+        self.log.error(self.error)
+
+    async def _run(self):
+        while self.error is None:
+            if self.wen.value.binstr != "1":
+                await RisingEdge(self.wen)
+            value = 0
+            for count in range(8):
+                await FallingEdge(self.clk)
+                if self.wen.value.binstr != "1":
+                    break
+                value |= self.rd.value.integer << (4 * count)
+            else:
+                self._check(value)
@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+import os
+import re
+
+import cocotb
+from cocotb.queue import Queue
+from cocotb.result import SimTimeoutError
+from cocotb.triggers import FallingEdge, Timer, with_timeout
+
+UART_BAUD = 115200
+DEBUG_UART_BAUD = 4000000
+
+# Baud rate of the main UART.  RTL simulations run it faster, so read it
+# from the design, or from UART_BIT_RATE as set by the makefiles if the
+# parameter can't be read, e.g. in gate level simulation.
+def uart_baud(dut):
+    try:
+        return int(dut.user_project.i_uart_tx.BIT_RATE.value)
+    except AttributeError:
+        return int(os.environ.get("UART_BIT_RATE", UART_BAUD))
+
+# Receives bytes sent on a UART tx line and puts them in a queue.
+# The monitor sleeps until the start bit's falling edge and then samples
+# the middle of each bit, so it costs a handful of wake ups per byte.
+# Bytes that are interrupted by a reset are discarded.
+class UartMonitor:
+    def __init__(self, dut, tx, baud):
+        self.tx = tx
+        self.rst_n = dut.rst_n
+        self.log = dut._log
+        self.bit_time = round(1e9 / baud)
+        self.queue = Queue()
+        self.received = ""
+        self.task = cocotb.start_soon(self._run())
+
+    def stop(self):
+        self.task.kill()
+
+    # Discard anything received so far, e.g. after a reset
+    def clear(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.received = ""
+
+    async def get_byte(self, timeout_ns=None):
+        if timeout_ns is None:
+            return await self.queue.get()
+        return await with_timeout(self.queue.get(), timeout_ns, "ns")
+
+    async def get_char(self, timeout_ns=None):
+        try:
+            char = chr(await self.get_byte(timeout_ns))
+        except SimTimeoutError:
+            self.log.info(f"Received before timeout: {self.received}")
+            raise
+        self.received += char
+        return char
+
+    # Timeouts apply to each character
+    async def expect_string(self, expected, timeout_ns=None):
+        for char in expected:
+            self.log.debug(f"Wait for: {char}")
+            received = await self.get_char(timeout_ns)
+            assert received == char, f"Expected {expected!r}, received {self.received!r}"
+
+    async def read_until(self, end, timeout_ns=None):
+        s = ""
+        while not s.endswith(end):
+            s += await self.get_char(timeout_ns)
+        return s
+
+    async def expect_regex(self, pattern, timeout_ns=None):
+        s = ""
+        while True:
+            s += await self.get_char(timeout_ns)
+            match = re.search(pattern, s)
+            if match is not None:
+                return match
+
+    def _in_reset(self):
+        return self.rst_n.value.binstr != "1"
+
+    async def _run(self):
+        while True:
+            await FallingEdge(self.tx)
+            if self._in_reset():
+                continue
+
+            # Check the start bit in the middle, ignoring glitches
+            await Timer(self.bit_time // 2, "ns")
+            if self.tx.value.binstr != "0" or self._in_reset():
+                continue
+
+            uart_byte = 0
+            reset_seen = False
+            for i in range(8):
+                await Timer(self.bit_time, "ns")
+                reset_seen |= self._in_reset()
+                if not reset_seen:
+                    uart_byte |= self.tx.value << i
+            await Timer(self.bit_time, "ns")
+            if reset_seen or self._in_reset():
+                continue
+            assert self.tx.value == 1, f"Stop bit missing after {uart_byte:02x}"
+
+            self.log.debug(f"Recvd: {chr(uart_byte)}")
+            self.queue.put_nowait(uart_byte)
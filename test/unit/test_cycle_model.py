@@ -0,0 +1,64 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# The cycle model fit on synthetic benchmark results made from known costs,
+# and the counts taken from a kernel run on the reference model.
+
+import numpy as np
+import pytest
+
+import cycle_model
+from cycle_model import FEATURES, PRIOR, calibrate, features, fit, predict, trace_counts
+from kernels import int_loop, trace_on_model
+
+COUNTS = ("instr16", "instr32", "restart", "load", "load_bytes", "store", "store_bytes", "shift", "mul")
+TRUE_COSTS = {"instr16": 9, "instr32": 17, "restart": 30, "restart_latency": 2,
+              "load": 50, "load_latency": 3, "load_bytes": 5,
+              "store": 40, "store_latency": 1, "store_bytes": 3, "shift": 2, "mul": 6}
+
+def random_counts(rng, n, zero=()):
+    return [{name: 0 if name in zero else int(rng.integers(100, 5000)) for name in COUNTS} for _ in range(n)]
+
+def rows(counts, costs, latencies=(1, 2, 3, 4, 5)):
+    cost = np.array([costs[name] for name in FEATURES], dtype=float)
+    return [(c, latency, float(features(c, latency) @ cost)) for c in counts for latency in latencies]
+
+def test_fit_recovers_costs():
+    costs = fit(rows(random_counts(np.random.default_rng(1), 20), TRUE_COSTS))
+    assert costs == pytest.approx([TRUE_COSTS[name] for name in FEATURES], abs=0.01)
+
+def test_fit_clips_negative_costs():
+    data = rows(random_counts(np.random.default_rng(2), 20), dict(TRUE_COSTS, mul=-6))
+    x = np.array([features(c, latency) for c, latency, _ in data])
+    unconstrained = np.linalg.lstsq(x, [cycles for _, _, cycles in data], rcond=None)[0]
+    assert unconstrained[FEATURES.index("mul")] < 0
+    fitted = dict(zip(FEATURES, fit(data)))
+    assert fitted["mul"] == 0
+    assert all(cost >= 0 for cost in fitted.values())
+
+def test_fit_keeps_prior_for_unused_counts():
+    fitted = dict(zip(FEATURES, fit(rows(random_counts(np.random.default_rng(3), 20, zero=("instr16",)), TRUE_COSTS))))
+    assert fitted["instr16"] == pytest.approx(PRIOR["instr16"])
+    assert fitted["instr32"] == pytest.approx(17, abs=0.01)
+
+def test_calibrate(monkeypatch):
+    counts = {"k{}".format(i): c for i, c in enumerate(random_counts(np.random.default_rng(4), 20))}
+    monkeypatch.setattr(cycle_model, "kernel_counts", lambda: counts)
+    results = [{"kernel": name, "latency": latency, "cycles": cycles}
+               for name in counts for c, latency, cycles in rows([counts[name]], TRUE_COSTS)]
+    results.append({"kernel": "unknown", "latency": 1, "cycles": 1})
+    model = calibrate(results)
+    assert model["features"] == list(FEATURES)
+    assert model["coefficients"] == pytest.approx([TRUE_COSTS[name] for name in FEATURES], abs=0.01)
+    assert model["fit_error_percent"] < 0.01
+    assert model["error_percent"] < 0.5
+    assert predict(model, counts["k0"], 3) == pytest.approx(rows([counts["k0"]], TRUE_COSTS, (3,))[0][2], rel=1e-4)
+
+def test_trace_counts():
+    trace, _ = trace_on_model(int_loop(n=5).assemble())
+    counts = trace_counts(trace)
+    assert counts["instr32"] == len(trace)
+    assert counts["instr16"] == 0
+    assert counts["restart"] == 4       # The loop branch, taken all but the last time
+    assert counts["shift"] == 10
+    assert counts["load"] == counts["store"] == 0   # The debug UART write is a peripheral access
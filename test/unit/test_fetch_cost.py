@@ -0,0 +1,69 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Block finding and fetch cost on a small image assembled with kernels.Program,
+# with a data word after the code that must not be disassembled.
+
+from riscvmodel.insn import *
+from riscvmodel.regnames import x0, ra, tp, a0, a1
+
+from fetch_cost import (BRANCH, CALL, CYCLES_PER_BYTE, JUMP, PLAIN, RESTART_CYCLES, RETURN,
+                        decode, find_blocks, find_code, summary)
+from kernels import Program, DEBUG_UART
+
+def image():
+    p = Program()
+    p(InstructionJAL, x0, "main")
+    p.label("main")
+    p(InstructionADDI, a0, x0, 0)
+    p(InstructionADDI, a1, x0, 3)
+    p.label("loop")
+    p(InstructionADDI, a0, a0, 1)
+    p(InstructionADDI, a1, a1, -1)
+    p(InstructionBNE, a1, x0, "loop")
+    p(InstructionJAL, ra, "func")
+    p(InstructionSW, tp, a0, DEBUG_UART)
+    p.label("spin")
+    p(InstructionJAL, x0, "spin")
+    p.label("func")
+    p(InstructionADDI, a0, a0, 2)
+    p(InstructionJALR, x0, ra, 0)
+    return p.assemble() + b"\xff\xff\xff\xff"
+
+def test_decode():
+    code = image()
+    assert decode(code, 0) == (4, JUMP, 4)
+    assert decode(code, 4) == (4, PLAIN, None)
+    assert decode(code, 20) == (4, BRANCH, 12)
+    assert decode(code, 24) == (4, CALL, 36)
+    assert decode(code, 40) == (4, RETURN, None)
+    assert decode(bytes([0x01, 0xA0]), 0) == (2, JUMP, 0)      # c.j .
+    assert decode(bytes([0x82, 0x80]), 0) == (2, RETURN, None) # c.jr ra
+    assert decode(code, len(code) - 2) is None
+
+def test_data_not_disassembled():
+    code = image()
+    instrs, _ = find_code(code, [0])
+    assert sorted(instrs) == list(range(0, 44, 4))
+
+def test_blocks():
+    blocks = find_blocks(image(), [0])
+    assert [(b.start, len(b.instrs), b.restart, b.taken) for b in blocks] == [
+        (0, 1, True, 1),        # Jump to main
+        (4, 2, True, 0),        # Falls through into the loop
+        (12, 3, True, 1),       # Backward branch, assumed taken
+        (24, 1, False, 1),      # Call, reached by the loop falling through
+        (28, 1, True, 0),       # Returned to after the call
+        (32, 1, True, 1),       # Spin
+        (36, 2, True, 1),       # func, ending in a return
+    ]
+    assert blocks[1].fetch_cycles(2) == 8 * CYCLES_PER_BYTE + RESTART_CYCLES + 2
+    assert blocks[3].fetch_cycles(2) == 4 * CYCLES_PER_BYTE
+
+def test_summary():
+    result = summary(find_blocks(image(), [0]))
+    assert result["instrs"] == 11
+    assert result["compressed_percent"] == 0
+    assert result["bytes_per_instr"] == 4
+    assert result["taken_per_instr"] == round(5 / 11, 3)
+    assert result["cycles_l1"] == 44 * CYCLES_PER_BYTE + 6 * (RESTART_CYCLES + 1)
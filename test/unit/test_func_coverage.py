@@ -0,0 +1,58 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Coverage bins, sampling, holes and merging on a hand made ops table.
+
+from types import SimpleNamespace
+
+from func_coverage import Coverage, merge_files
+
+def op(name, kind, imm_range=None):
+    return SimpleNamespace(name=name, kind=kind, imm_range=lambda: imm_range)
+
+OPS = [op("add", "alu"), op("addi", "alu", (-2048, 2047)), op("lw", "load", (-2048, 2047))]
+
+def item(name, kind, dest, srcs, imm=None):
+    return {"op": name, "kind": kind, "dest": dest, "srcs": srcs, "imm": imm}
+
+def test_bins_defined_from_ops():
+    coverage = Coverage(OPS)
+    assert set(coverage.bins["op"]) == {"add", "addi", "lw"}
+    assert set(coverage.bins["imm"]) == {"addi -2048", "addi -1", "addi 0", "addi 2047",
+                                         "lw -2048", "lw -1", "lw 0", "lw 2047"}
+    assert set(coverage.bins["align"]) == {"lw +0", "lw +1", "lw +2", "lw +3"}
+    assert set(coverage.bins["dep"]) == {"alu->alu raw", "alu->alu waw", "alu->load raw", "alu->load waw",
+                                         "load->alu raw", "load->alu waw", "load->load raw", "load->load waw"}
+    assert coverage.percent() == 0
+
+def test_sample_and_holes():
+    coverage = Coverage(OPS)
+    prev = item("addi", "alu", 8, [9], imm=-1)
+    coverage.sample(prev)
+    coverage.sample(item("lw", "load", 8, [8], imm=0), addr=0x1000002, prev=prev)
+    holes = coverage.holes()
+    for hit in [("op", "addi"), ("op", "lw"), ("imm", "addi -1"), ("imm", "lw 0"), ("align", "lw +2"),
+                ("dep", "alu->load raw"), ("dep", "alu->load waw"), ("rd", "x8"), ("rs", "x9")]:
+        assert hit not in holes
+    assert ("op", "add") in holes
+    assert ("align", "lw +0") in holes
+    assert coverage.op_holes("lw") == ([-2048, -1, 2047], [0, 1, 3])
+
+def test_no_dependency_through_x0_or_gap():
+    coverage = Coverage(OPS)
+    coverage.sample(item("add", "alu", 9, [8, 9]), prev=item("add", "alu", 0, [1]))
+    coverage.sample(item("add", "alu", 9, [9]), prev=None)
+    assert coverage.bins["dep"]["alu->alu raw"] == 0
+    assert coverage.bins["dep"]["alu->alu waw"] == 0
+
+def test_merge_files(tmp_path):
+    a = Coverage(OPS)
+    a.sample(item("add", "alu", 1, [2]))
+    b = Coverage(OPS)
+    b.sample(item("add", "alu", 1, [2]))
+    b.sample(item("lw", "load", 1, [2], imm=0), addr=0x1000000)
+    a.save(str(tmp_path / "a.json"))
+    b.save(str(tmp_path / "b.json"))
+    merged = merge_files([str(tmp_path / "a.json"), str(tmp_path / "b.json")])
+    assert merged.bins["op"] == {"add": 2, "addi": 0, "lw": 1}
+    assert merged.bins["align"]["lw +0"] == 1
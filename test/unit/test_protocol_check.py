@@ -0,0 +1,94 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# The protocol checks on hand built QSPI sequences, one sample per cycle,
+# and the VCD loading on a small dump.
+
+import numpy as np
+
+from protocol_check import CONTROL_OE, FLASH, RAM_A, RAM_B, SELECT_BITS, check, check_dump
+
+IDLE_OUT = sum(1 << bit for bit in SELECT_BITS)
+
+def cycle(select=None, clk=0, nibble=0, data_oe=0xF, also_select=None):
+    out = IDLE_OUT | (clk << 3) | (((nibble >> 2) & 3) << 4) | ((nibble & 3) << 1)
+    for device in (select, also_select):
+        if device is not None:
+            out &= ~(1 << SELECT_BITS[device])
+    oe = CONTROL_OE | (((data_oe >> 2) & 3) << 4) | ((data_oe & 3) << 1)
+    return out, oe
+
+# The cycles of a transaction: a clock low then high cycle for each nibble,
+# given as (nibble, pins driven)
+def transaction(device, nibbles, **kwargs):
+    cycles = []
+    for nibble, driven in nibbles:
+        data_oe = 0xF if driven else 0
+        cycles.append(cycle(device, 0, nibble, data_oe, **kwargs))
+        cycles.append(cycle(device, 1, nibble, data_oe, **kwargs))
+    return cycles
+
+def flash_read(mode=0xA):
+    return ([(n, True) for n in (0, 0, 1, 2, 3, 4)] + [(mode, True), (mode, True)] +
+            [(0, False)] * 4 + [(5, False)] * 4)
+
+def ram_write():
+    return [(0, True), (2, True)] + [(0, True)] * 6 + [(7, True)] * 8
+
+def ram_read(command=0x0B):
+    return [(command >> 4, True), (command & 0xF, True)] + [(0, True)] * 6 + [(0, False)] * 4 + [(3, False)] * 8
+
+def samples(*transactions):
+    idle = cycle()
+    cycles = [(0, 0)] * 3 + [idle] * 2
+    for txn in transactions:
+        cycles += txn + [idle] * 2
+    rst_n = np.array([0] * 3 + [1] * (len(cycles) - 3))
+    out, oe = (np.array(x) for x in zip(*cycles))
+    return {"rst_n": rst_n, "uio_out": out, "uio_oe": oe}
+
+def failed(failures):
+    return {name for name, indices in failures.items() if len(indices)}
+
+def test_legal_sequence_passes():
+    assert failed(check(samples(transaction(FLASH, flash_read()), transaction(RAM_A, ram_write()),
+                                transaction(RAM_B, ram_read())))) == set()
+
+def test_unknown_ram_command():
+    assert failed(check(samples(transaction(RAM_A, ram_read(command=0x03))))) == {"command"}
+
+def test_bad_mode_bits():
+    assert failed(check(samples(transaction(FLASH, flash_read(mode=0x5))))) == {"mode"}
+
+def test_two_selects_low():
+    assert "select" in failed(check(samples(transaction(RAM_A, ram_read(), also_select=RAM_B))))
+
+def test_pins_driven_in_dummy_cycles():
+    nibbles = flash_read()
+    nibbles[8] = (0, True)
+    assert failed(check(samples(transaction(FLASH, nibbles)))) == {"direction"}
+
+def test_clock_high_back_to_back():
+    txn = transaction(RAM_A, ram_write())
+    txn[2] = cycle(RAM_A, 1, 0, 0xF)
+    assert "clock" in failed(check(samples(txn)))
+
+def test_driven_in_reset():
+    s = samples(transaction(FLASH, flash_read()))
+    s["uio_oe"][1] = CONTROL_OE
+    assert failed(check(s)) == {"reset"}
+
+def test_check_dump(tmp_path):
+    s = samples(transaction(RAM_A, ram_read(command=0x03)))
+    lines = ["$timescale 1ns $end", "$scope module tb $end",
+             "$var wire 1 ! clk $end", "$var wire 1 \" rst_n $end",
+             "$var wire 8 # uio_out [7:0] $end", "$var wire 8 $ uio_oe [7:0] $end",
+             "$upscope $end", "$enddefinitions $end"]
+    for i in range(len(s["rst_n"])):
+        lines += ["#{}".format(10 * i), "1!", "{}\"".format(s["rst_n"][i]),
+                  "b{:b} #".format(s["uio_out"][i]), "b{:b} $".format(s["uio_oe"][i]), "#{}".format(10 * i + 5), "0!"]
+    path = tmp_path / "dump.vcd"
+    path.write_text("\n".join(lines) + "\n")
+    times_ns, failures = check_dump(str(path))
+    assert len(times_ns) == len(s["rst_n"])
+    assert failed(failures) == {"command"}
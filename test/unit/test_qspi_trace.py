@@ -0,0 +1,40 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# The bus report of hand built QSPI transaction traces.
+
+import numpy as np
+
+from bus import FLASH, RAM_A, RAM_B
+from qspi_trace import TRACE_DTYPE, bus_report
+
+def trace(*transactions):
+    records = np.zeros(len(transactions), dtype=TRACE_DTYPE)
+    start = 0
+    for i, (device, cycles, setup, length, complete) in enumerate(transactions):
+        records[i] = (device, 0, 0, start, cycles, setup, length, complete)
+        start += cycles
+    return records
+
+def test_utilisation_and_bursts():
+    report = bus_report(trace((FLASH, 40, 20, 10, True), (RAM_A, 30, 14, 4, True), (FLASH, 30, 20, 5, False)), 200)
+    assert report["transactions"] == 3
+    assert report["flash_busy_percent"] == 35.0
+    assert report["ram_a_busy_percent"] == 15.0
+    assert report["ram_b_busy_percent"] == 0.0
+    assert report["fetches"] == 2
+    assert report["average_fetch_bytes"] == 7.5
+    assert report["aborted_fetches"] == 1
+
+def test_restart_after_back_to_back_accesses():
+    # The aborted fetch before a load and a store is charged to the restart
+    # after them, the completed fetch before a single load isn't
+    report = bus_report(trace((FLASH, 10, 8, 1, False), (RAM_A, 5, 4, 4, True), (RAM_B, 5, 4, 4, True),
+                              (FLASH, 20, 8, 6, True), (RAM_A, 5, 4, 4, True), (FLASH, 20, 8, 6, True)), 100)
+    assert report["fetch_restarts"] == 2
+    assert report["average_restart_wasted_cycles"] == ((8 + 10) + 8) / 2
+
+def test_restart_without_earlier_fetch():
+    report = bus_report(trace((RAM_A, 5, 4, 4, True), (FLASH, 20, 8, 6, True)), 100)
+    assert report["fetch_restarts"] == 1
+    assert report["average_restart_wasted_cycles"] == 8
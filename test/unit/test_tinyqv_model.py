@@ -0,0 +1,160 @@
+# SPDX-FileCopyrightText: © 2024 Michael Bell
+# SPDX-License-Identifier: MIT
+
+# Decode and execute checks of the reference model, and of the register
+# write checker's matching, on hand encoded instructions.
+
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+
+from riscvmodel.insn import InstructionADDI, InstructionBNE, InstructionJAL, InstructionLUI, InstructionLW, \
+    InstructionSRAI, InstructionSUB, InstructionSW
+from riscvmodel.regnames import x0, ra, gp, s0, s1, a0, a1
+
+from qspi_memory import SparseMemory
+from tinyqv_model import GP_VALUE, INTERRUPT_VECTOR, MCAUSE, MEPC, MIE, MSTATUS, MSTATUS_MIE, \
+    RegWriteChecker, TinyQVModel
+
+def run(model, memory, *instrs):
+    return [model.execute(instr, memory.read_int) for instr in instrs]
+
+def load32(funct3, rd, rs1, imm):
+    return ((imm & 0xFFF) << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | 0x03
+
+def store32(funct3, rs2, rs1, imm):
+    return (((imm >> 5) & 0x7F) << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | ((imm & 0x1F) << 7) | 0x23
+
+def test_alu_and_x0():
+    model = TinyQVModel()
+    run(model, SparseMemory(),
+        InstructionLUI(a0, 0x12345).encode(),
+        InstructionADDI(a0, a0, 0x678).encode(),
+        InstructionSUB(a1, x0, a0).encode(),
+        InstructionSRAI(s0, a1, 4).encode(),
+        InstructionADDI(x0, a0, 1).encode())
+    assert model.reg[a0] == 0x12345678
+    assert model.reg[a1] == (-0x12345678) & 0xFFFFFFFF
+    assert model.reg[s0] == (-0x12345678 >> 4) & 0xFFFFFFFF
+    assert model.reg[x0] == 0
+    assert model.pc == 20
+
+def test_gp_is_hard_wired():
+    model = TinyQVModel()
+    retired, = run(model, SparseMemory(), InstructionADDI(gp, x0, 1).encode())
+    assert retired.rd == gp
+    assert model.reg[gp] == GP_VALUE
+
+def test_load_store():
+    model = TinyQVModel()
+    memory = SparseMemory()
+    model.reg[a0] = 0xDEADBEEF
+    store, = run(model, memory, InstructionSW(gp, a0, 8).encode())
+    assert store.access == (GP_VALUE + 8, 4, True, 0xDEADBEEF)
+    memory.write_int(store.access.addr, 4, store.access.value)
+    load = model.execute(InstructionLW(a1, gp, 8).encode(), memory.read_int)
+    assert load.value == 0xDEADBEEF and model.reg[a1] == 0xDEADBEEF
+
+def test_branch_and_jal():
+    model = TinyQVModel()
+    model.reg[a0] = 1
+    bne, jal = run(model, SparseMemory(), InstructionBNE(a0, x0, 8).encode(), InstructionJAL(ra, 0x100).encode())
+    assert bne.pc == 0 and jal.pc == 8
+    assert jal.rd == ra and jal.value == 12
+    assert model.pc == 0x108
+
+def test_lw2_and_sw4():
+    model = TinyQVModel()
+    memory = SparseMemory()
+    for i in range(4):
+        model.reg[s0 + i] = 0x11111111 * (i + 1)
+    sw4, = run(model, memory, store32(7, s0, gp, 16))
+    assert sw4.name == "sw4" and sw4.access.size == 16
+    memory.write_int(sw4.access.addr, 16, sw4.access.value)
+    lw2, = run(model, memory, load32(3, a0, gp, 20))
+    assert lw2.name == "lw2"
+    assert (lw2.rd, lw2.value) == (a0, 0x22222222)
+    assert lw2.writes == ((a1, 0x33333333),)
+    assert model.reg[a1] == 0x33333333
+
+def test_sw4rep_repeats_the_register():
+    model = TinyQVModel()
+    model.reg[a0] = 0xA5
+    retired, = run(model, SparseMemory(), store32(6, a0, gp, 0))
+    assert retired.access.value == 0xA5 * 0x00000001000000010000000100000001
+
+def test_mul16():
+    model = TinyQVModel()
+    model.reg[a0] = 0x1234
+    model.reg[a1] = 0xFFFF0003
+    run(model, SparseMemory(), (2 << 25) | (a1 << 20) | (a0 << 15) | (s1 << 7) | 0x33)
+    assert model.reg[s1] == 0x1234 * 3
+
+def test_illegal_instruction():
+    with pytest.raises(ValueError):
+        TinyQVModel().execute(load32(6, a0, gp, 0), SparseMemory().read_int)
+
+def test_compressed():
+    model = TinyQVModel()
+    # c.li a0, 5; c.addi a0, -1; c.mv a1, a0
+    run(model, SparseMemory(), 0x4515, 0x157D, 0x85AA)
+    assert model.reg[a0] == 4 and model.reg[a1] == 4
+    assert model.pc == 6
+
+def test_interrupt_and_mret():
+    model = TinyQVModel()
+    model.pc = 0x40
+    model.csr[MIE] = 1 << 19
+    model.set_pending(19)
+    assert not model.take_interrupt()
+    model.csr[MSTATUS] = MSTATUS_MIE
+    assert model.take_interrupt()
+    assert model.pc == INTERRUPT_VECTOR
+    assert model.csr[MEPC] == 0x40 and model.csr[MCAUSE] == 0x80000013
+    assert not model.csr[MSTATUS] & MSTATUS_MIE
+    model.execute(0x30200073)
+    assert model.pc == 0x40 and model.csr[MSTATUS] & MSTATUS_MIE
+
+def checker(*retired):
+    c = RegWriteChecker.__new__(RegWriteChecker)
+    c.log = SimpleNamespace(info=print, error=print)
+    c.debug = False
+    c.expected = deque()
+    c.error = None
+    c.checked = 0
+    for r in retired:
+        c.expect(r)
+    return c
+
+def retired(model, instr, memory=None):
+    return model.execute(instr, (memory or SparseMemory()).read_int)
+
+def test_checker_matches_in_order():
+    model = TinyQVModel()
+    c = checker(retired(model, InstructionADDI(a0, x0, 1).encode()), retired(model, InstructionADDI(a1, x0, 2).encode()))
+    c._check(1)
+    c._check(2)
+    assert c.error is None and c.checked == 2 and not c.expected
+
+def test_checker_looks_past_loads_and_unseen_writes():
+    model = TinyQVModel()
+    memory = SparseMemory()
+    memory.write_int(GP_VALUE, 4, 0x55)
+    load = retired(model, InstructionLW(a0, gp, 0).encode(), memory)
+    gp_write = retired(model, InstructionADDI(gp, x0, 7).encode())
+    alu = retired(model, InstructionADDI(a1, x0, 9).encode())
+    c = checker(load, gp_write, alu)
+    # The ALU result overtakes the load, and the write to gp is never seen
+    c._check(9)
+    c._check(0x55)
+    assert c.error is None and not c.pending()
+
+def test_checker_reports_wrong_and_unmatched_values():
+    model = TinyQVModel()
+    c = checker(retired(model, InstructionADDI(a0, x0, 1).encode()))
+    c._check(2)
+    assert "expected 00000001" in c.error
+    c = checker()
+    c._check(0)
+    assert c.error == "Unexpected register write of 00000000"